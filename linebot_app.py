@@ -34,6 +34,13 @@ rag_system = CourseRAGSystem()
 query_system = CourseQuerySystem(rag_system)
 print("✅ RAG 系統初始化完成")
 
+# 查詢前處理要移除的客套詞前綴（依序套用：先移除較長的前綴，再移除常見客套詞與「查詢/找」）
+_POLITE_PREFIX_RES = (
+    re.compile(r'^(請幫我查詢|請幫我找|幫我查詢|幫我找|麻煩查詢|麻煩找)\s*'),
+    re.compile(r'^(請幫我|麻煩你|麻煩|請|幫我|幫忙|幫忙查詢|幫忙找)\s*'),
+    re.compile(r'^(查詢|查找|找)\s*'),
+)
+
 # 避免重複回覆：記錄近期處理過的 message_id
 RECENT_MESSAGE_IDS = deque(maxlen=200)
 RECENT_MESSAGE_SET = set()
@@ -115,9 +122,8 @@ def handle_message(event):
             # 前處理：移除客套詞，降低干擾
             cleaned_message = user_message.strip()
             # 先移除較長的前綴，再移除常見客套詞與「查詢/找」
-            cleaned_message = re.sub(r'^(請幫我查詢|請幫我找|幫我查詢|幫我找|麻煩查詢|麻煩找)\s*', '', cleaned_message)
-            cleaned_message = re.sub(r'^(請幫我|麻煩你|麻煩|請|幫我|幫忙|幫忙查詢|幫忙找)\s*', '', cleaned_message)
-            cleaned_message = re.sub(r'^(查詢|查找|找)\s*', '', cleaned_message)
+            for prefix_re in _POLITE_PREFIX_RES:
+                cleaned_message = prefix_re.sub('', cleaned_message)
             app.logger.info(f"查詢中：{user_message} -> 清理後：{cleaned_message}")
             # 可以調整 n_results 來改變顯示的課程數量（預設 10 個，合併後應該會有 5 門不同的課程）
             n_results = 10
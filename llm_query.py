@@ -1,10 +1,23 @@
 """
 LLM 查詢系統：整合 RAG 與 LLM，實現自然語言查詢課程
 """
+from __future__ import annotations
+
 import os
 import re
-import json
-from typing import List, Dict, Optional
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from types import MappingProxyType
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple, Union
 from dotenv import load_dotenv
 from openai import OpenAI
 from rag_system import CourseRAGSystem
@@ -17,12 +30,842 @@ from utils import (
     check_grades_required_from_json,
     extract_time_from_query,
     check_time_match,
+    extract_document_field,
+    extract_document_grade_required,
+    safe_load_mapping_status,
     parse_grade_required_mapping
 )
 
 # 載入環境變數
 load_dotenv()
 
+# 學院映射關係（解決微積分、物理等院級課程匹配問題）
+_COLLEGE_MAPPINGS: Mapping[str, Tuple[str, ...]] = MappingProxyType({
+    '通訊系': ('電機資訊學院', '電資院'),
+    '資工系': ('電機資訊學院', '電資院'),
+    '電機系': ('電機資訊學院', '電資院'),
+    '經濟系': ('社會科學學院', '社科院'),
+    '社工系': ('社會科學學院', '社科院'),
+    '社會系': ('社會科學學院', '社科院'),
+    '法律系': ('法律學院', '法學院'),
+})
+
+# 常見系所簡稱與全名關鍵字對應
+_DEPT_MAPPINGS: Mapping[str, Tuple[str, ...]] = MappingProxyType({
+    '資工系': ('資訊工程', '資工'),
+    '通訊系': ('通訊工程', '通訊'),
+    '電機系': ('電機工程', '電機'),
+    '企管系': ('企業管理', '企管'),
+    '社工系': ('社會工作', '社工'),
+    '公行系': ('公共行政', '公行'),
+    '不動系': ('不動產', '不動'),
+    '休運系': ('休閒運動', '休運'),
+})
+
+# 設定環境變數 LLM_TRACE 時，過濾與補強邏輯會印出逐筆課程的比對過程；
+# 未設定時只印每個階段的摘要，避免每門課都寫一次 stdout
+_DEBUG_COURSE_TRACE = bool(os.environ.get('LLM_TRACE'))
+# 初始過濾時要追蹤的課程
+_DEBUG_FILTER_COURSES = ('計算機結構', '通訊原理', '多媒體訊號處理', '專題製作')
+
+_DIGITS_RE = re.compile(r'\d+')
+# 全表快照中要 intern 的 metadata 欄位（值在課程間大量重複）
+_INTERNED_META_FIELDS = ('grade', 'required', 'dept', 'schedule')
+# 補強逐筆判斷用到的欄位；建立快照時缺少的欄位先補成空字串，之後可直接一次取出
+_AUGMENT_META_FIELDS = ('grade', 'required', 'name', 'serial', 'grade_required_mapping')
+_AUGMENT_META_GETTER = itemgetter(*_AUGMENT_META_FIELDS)
+# 讀取全表快照時同時進行的批次數
+_SNAPSHOT_FETCH_WORKERS = 4
+# 年級後面的班別字母（例如「經濟系1A」的 A）
+_SECTION_LETTERS = frozenset('ABCDEF')
+# 從查詢或年級字串中擷取系所（XX系、XX碩；簡短版只取1-4個字）
+_DEPT_XI_RE = re.compile(r'(\S+系)')
+_DEPT_SHI_RE = re.compile(r'(\S+碩)')
+_SHORT_DEPT_XI_RE = re.compile(r'([^\s]{1,4}系)')
+_SHORT_DEPT_SHI_RE = re.compile(r'([^\s]{1,4}碩)')
+
+# 法律系各組（法學組、司法組、財經法學組）在年級欄位中的關鍵字
+_LAW_GROUP_RE = re.compile('法學|司法|財法|法律')
+
+# 送進 LLM 的課程筆數上限（與 system prompt「課程一次最多顯示15筆」一致）
+_MAX_PROMPT_COURSES = 15
+
+# LLM 回答的 token 上限：基本開場/結尾 + 每門課程的估計長度，最多不超過 _MAX_ANSWER_TOKENS
+_MAX_ANSWER_TOKENS = 4000
+_ANSWER_BASE_TOKENS = 400
+_ANSWER_TOKENS_PER_COURSE = 200
+
+# 送進 LLM 的課程 context 字數上限（約略對應 token 預算）
+_CONTEXT_CHAR_BUDGET = 40000
+
+# grade 欄位中的「系所年級」token（例如「通訊系3」）
+_DEPT_GRADE_TOKEN = re.compile(r'系\d+|系[一二三四]')
+
+# grade 欄位的 token 分隔字元（沿用原本 re.split(r'[\\|,，/\\s]+') 的字元集合）
+_GRADE_TOKEN_SEPARATORS = '\\|,，/s'
+# 分隔字元統一換成「|」後再以 str.split 切分
+_GRADE_TOKEN_TRANS = str.maketrans(dict.fromkeys(_GRADE_TOKEN_SEPARATORS, '|'))
+
+
+@lru_cache(maxsize=8192)
+def _split_grade_tokens(text: str) -> Tuple[str, ...]:
+    """
+    切分 grade/required 欄位為 token（依字串快取；保留空 token 以維持與必選修欄位的位置對應）
+    
+    Args:
+        text: grade 或 required 欄位字串
+        
+    Returns:
+        切分後的 token tuple
+    """
+    parts = text.translate(_GRADE_TOKEN_TRANS).split('|')
+    last = len(parts) - 1
+    # 連續分隔字元視為一個（與 regex 的「+」相同），只保留頭尾的空 token
+    return tuple(p for i, p in enumerate(parts) if p or i == 0 or i == last)
+
+
+@lru_cache(maxsize=64)
+def _target_dept_grade_pattern(target_dept: str) -> re.Pattern:
+    """
+    建立判斷 grade 欄位是否含有目標系所年級 token 的正則（依系所快取）
+    
+    等同於逐一檢查分隔後的 token：
+    1. 排除含「學程」的 token
+    2. 學士班排除含「碩」的 token；碩士班排除含「系」但不含「碩」的 token
+    3. token 以完整系名開頭，或以去「系」的簡稱開頭且後接數字/年級/組別字元或結尾
+    
+    目標為法律系時，另外接受 grade 欄位任何位置出現的法學/司法/財法/法律組別字樣，
+    合併成同一個正則，只需搜尋一次。
+    """
+    sep = re.escape(_GRADE_TOKEN_SEPARATORS)
+    body = f'[^{sep}]*'
+    target_dept_short = target_dept.replace('系', '')
+    if '碩' not in target_dept:
+        level_guard = f'(?!{body}碩)'
+    else:
+        level_guard = f'(?={body}碩|(?!{body}系))'
+    pattern = (
+        f'(?:^|(?<=[{sep}]))(?=[^{sep}])(?!{body}學程){level_guard}'
+        f'(?:{re.escape(target_dept)}|{re.escape(target_dept_short)}'
+        f'(?:[1234567890碩一二三四ABCDEFX系法司財]|(?=[{sep}]|\\Z)))'
+    )
+    # 特殊處理：法律系包含法學組、司法組、財經法學組
+    if '法律' in target_dept:
+        pattern = f'{_LAW_GROUP_RE.pattern}|{pattern}'
+    return re.compile(pattern)
+
+
+@lru_cache(maxsize=16384)
+def _grade_has_target_dept(grade_text: str, target_dept: str) -> bool:
+    """
+    判斷 grade 欄位中是否包含目標系所（須為獨立年級/組別，而非學程名稱）
+    
+    Args:
+        grade_text: 年級欄位，例如「資工系2|通訊系2」
+        target_dept: 目標系所，例如「資工系」、「資工碩」
+        
+    Returns:
+        是否包含目標系所
+    """
+    if not grade_text or not target_dept:
+        return False
+    return _target_dept_grade_pattern(target_dept).search(grade_text) is not None
+
+
+@lru_cache(maxsize=16384)
+def _course_matches_target_dept(grade_text: str, dept_text: str, target_dept: str,
+                                dept_name_pattern: re.Pattern, college_pattern: re.Pattern) -> bool:
+    """
+    判斷課程是否屬於目標系所（優先依應修系級 grade 判斷，其次為開課系所與院級課程）
+    
+    結果只取決於 (年級, 開課系所, 目標系所)，許多課程共用相同組合，因此依參數快取。
+    
+    Args:
+        grade_text: 年級欄位（應修系級）
+        dept_text: 開課系所
+        target_dept: 目標系所
+        dept_name_pattern: 開課系所比對用的系名關鍵字正則
+        college_pattern: 院級課程比對用的學院關鍵字正則
+        
+    Returns:
+        是否符合系所條件
+    """
+    tokens: List[str] = [tk for tk in _split_grade_tokens(grade_text) if tk] if grade_text else []
+    
+    # 排除學位學程與微學程
+    # 只排除「只屬於」學位學程或微學程的課程（grade_text 中沒有任何系所年級）
+    has_dept_grade = any(_DEPT_GRADE_TOKEN.search(tk) for tk in tokens)
+    if not has_dept_grade and ('學位學程' in grade_text or '微學程' in grade_text):
+        return False
+    
+    # 如果 dept_text 是學位學程或微學程，則排除
+    if '學位學程' in dept_text or '微學程' in dept_text:
+        return False
+    
+    # 1. 檢查年級欄位
+    grade_match: bool = _grade_has_target_dept(grade_text, target_dept) if grade_text else False
+    
+    # 2. 檢查開課系所 (支援簡稱匹配全名)
+    dept_match: bool = dept_name_pattern.search(dept_text) is not None if dept_text else False
+    
+    # 3. 檢查年級欄位是否包含學院名稱（例如「電資院1」）
+    college_grade_match: bool = college_pattern.search(grade_text) is not None if grade_text else False
+    
+    # 應修系級中是否有學士班的年級（例如「資工系2」），學程名稱不計
+    program_tokens: List[str] = [tk for tk in tokens if '學程' not in tk]
+    has_undergrad_grade = any('系' in tk and '碩' not in tk for tk in program_tokens)
+    
+    # 修正：優先使用應修系級 (grade) 判斷，避免開課系所造成的誤判
+    # 特別處理：如果目標是學士班（不包含「碩」），排除只開給碩士班的課程
+    target_is_undergrad = '碩' not in target_dept
+    if target_is_undergrad and grade_text and not has_undergrad_grade:
+        # 沒有學士班年級時，以最後一個 token 是否為碩士班年級為準（沒有 token 視為只有碩士班）
+        has_master_grade_only = '碩' in program_tokens[-1] if program_tokens else True
+        if has_master_grade_only:
+            grade_match = False
+    
+    if grade_match:
+        return True
+    if dept_match:
+        # 開課系所符合，但須檢查應修系級是否明確排除了該系（例如通識課）
+        if '通識' in grade_text and '通識' not in target_dept:
+            return False
+        if '體育' in grade_text and '體育' not in target_dept:
+            return False
+        # 如果目標是學士班，但開課系所是碩士班，且 grade_text 中沒有學士班的年級，則排除
+        if target_is_undergrad and '碩' in dept_text:
+            return not (grade_text and not has_undergrad_grade)
+        # 若應修系級沒有明確排除（例如只寫「1」或「選修」），則接受開課系所
+        return True
+    return college_grade_match
+
+
+# 系所候選字串中不應出現的時間詞／問句詞
+_DEPT_STOPWORD_RE = re.compile('週|周|星期|禮拜|早上|下午|晚上|夜間|有什麼|哪些|什麼')
+
+# 從查詢擷取系所前先移除的問句詞彙與時間詞彙（依序取代）
+_QUESTION_WORDS = ('有什麼', '哪些', '什麼', '查詢', '找', '幫我', '請', '的', '課程', '課')
+_TIME_WORDS = (
+    '週一', '週二', '週三', '週四', '週五', '週六', '週日',
+    '周一', '周二', '周三', '周四', '周五', '周六', '周日',
+    '星期一', '星期二', '星期三', '星期四', '星期五', '星期六', '星期日',
+    '禮拜一', '禮拜二', '禮拜三', '禮拜四', '禮拜五', '禮拜六', '禮拜日',
+    '早上', '上午', '下午', '晚上', '夜間', 'AM', 'PM',
+)
+
+
+def _dept_from_grade(target_grade: str) -> Optional[str]:
+    """
+    從年級字串中提取系所（例如「統計系1」→「統計系」、「資工碩1」→「資工碩」）
+    
+    Args:
+        target_grade: extract_grade_from_query 的結果
+        
+    Returns:
+        系所名稱；找不到時回傳 None
+    """
+    match = _DEPT_XI_RE.search(target_grade) or _DEPT_SHI_RE.search(target_grade)
+    return match.group(1) if match else None
+
+
+def _dept_from_question(question: str) -> Optional[str]:
+    """
+    直接從查詢中提取簡短的系所名稱（XX系，其次 XX碩）
+    
+    先移除常見的問句詞彙和時間詞彙，再匹配1-4個字的系所名稱。
+    
+    Args:
+        question: 使用者問題
+        
+    Returns:
+        系所名稱；找不到或是時間/問句詞彙時回傳 None
+    """
+    cleaned_query = question
+    for word in _QUESTION_WORDS + _TIME_WORDS:
+        cleaned_query = cleaned_query.replace(word, ' ')
+    
+    match = _SHORT_DEPT_XI_RE.search(cleaned_query) or _SHORT_DEPT_SHI_RE.search(cleaned_query)
+    if not match:
+        return None
+    dept = match.group(1).strip()
+    # 再次檢查，確保不是時間相關的詞彙或問句詞彙
+    return None if _DEPT_STOPWORD_RE.search(dept) else dept
+
+
+@lru_cache(maxsize=64)
+def _keyword_pattern(keywords: Tuple[str, ...]) -> re.Pattern:
+    """
+    將關鍵字組合成單一正則（任一關鍵字出現即匹配；空集合永不匹配）
+    
+    Args:
+        keywords: 關鍵字 tuple
+        
+    Returns:
+        編譯後的正則
+    """
+    if not keywords:
+        return re.compile('(?!)')
+    return re.compile('|'.join(map(re.escape, keywords)))
+
+
+@lru_cache(maxsize=16384)
+def _time_branch_dept_match(grade_text: str, dept_text: str, target_dept: str, target_dept_short: str,
+                            college_pattern: re.Pattern) -> bool:
+    """
+    時間條件回覆的系所過濾：優先使用年級欄位，避免誤匹配開課系所（便宜的條件先判斷）
+    
+    結果只取決於 (年級, 開課系所, 目標系所)，時間條件查詢常一次過濾上百門課，因此依參數快取。
+    
+    Args:
+        grade_text: 年級欄位（應修系級）
+        dept_text: 開課系所
+        target_dept: 目標系所
+        target_dept_short: 去「系」後的目標系所
+        college_pattern: 院級課程比對用的學院關鍵字正則
+        
+    Returns:
+        是否保留該課程
+    """
+    if not grade_text:
+        return False
+    
+    # 通識課程可能由不同系所開設（例如「歷史系」、「體育」），年級欄位中包含「通識」即可
+    if target_dept == '通識':
+        return _grade_has_target_dept(grade_text, target_dept)
+    
+    # 其他系所必須同時滿足：
+    # 1. 開課系所也要匹配，避免顯示其他系開設但年級欄位中包含目標系所的課程；或為學院級課程（例如「電資院1」）
+    # 2. 年級欄位中包含目標系所
+    # 不包含只有年級欄位或只有開課系所匹配的情況，避免誤匹配
+    dept_ok = bool(dept_text) and target_dept_short in dept_text
+    if not dept_ok and college_pattern.search(grade_text) is None:
+        return False
+    return _grade_has_target_dept(grade_text, target_dept)
+
+
+@lru_cache(maxsize=8192)
+def _schedule_matches_time(schedule: str, day: Optional[str], period: Optional[str]) -> bool:
+    """
+    check_time_match 的快取版本：同一個上課時間字串在同一時間條件下只解析一次
+    
+    Args:
+        schedule: 上課時間字串
+        day: 星期條件，例如「週二」
+        period: 時段條件，例如「早上」
+        
+    Returns:
+        是否符合時間條件
+    """
+    return check_time_match(schedule, {'day': day, 'period': period})
+
+
+# 碩士班必修查詢額外檢索的查詢（部分專題研討課程的開課系所不同）
+_MASTER_SEMINAR_QUERY = '專題研討 Seminar'
+
+# 回答快取的最大筆數與有效秒數（課程資料在筆數不變的情況下更新時，舊回答最多保留這麼久）
+_ANSWER_CACHE_SIZE = 512
+_ANSWER_CACHE_TTL = 3600
+
+# 問題結尾的標點（不影響查詢條件，正規化時去除）
+_TRAILING_PUNCT_RE = re.compile(r'[?？!！。.~～]+$')
+
+
+def _normalize_question(question: str) -> str:
+    """將問題正規化為快取 key：全形轉半形、合併連續空白、去除結尾標點"""
+    text = unicodedata.normalize('NFKC', question)
+    text = ' '.join(text.split())
+    return _TRAILING_PUNCT_RE.sub('', text)
+
+
+# 基本對話關鍵字（合併成單一正則，一次掃描即可判斷是否命中）
+_GREET_KEYWORDS = ('嗨', 'hi', 'hello', '哈囉', '你好', '您好', '早安', '午安', '晚安')
+# 課程資訊/選課，以及沒有系所或年級的「必修」「選修」都回覆使用說明
+_USAGE_KEYWORDS = ('課程資訊', '選課', '加退選', '加選', '退選', '必修', '選修')
+_GREET_PATTERN = re.compile('|'.join(map(re.escape, _GREET_KEYWORDS)))
+_USAGE_PATTERN = re.compile('|'.join(map(re.escape, _USAGE_KEYWORDS)))
+_CHAT_GRADE_PATTERN = re.compile(r'[一二三四1234]|大[一二三四]|碩[一二三]')
+
+# 基本對話的固定回覆
+_GREET_REPLY = "嗨！想查課程、教室或選課資訊嗎？可以直接輸入「系所 + 時間」或「課程名稱」。"
+_USAGE_REPLY = "可以直接問我「系所/年級/必選修/時間」組合，例如「通訊系禮拜三早上有什麼課」或「資工系大三必修」。想找特定課程也能輸入課名或代碼。"
+_CLASSROOM_REPLY = "教室會寫在課程的上課時間旁，如「每週三2~4 電4F08」。你可以提供課程名稱或時間，我幫你查到對應教室。"
+_COURSE_CODE_REPLY = "你可以輸入課程名稱，我會列出課程代碼；也能直接輸入課程代碼來查時段與教師。"
+
+def _resolve_grade_required(meta_grade: str, meta_required: str, document: str) -> Tuple[str, str]:
+    """
+    取得課程的年級與必選修欄位：metadata 缺少任一欄位時，改用 document 中找得到的欄位值
+    
+    Args:
+        meta_grade: metadata 的 grade 欄位
+        meta_required: metadata 的 required 欄位
+        document: 課程文字
+        
+    Returns:
+        (年級, 必選修)
+    """
+    grade, required = meta_grade, meta_required
+    if not grade or not required:
+        doc_grade, doc_required = extract_document_grade_required(document)
+        if doc_grade is not None:
+            grade = doc_grade
+        if doc_required is not None:
+            required = doc_required
+    return grade, required
+
+
+def _fallback_grade_required(meta_grade: str, meta_required: str, document: str, target_grade: str) -> Optional[str]:
+    """
+    以 grade/required 欄位的位置對應判斷目標年級的必選修（grade_required_mapping 無結果時的備援）
+    
+    Args:
+        meta_grade: metadata 的 grade 欄位
+        meta_required: metadata 的 required 欄位
+        document: 課程文字
+        target_grade: 目標年級
+        
+    Returns:
+        '必'、'選' 等必選修狀態；欄位不足或年級不符時為 None
+    """
+    grade, required = _resolve_grade_required(meta_grade, meta_required, document)
+    if grade and required:
+        return check_grade_required({'grade': grade, 'required': required}, target_grade)
+    return None
+
+
+def _scanned_course(document: str, metadata: Dict) -> Dict:
+    """
+    建立由 collection 全表掃描補入的課程紀錄
+    
+    欄位與 CourseRAGSystem.search 回傳的結果一致，未經檢索因此分數皆為 0。
+    """
+    return {
+        'document': document,
+        'metadata': metadata,
+        'distance': None,
+        'similarity': 0.0,
+        'embedding_score': 0.0,
+        'bm25_score': 0.0,
+        'hybrid_score': 0.0
+    }
+
+
+def _row_has_target_grade(grade_text: str, mapping_json: str, target_grade: str) -> bool:
+    """
+    判斷課程的應修系級是否包含目標年級（補強邏輯的年級條件，不含系所與必選修判斷）
+    
+    比對 grade 欄位的 token 與 grade_required_mapping 的年級組別，任一符合即可；
+    token 切分有快取且多數課程在這一步就能判定，因此先比對 token，再解析 mapping。
+    
+    Args:
+        grade_text: metadata 的 grade 欄位
+        mapping_json: grade_required_mapping 欄位的 JSON 字串
+        target_grade: 目標年級（例如「統計系3」）
+        
+    Returns:
+        是否符合目標年級
+    """
+    if not grade_text:
+        return False
+    
+    for tk in _split_grade_tokens(grade_text):
+        if tk == target_grade:
+            return True
+        elif tk.startswith(target_grade):
+            diff = tk[len(target_grade):].strip()
+            if len(diff) == 0 or \
+               (len(diff) == 1 and diff in _SECTION_LETTERS):
+                return True
+    
+    if mapping_json:
+        for grade_item, _ in safe_load_mapping_status(mapping_json) or ():
+            if grade_item == target_grade:
+                return True
+            elif grade_item.startswith(target_grade):
+                diff = grade_item[len(target_grade):].strip()
+                if len(diff) == 0 or \
+                   (len(diff) == 1 and diff in _SECTION_LETTERS) or \
+                   (len(diff) > 0 and not diff[0].isdigit()):
+                    return True
+    return False
+
+
+def _course_keys(courses: List[Dict]) -> set:
+    """
+    收集課程的去重鍵 (課程代碼, 上課時間)，供全表掃描補強時跳過已有的課程
+    """
+    keys = set()
+    for c in courses:
+        md = c.get('metadata', {})
+        keys.add((md.get('serial', ''), md.get('schedule', '')))
+    return keys
+
+
+def _law_target_num(target_grade: str) -> Optional[str]:
+    """
+    法律系年級的年級數字（供法律系組別 fallback 比對）
+    
+    Returns:
+        年級數字（沒有數字時為空字串）；不是法律系年級時為 None
+    """
+    if '法律' not in target_grade:
+        return None
+    num_match = _DIGITS_RE.search(target_grade)
+    return num_match.group(0) if num_match else ''
+
+
+def _target_grade_status(info: Dict, target_grade: str, law_target_num: Optional[str]) -> Optional[str]:
+    """
+    判斷課程對指定年級的必選修狀態
+    
+    Args:
+        info: _group_courses 產生的課程資訊
+        target_grade: 目標年級
+        law_target_num: _law_target_num(target_grade) 的結果
+        
+    Returns:
+        '必'、'選'；無法判斷時為 None（法律系 fallback 可能回傳 mapping 中的原字樣）
+    """
+    dummy_course = {
+        'grade': info['grade'],
+        'required': info['required'],
+        'grade_required_mapping': info.get('grade_required_mapping', '')
+    }
+    status = check_grade_required_from_json(dummy_course, target_grade)
+    if not status:
+        status = check_grade_required(dummy_course, target_grade)
+    
+    # 特殊處理：法律系 fallback
+    if not status and law_target_num is not None:
+        for g_item, req_status in safe_load_mapping_status(info.get('grade_required_mapping', '{}')) or ():
+            if _LAW_GROUP_RE.search(g_item):
+                if not law_target_num or law_target_num in g_item:
+                    status = req_status
+                    break
+    return status
+
+
+def _is_mixed_required(required: str) -> bool:
+    """必選修欄位是否同時含有「必」與「選」（跨系級課程，例如「必|選」）"""
+    return '必' in required and '選' in required
+
+
+def _course_title_line(info: Dict) -> str:
+    """課程名稱行，附上上課時間與開課系所"""
+    return f"課程名稱：{info['name']}{info['title_suffix']}"
+
+
+def _course_field_lines(info: Dict, include_dept: bool = False, required: Optional[str] = None) -> List[str]:
+    """
+    課程代碼、授課教師、（系所）、必選修、上課時間、年級等欄位行，空欄位略過
+    
+    Args:
+        info: _group_courses 產生的課程資訊
+        include_dept: 是否輸出「系所」欄位
+        required: 「必選修」欄位的顯示值；None 時使用課程原本的必選修欄位
+        
+    Returns:
+        欄位行列表
+    """
+    fields = (
+        ('課程代碼', info['serials_display']),
+        ('授課教師', info['teachers_display']),
+        ('系所', info['dept'] if include_dept else ''),
+        ('必選修', info['required'] if required is None else required),
+        ('上課時間', info['schedule']),
+        ('年級', info['grade']),
+    )
+    return [f"{label}：{value}" for label, value in fields if value]
+
+
+# system prompt 分段：依問題內容只送出相關的規則，減少每次呼叫的輸入 token
+# 核心規則：角色、不可編造、必選修判讀、系所/組別/年級原則
+_PROMPT_CORE_RULES = """你是一個友善的課程查詢助手，專門協助學生查詢國立臺北大學的課程資訊。
+
+⚠️ 重要規則：
+1. 你必須完全根據提供的「相關課程資料」來回答，絕對不能編造、發明或猜測任何課程資訊
+2. 如果提供的資料中沒有某個資訊，就說「資料中未提供」，不要編造
+3. 只能使用「相關課程資料」中實際存在的課程，不能自己創造課程
+
+【課程回答時的指導原則】
+1. 使用繁體中文回答，語氣自然、像跟同學聊天，簡短問候開頭也可以（不要太長）
+2. 仔細閱讀「相關課程資料」中的每一筆課程資訊
+3. 仔細閱讀課程資料中的必選修資訊：
+   - 課程的必選修狀態可能因不同的年級/組別而不同
+   - 如果課程資料中有「年級組別與必選修對應」，這表示不同組別可能有不同的必選修狀態
+   - 例如：「經濟系1A：選修課程，經濟系1B：選修課程」表示對經濟系1A和1B來說是選修
+   - 如果標記為「✅ 對於 XX，這是必修課程」，表示對該組別來說是必修
+   - 如果標記為「📝 對於 XX，這是選修課程」，表示對該組別來說是選修
+   - 如果「必選修」欄位中包含「必」字（如「必選修：必|必」），且沒有特定組別標記，表示這是必修課程
+   - 如果「必選修」欄位中只有「選」字（如「必選修：選|選」），且沒有特定組別標記，表示這是選修課程
+
+4. 當使用者詢問「XX系XX年級的下午xx節的必/選修課程？」時，基本上分成四個面向:「指定系所」、「指定年級」、「指定必選修」、「指定時間」，針對這些面向細部建立原則:
+   - 系所、組別、年級、時間相關原則:
+     1) 應注重「應修系級」去做判定，因為有些課程老師是某系所，但開的課程可能是其他系所或是通識,應修系級指的就是grade欄位，中文字就是系名(可能是簡稱，法律系可能會包含組別)
+     2) 年級的部分，例如:「通訊3」、「不動1A」、「企管2B」、「法律學系財法組4」，其數字所代表的便是年級。
+     3) 分組問題如不動1A、經濟3B、企管4A等等，有強調英文字母者，代表班別「A班、B班、C班」。
+     4) 分組問題如法律財法組2、法律學系法學組3、法律系司法1，本身便以中文組別分類為班(數字同樣代表年級)。
+"""
+
+# 時間規則：時段與節次的判定（問題提到時間時才加入）
+_PROMPT_TIME_RULES = """     5) 使用者詢問時間相關的問題（例如「週二早上」、「下午」），請只列出符合時間條件的課程:
+        * 如果使用者問「下午」的課程，只顯示節次為5-8節的課程。
+        * 如果使用者問「晚上」的課程，只顯示節次為9-12節的課程。
+        * 如果使用者問「早上」的課程，只顯示節次為1-4節的課程。
+        * 例如:如果使用者問「週二早上」的課程，只顯示上課時間包含「週二」且節次為1-4節的課程。
+        * 若問「平日」則代表周一到周五；若問假日則代表周六、周日。
+        * 若問節數，例如2-3節的課，則須找吻合的課程時間，1-3節雖有包含2-3節，但仍舊視作不吻合，僅能恰好顯示符合要求的範圍。
+
+"""
+
+# 課程條件原則、系所簡稱與顯示格式
+_PROMPT_COURSE_RULES = """   - 根據使用者提問課程相關內容，一些重要的原則:
+     1) 特別注意課程資料中是否有針對該年級/組別的必選修標記。
+     2) 例如：如果用戶問「經濟系1A的必修課程」，只顯示標記為「✅ 對於 經濟系1A，這是必修課程」的課程
+     3) 從「相關課程資料」中找出所有符合條件的課程，並列出所有符合條件的課程，不要遺漏。
+     4) 對於每門課程，從「相關課程資料」中提取實際的資訊：課程名稱、課程代碼、教師、上課時間、學分數、年級等
+     5) 如果有多門相同名稱的課程（例如不同教師開的專題製作），請全部列出
+     6) 使用者的輸入可能容易因為簡稱而造成查詢與回答上的錯誤，因此簡易列數個可能問題與概念，助於改善問題:
+        * 學系、系是同樣意思概念，有時候甚至會省略
+        * 法律學系(簡稱法律系、法律)是一個統稱，包含財經法組(或簡稱財法組、財法、財經法)、司法組(或簡稱司法)、法學組(或簡稱法學)
+        * 不動產與城鄉環境學系可能簡稱不動(系)、地政(系)
+        * 金融與合作經營學系，多會簡稱金融(系)
+        * 休閒運動管理學系，多會簡稱休運(系)；企業管理學系，多會簡稱企管(系)
+        * 電機工程學系，多會簡稱電機(系)；通訊工程學系，多會簡稱通訊(系)；資訊工程學系，多會簡稱資工(系)
+        * 公共行政暨政策學系，多會簡稱公行(系)或行政(系)
+        * 社會工作學系，多會簡稱社工(系)
+        * 中國文學系，簡稱中文系；應用外語系，簡稱外語(系)、應外(系)
+        * 師資培育，簡稱師培
+     7) 若提問缺少系所，則代表不分系所顯示；若缺少組別，則不分組別顯示；若缺少年級，則不分年級顯示；若缺少必選修，則不分必選修顯示；若缺少時間，則不分時間顯示。
+     8) 如果課程對不同組別有不同的必選修狀態，可加以說明。
+     9)延續7)，基本上就是有提供的條件一定要在條件內執行，未提供條件限制者，則視作不受限制，該顯示的都要顯示。
+     10)例如:「通訊系星期二早上的課程」，未提及年級代表所有年級都要顯示；未提及必修選修，則必修與選修都要顯示。
+
+5. 課程顯示邏輯與格式（非常重要，必須嚴格遵守）：
+   - 基本格式為:
+       ```
+       課程名稱：科目名稱 / 科目英文名稱
+       課程代碼：UXXXX
+       授課教師：XXX
+       系所：如XX系orXX學系
+       必選修類型：如選修
+       上課時間：如每週五1-2
+       學分數：如3
+       年級：如XX系1
+       ```
+   - 顯示規則（必須執行）：
+        1) 每筆課程都必須單獨顯示，不進行合併。
+        2) 即使課程名稱相同、上課時間相同，也要分開顯示。
+        3) 同一門課有兩個以上的授課老師，則以「|」來區隔，格式如「教師A|教師B|教師C」
+   
+   - 顯示格式：每筆課程必須包含：
+        * 課程名稱、課程代碼（必須是資料中實際的課程代碼）
+        * 授課教師（必須是資料中實際的教師姓名，若有多位教師則以「|」區隔）
+        * 系所、必選修類型（明確標示為「必修」或「選修」，除非資料本身不是標明此兩者）
+        * 上課時間、學分數、年級（必須是資料中實際的資訊）     
+  
+   - 顯示順序：
+        - 先顯示課程名稱不同的課程
+        - 相同課程名稱的，按照上課時間排序
+   
+"""
+
+# 同名課程分開顯示的範例（送出的課程有同名時才加入）
+_PROMPT_SAME_NAME_EXAMPLE = """   - 範例：如果有4個「統計學」課程，都是「每週四2~4」，但教師不同，各自對應的課程代碼是（U1017, U1166, U1011, U1012），則必須分開顯示為4筆：
+       ```
+       課程名稱：統計學 / Statistics
+       課程代碼：U1017
+       授課教師：林定香
+       系所：統計系
+       必選修類型：必修
+       上課時間：每週四2~4
+       學分數：3
+       年級：統計系1
+       
+       課程名稱：統計學 / Statistics
+       課程代碼：U1166
+       授課教師：莊惠菁
+       系所：統計系
+       必選修類型：必修
+       上課時間：每週四2~4
+       學分數：3
+       年級：統計系1
+       ```
+       （以此類推，顯示所有4筆）
+   
+"""
+
+# 查無課程、課程數量與整體回覆格式
+_PROMPT_ANSWER_RULES = """   - 只有在「相關課程資料」中完全沒有任何符合條件的課程時，請回答「查無課程 請重新輸入」。
+  
+   - 可以根據課程限制、選課人數等資訊提供建議。
+   
+   - 重要：計算和顯示課程數量時：
+        * 請按照實際的課程筆數來計算，每筆課程都單獨計算。
+        * 例如：如果有4筆「統計學」課程，加上1筆「電腦概論」課程，總共應該顯示「共找到 5 個符合條件的課程」。
+        * 不要顯示「前 N 個」，而是顯示實際的課程數量
+   
+   - 回覆課程資訊之整體格式：
+        * 先開頭句，含問候。
+        * 依前述格式顯示課程
+        * 課程顯示完後，顯示「共找到 N 個符合條件的課程」。
+        * 有需其他補充資訊或是問候等可以寫在最後面，例如導引使用者查詢課程「如需更多資訊請輸入系所、時間或課程名稱等。
+        
+   - 課堂數量限制:
+        * 課程一次最多顯示15筆。
+        * 如果課程數量超過15筆，則僅顯示15筆，並告知課程未完全顯示，並要求提問者修改提問方式，縮小查詢範圍。
+
+"""
+
+# 校際與學程範圍限制（問題或課程資料提到北醫/北科/學程時才加入）
+_PROMPT_SCOPE_RULES = """   - 課堂範圍限制:
+        * 若系所、應修系級出現北醫大(全名台北醫學大學，或簡稱北醫)、北科大(全名臺北科技大學，或簡稱北科)相關課程，一律不顯示。
+        * 若提問者有提問關於這此兩校，則回應臺北大學以外的學校暫時不在範圍搜尋範圍內。
+        * 若提問者查詢微學程、學士學位學程，也回應暫時不在查詢範圍
+"""
+
+# 重要提醒
+_PROMPT_REMINDERS = """【重要提醒】
+- 當你看到「相關課程資料」中有多筆標記為「✅ 這是必修課程」且系所為「資工系」的課程時，你必須全部列出，不要忽略任何一筆！
+- 絕對不要編造課程資訊！只能使用「相關課程資料」中實際存在的資訊！
+- **極其重要**：你必須列出「相關課程資料」中**所有**符合條件的課程，絕對不能遺漏任何一筆！如果資料中有 4 筆課程，你必須顯示 4 筆；如果有 5 筆，你必須顯示 5 筆。不要因為任何原因（如格式、長度等）而省略任何課程！"""
+
+_PROMPT_TIME_QUESTION_RE = re.compile(r'早上|上午|中午|下午|晚上|夜間|週|周|星期|禮拜|節|平日|假日')
+_PROMPT_SCOPE_RE = re.compile(r'北醫|北科|醫學大學|科技大學|學程')
+
+
+def _build_system_prompt(user_question: str, courses: List[Dict]) -> str:
+    """
+    依問題與要送出的課程組出 system prompt（核心規則固定包含，其餘依需要加入）
+    
+    Args:
+        user_question: 使用者問題
+        courses: 要送進 prompt 的課程
+        
+    Returns:
+        system prompt 文字
+    """
+    names = [(c.get('metadata', {}) or {}).get('name', '') for c in courses]
+    has_same_name = len(set(names)) < len(names)
+    scope_text = user_question + ''.join(
+        (c.get('metadata', {}) or {}).get('grade', '') + (c.get('metadata', {}) or {}).get('dept', '')
+        for c in courses
+    )
+    blocks = [_PROMPT_CORE_RULES]
+    if _PROMPT_TIME_QUESTION_RE.search(user_question):
+        blocks.append(_PROMPT_TIME_RULES)
+    blocks.append(_PROMPT_COURSE_RULES)
+    if has_same_name:
+        blocks.append(_PROMPT_SAME_NAME_EXAMPLE)
+    blocks.append(_PROMPT_ANSWER_RULES)
+    if _PROMPT_SCOPE_RE.search(scope_text):
+        blocks.append(_PROMPT_SCOPE_RULES)
+    blocks.append(_PROMPT_REMINDERS)
+    return ''.join(blocks)
+
+
+# 系所名稱的前綴（如「(進修)」）與後綴（如「系」、「碩」、「學程」）
+_DEPT_PREFIX_RE = re.compile(r'^\([^)]+\)')
+_DEPT_SUFFIX_RE = re.compile(r'(系|碩|博|碩職|碩士班|學位學程|產碩專班|中心|學院|學程)$')
+# 標準系所格式（XX系、XX碩）：只用來判斷是否出現，等同「系」或「碩」前面緊接非空白字元，
+# 不必用 \S+ 在每個起點往後吃再回溯
+_DEPT_FORMAT_RE = re.compile(r'\S[系碩]')
+
+
+@lru_cache(maxsize=4)
+def _load_dept_keywords_cached(db_path: str, db_mtime: Optional[float]) -> frozenset:
+    """
+    讀取資料庫中的系所名稱並擷取簡稱關鍵字（以資料庫路徑與修改時間為快取鍵）
+    
+    讀取失敗時直接拋出例外（例外不會被快取），由呼叫端改用預設列表。
+    
+    Args:
+        db_path: SQLite 資料庫路徑
+        db_mtime: 資料庫檔案修改時間，檔案變動後自動重新讀取
+        
+    Returns:
+        系所簡稱關鍵字集合
+    """
+    dept_keywords = set()
+    
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        
+        # 獲取所有系所
+        cur.execute('SELECT DISTINCT name FROM departments WHERE name IS NOT NULL AND name != "" ORDER BY name')
+        all_depts = [row[0] for row in cur.fetchall()]
+        
+        # 如果沒有 departments 表，嘗試從 courses 表獲取
+        if not all_depts:
+            cur.execute('SELECT DISTINCT dept FROM courses WHERE dept IS NOT NULL AND dept != "" ORDER BY dept')
+            all_depts = [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+    
+    # 提取系所簡稱
+    for dept in all_depts:
+        # 移除前綴與後綴
+        base = _DEPT_SUFFIX_RE.sub('', _DEPT_PREFIX_RE.sub('', dept))
+        
+        # 如果 base 太長（超過4個字），取前2-3個字作為簡稱
+        if len(base) > 4:
+            dept_keywords.add(base[:2])
+            dept_keywords.add(base[:3])
+        else:
+            dept_keywords.add(base)
+        
+        # 也加入完整名稱（去除前綴和後綴）
+        if len(base) <= 6:
+            dept_keywords.add(base)
+    
+    # 過濾掉太短或無意義的關鍵字
+    return frozenset(kw for kw in dept_keywords if len(kw) >= 2 and not kw.isdigit())
+
+
+def _primary_search_query(user_question: str, target_grade: Optional[str], target_dept: Optional[str],
+                          has_required_kw: bool, has_elective_kw: bool) -> str:
+    """
+    組出 RAG 主要檢索查詢：有系所時使用系所 + 年級 + 必選修關鍵詞組合，否則使用原始問題
+    
+    Args:
+        user_question: 使用者問題
+        target_grade: 目標年級
+        target_dept: 目標系所
+        has_required_kw: 問題是否包含「必修」
+        has_elective_kw: 問題是否包含「選修」
+        
+    Returns:
+        檢索查詢字串
+    """
+    # 如果有特定 grade，使用包含 grade 和必選修的關鍵詞組合
+    # 如果沒有 grade，使用包含必選修的關鍵詞
+    if target_dept:
+        # 特殊處理：法律系搜尋擴展，確保能搜尋到各組別（法學、司法、財法）
+        search_dept_term = target_dept
+        if '法律' in target_dept:
+            search_dept_term = f"{target_dept} 法學組 司法組 財經法學組"
+        
+        if target_grade:
+            # 有 grade：使用系所 + grade + 必選修關鍵詞（提高召回率）
+            if has_required_kw:
+                return f"{search_dept_term} {target_grade} 必修"
+            elif has_elective_kw:
+                return f"{search_dept_term} {target_grade} 選修"
+            else:
+                # 沒有必選修關鍵詞，使用系所 + grade
+                return f"{search_dept_term} {target_grade}"
+        else:
+            # 沒有 grade：使用系所 + 必選修關鍵詞
+            if has_required_kw:
+                return f"{search_dept_term} 必修"
+            elif has_elective_kw:
+                return f"{search_dept_term} 選修"
+            else:
+                return search_dept_term
+    else:
+        return user_question
+
+
 class CourseQuerySystem:
     def __init__(self, rag_system: CourseRAGSystem):
         """
@@ -33,65 +876,54 @@ class CourseQuerySystem:
         """
         self.rag_system = rag_system
         
-        # 初始化 OpenAI client
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
+        # OpenAI client 延遲到第一次呼叫 LLM 時才建立（基本對話與快取命中不需要）
+        self._openai_api_key = os.getenv("OPENAI_API_KEY")
+        if not self._openai_api_key:
             raise ValueError("請設定 OPENAI_API_KEY 環境變數")
-        self.openai_client = OpenAI(api_key=api_key)
+        self._openai_client: Optional[OpenAI] = None
     
         # 從資料庫載入所有系所簡稱
         self.dept_keywords = self._load_dept_keywords()
+        # 較長的簡稱排在前面，同一位置有多個簡稱符合時取最長者
+        self._dept_keyword_re = _keyword_pattern(tuple(sorted(self.dept_keywords, key=lambda kw: (-len(kw), kw))))
+        # 基本對話用：系所格式、系所簡稱或年級任一出現即視為實際課程查詢
+        self._chat_query_re = re.compile('|'.join((
+            _DEPT_FORMAT_RE.pattern, self._dept_keyword_re.pattern, _CHAT_GRADE_PATTERN.pattern
+        )))
+        
+        # collection 全表快照與時間條件/年級索引（延遲建立；collection 筆數或資料版本變動、或超過有效秒數時重建）
+        # 全表快照只保留 id 與 metadata；document 只在課程被採用時才依 id 補讀並快取
+        self._course_ids: List[str] = []
+        self._course_metas: List[Dict] = []
+        self._course_docs: Dict[int, str] = {}
+        # 各課程的去重鍵 (課程代碼, 上課時間)，建立快照時算好，補強時直接查表
+        self._course_row_keys: List[Tuple[str, str]] = []
+        self._course_metas_token: Optional[Tuple[int, Optional[str]]] = None
+        self._course_metas_at = 0.0
+        self._schedule_groups: Dict[str, List[int]] = {}
+        self._time_index: Dict[Tuple[Optional[str], Optional[str]], List[int]] = {}
+        self._grade_index: Dict[Tuple[str, Optional[str]], List[int]] = {}
+        
+        # 回答快取：(正規化問題, n_results) → (寫入時間, 回答)；collection 筆數或資料版本變動時清空
+        self._answer_cache: "OrderedDict[Tuple[str, int], Tuple[float, str]]" = OrderedDict()
+        self._answer_cache_token: Optional[Tuple[int, Optional[str]]] = None
+        # Line bot 以多執行緒處理請求並共用同一個實例：回答快取與快照的讀寫、重建都在此鎖內進行
+        self._cache_lock = threading.RLock()
     
     def _load_dept_keywords(self) -> set:
         """
-        從資料庫載入所有系所簡稱關鍵字
+        從資料庫載入所有系所簡稱關鍵字（同一資料庫檔案未變動時重用模組層級快取）
         
         Returns:
             系所簡稱關鍵字集合
         """
-        import sqlite3
-        dept_keywords = set()
-        
         try:
             db_path = self.rag_system.db_path
-            conn = sqlite3.connect(db_path)
-            cur = conn.cursor()
-            
-            # 獲取所有系所
-            cur.execute('SELECT DISTINCT name FROM departments WHERE name IS NOT NULL AND name != "" ORDER BY name')
-            all_depts = [row[0] for row in cur.fetchall()]
-            
-            # 如果沒有 departments 表，嘗試從 courses 表獲取
-            if not all_depts:
-                cur.execute('SELECT DISTINCT dept FROM courses WHERE dept IS NOT NULL AND dept != "" ORDER BY dept')
-                all_depts = [row[0] for row in cur.fetchall()]
-            
-            # 提取系所簡稱
-            for dept in all_depts:
-                # 移除前綴（如「(進修)」）
-                clean_dept = re.sub(r'^\([^)]+\)', '', dept)
-                
-                # 移除後綴（如「系」、「碩」、「博」、「碩職」等）
-                base = re.sub(r'(系|碩|博|碩職|碩士班|學位學程|產碩專班|中心|學院|學程)$', '', clean_dept)
-                
-                # 如果 base 太長（超過4個字），取前2-3個字作為簡稱
-                if len(base) > 4:
-                    # 嘗試提取關鍵字（通常是前2-3個字）
-                    if len(base) >= 2:
-                        dept_keywords.add(base[:2])
-                    if len(base) >= 3:
-                        dept_keywords.add(base[:3])
-                else:
-                    dept_keywords.add(base)
-                
-                # 也加入完整名稱（去除前綴和後綴）
-                if len(base) <= 6:
-                    dept_keywords.add(base)
-            
-            # 過濾掉太短或無意義的關鍵字
-            dept_keywords = {kw for kw in dept_keywords if len(kw) >= 2 and not kw.isdigit()}
-            
-            conn.close()
+            try:
+                db_mtime = os.path.getmtime(db_path)
+            except OSError:
+                db_mtime = None
+            dept_keywords = set(_load_dept_keywords_cached(db_path, db_mtime))
         except Exception as e:
             # 如果載入失敗，使用預設的常見系所簡稱
             print(f"⚠️ 載入系所關鍵字失敗: {e}，使用預設列表")
@@ -101,32 +933,357 @@ class CourseQuerySystem:
                 '師培', '體育', '通識', 'AI聯盟', '北科大', '北醫大'
             }
         
-        return dept_keywords
+        return dept_keywords
+    
+    def _has_dept_keyword(self, text: str) -> bool:
+        """
+        檢查文本中是否包含系所關鍵字
+        
+        Args:
+            text: 要檢查的文本
+            
+        Returns:
+            是否包含系所關鍵字
+        """
+        # 先檢查標準格式（XX系、XX碩）
+        if _DEPT_FORMAT_RE.search(text):
+            return True
+        
+        # 檢查是否包含任何系所簡稱（預先編譯的單一正則）
+        return self._dept_keyword_re.search(text) is not None
+    
+    @property
+    def openai_client(self) -> OpenAI:
+        """OpenAI client（第一次使用時建立）"""
+        if self._openai_client is None:
+            self._openai_client = OpenAI(api_key=self._openai_api_key)
+        return self._openai_client
+    
+    def _basic_chat_response(self, question: str) -> Optional[str]:
+        """
+        基本問候/常見問題的固定回覆
+        
+        Args:
+            question: 使用者問題
+            
+        Returns:
+            固定回覆；若為實際課程查詢則回傳 None
+        """
+        text = question.strip()
+        # 問候
+        if _GREET_PATTERN.search(text):
+            return _GREET_REPLY
+        
+        # 檢查是否為實際的課程查詢（包含系所名稱或年級）
+        # 如果包含系所或年級關鍵詞，則視為實際查詢，不返回提示（單一正則一次判斷）
+        if self._chat_query_re.search(text):
+            return None
+        
+        # 課程資訊/選課，或只有「必修」「選修」但沒有系所或年級（一般性問題）
+        if _USAGE_PATTERN.search(text):
+            return _USAGE_REPLY
+        
+        # 教室地點
+        if '教室' in text:
+            return _CLASSROOM_REPLY
+        # 校園基本對話
+        if '課程代碼' in text or '課號' in text:
+            return _COURSE_CODE_REPLY
+        return None
+    
+    def _data_token(self) -> Tuple[int, Optional[str]]:
+        """
+        目前課程資料的識別：(collection 筆數, 資料版本)
+        
+        資料版本由 CourseRAGSystem 建立或更新向量資料庫時寫入，筆數不變但內容變動時也會改變。
+        
+        Returns:
+            (筆數, 資料版本)
+        """
+        return (self.rag_system.collection.count(), self.rag_system.data_version())
+    
+    def _get_course_metas(self, batch_size: int = 500) -> List[Dict]:
+        """
+        取得 collection 中所有課程的 metadata 快照
+        
+        第一次呼叫時分批讀取整個 collection（只取 metadata，不取 document），之後直接重用；
+        若 collection 筆數或資料版本改變、或快照超過 _ANSWER_CACHE_TTL 秒，則重新讀取並清空時間/年級索引與 document 快取。
+        
+        Args:
+            batch_size: 每批讀取的筆數
+            
+        Returns:
+            依 collection 順序排列的 metadata 列表
+        """
+        with self._cache_lock:
+            token = self._data_token()
+            if token != self._course_metas_token or time.monotonic() - self._course_metas_at >= _ANSWER_CACHE_TTL:
+                total = token[0]
+                ids = []
+                metas = []
+                collection = self.rag_system.collection
+            
+                def fetch_batch(offset: int) -> Dict:
+                    return collection.get(
+                        include=['metadatas'],
+                        limit=batch_size,
+                        offset=offset
+                    )
+            
+                # 各批讀取互不相依，交給執行緒池同時讀取；map 依 offset 順序回傳，快照順序不變
+                with ThreadPoolExecutor(max_workers=_SNAPSHOT_FETCH_WORKERS) as executor:
+                    batches = list(executor.map(fetch_batch, range(0, total, batch_size)))
+                for all_results in batches:
+                    batch_ids = all_results.get('ids', []) or []
+                    batch_metas = all_results.get('metadatas', []) or []
+                    ids.extend(batch_ids[:len(batch_metas)])
+                    metas.extend(batch_metas[:len(batch_ids)])
+                # 年級、必選修、系所、上課時間在各課程間大量重複，intern 後共用同一物件，
+                # 比對與快取查詢時可直接以指標判斷相等
+                for md in metas:
+                    for field in _AUGMENT_META_FIELDS:
+                        if md.get(field) is None:
+                            md[field] = ''
+                    for field in _INTERNED_META_FIELDS:
+                        value = md.get(field)
+                        if isinstance(value, str):
+                            md[field] = sys.intern(value)
+                # 相同上課時間字串的課程歸為一組，時間條件只需對每個不同的字串判斷一次
+                schedule_groups: Dict[str, List[int]] = {}
+                for i, md in enumerate(metas):
+                    schedule = md.get('schedule', '')
+                    if schedule:
+                        schedule_groups.setdefault(schedule, []).append(i)
+                self._course_ids = ids
+                self._course_metas = metas
+                self._course_docs = {}
+                self._course_row_keys = [(md.get('serial', ''), md.get('schedule', '')) for md in metas]
+                self._course_metas_token = token
+                self._course_metas_at = time.monotonic()
+                self._schedule_groups = schedule_groups
+                self._time_index = {}
+                self._grade_index = {}
+            return self._course_metas
+    
+    def _get_scanned_courses(self, indices: List[int]) -> List[Dict]:
+        """
+        依快照索引建立全表掃描補入的課程紀錄，缺少的 document 一次依 id 補讀
+        
+        Args:
+            indices: 快照索引列表
+            
+        Returns:
+            與 indices 同順序的課程紀錄列表
+        """
+        metas = self._get_course_metas()
+        missing = [i for i in indices if i not in self._course_docs]
+        if missing:
+            results = self.rag_system.collection.get(
+                ids=[self._course_ids[i] for i in missing],
+                include=['documents']
+            )
+            docs_by_id = dict(zip(results.get('ids', []) or [], results.get('documents', []) or []))
+            for i in missing:
+                self._course_docs[i] = docs_by_id.get(self._course_ids[i]) or ''
+        return [_scanned_course(self._course_docs[i], metas[i]) for i in indices]
+    
+    def _get_time_matched_indices(self, time_condition: Dict[str, Optional[str]]) -> List[int]:
+        """
+        取得上課時間符合時間條件的課程在快照中的索引（依時間條件快取）
+        
+        Args:
+            time_condition: 時間條件字典，例如 {'day': '週二', 'period': '早上'}
+            
+        Returns:
+            遞增排列的快照索引列表
+        """
+        self._get_course_metas()
+        key = (time_condition.get('day'), time_condition.get('period'))
+        indices = self._time_index.get(key)
+        if indices is None:
+            indices = sorted(
+                i
+                for schedule, group in self._schedule_groups.items()
+                if _schedule_matches_time(schedule, *key)
+                for i in group
+            )
+            self._time_index[key] = indices
+        return indices
+    
+    def _get_grade_matched_indices(self, target_grade: str, target_dept: Optional[str] = None) -> List[int]:
+        """
+        取得應修系級符合目標年級（與目標系所）的課程在快照中的索引（依條件快取）
+        
+        只屬於學位學程或微學程的課程一律排除。符合年級的課程，其 document 的
+        「年級：」或年級組別對應行必定含有目標年級字串，因此先以 where_document
+        交由 collection 篩出候選，只對候選課程逐筆判斷。
+        
+        Args:
+            target_grade: 目標年級（例如「統計系3」）
+            target_dept: 目標系所；None 表示不限系所
+            
+        Returns:
+            遞增排列的快照索引列表
+        """
+        course_metas = self._get_course_metas()
+        key = (target_grade, target_dept)
+        indices = self._grade_index.get(key)
+        if indices is None:
+            try:
+                results = self.rag_system.collection.get(
+                    where_document={'$contains': target_grade},
+                    include=[]
+                )
+                candidate_ids = set(results.get('ids', []) or [])
+                candidates = [i for i, course_id in enumerate(self._course_ids) if course_id in candidate_ids]
+            except Exception:
+                candidates = range(len(course_metas))
+            indices = []
+            for i in candidates:
+                md = course_metas[i]
+                grade_text = md.get('grade', '')
+                dept_text = md.get('dept', '')
+                # 排除學位學程與微學程
+                if '學位學程' in grade_text or '微學程' in grade_text or \
+                   '學位學程' in dept_text or '微學程' in dept_text:
+                    continue
+                if target_dept and not _grade_has_target_dept(grade_text, target_dept):
+                    continue
+                if _row_has_target_grade(grade_text, md.get('grade_required_mapping', ''), target_grade):
+                    indices.append(i)
+            self._grade_index[key] = indices
+        return indices
+    
+    def _cache_key(self, user_question: str, n_results: int) -> Tuple[str, int]:
+        """
+        取得回答快取的鍵；課程資料筆數或資料版本變動時先清空舊快取
+        
+        Args:
+            user_question: 使用者問題
+            n_results: RAG 檢索結果數量
+            
+        Returns:
+            (正規化後的問題, n_results)
+        """
+        try:
+            token = self._data_token()
+        except Exception:
+            token = (-1, None)
+        with self._cache_lock:
+            if token != self._answer_cache_token:
+                # 課程資料變動，舊的回答不再可信
+                self._answer_cache.clear()
+                self._answer_cache_token = token
+        return (_normalize_question(user_question), n_results)
+    
+    def _get_cached_answer(self, key: Tuple[str, int]) -> Optional[str]:
+        """
+        取出未過期的快取回答，過期則順便移除
+        """
+        with self._cache_lock:
+            cached = self._answer_cache.get(key)
+            if cached is None:
+                return None
+            cached_at, cached_answer = cached
+            if time.monotonic() - cached_at < _ANSWER_CACHE_TTL:
+                self._answer_cache.move_to_end(key)
+                return cached_answer
+            self._answer_cache.pop(key, None)
+            return None
+    
+    def _store_answer(self, key: Tuple[str, int], answer: str):
+        """
+        將回答寫入快取（錯誤訊息不快取，下次仍重新查詢）
+        """
+        if isinstance(answer, str) and not answer.startswith("❌"):
+            with self._cache_lock:
+                self._answer_cache[key] = (time.monotonic(), answer)
+                if len(self._answer_cache) > _ANSWER_CACHE_SIZE:
+                    self._answer_cache.popitem(last=False)
+    
+    def query(self, user_question: str, n_results: int = 10) -> str:
+        """
+        處理使用者查詢，結合 RAG 與 LLM 生成回答（相同問題直接回傳快取的回答）
+        
+        Args:
+            user_question: 使用者問題
+            n_results: RAG 檢索結果數量
+            
+        Returns:
+            LLM 生成的回答
+        """
+        key = self._cache_key(user_question, n_results)
+        cached_answer = self._get_cached_answer(key)
+        if cached_answer is not None:
+            return cached_answer
+        
+        answer = self._answer_question(user_question, n_results)
+        self._store_answer(key, answer)
+        return answer
     
-    def _has_dept_keyword(self, text: str) -> bool:
+    def query_stream(self, user_question: str, n_results: int = 10) -> Iterator[str]:
         """
-        檢查文本中是否包含系所關鍵字
+        串流版本的 query：LLM 產生的片段一到就 yield，不必等整段回答完成
+        
+        快取命中或不需呼叫 LLM（問候、查無課程、deterministic 列表）時，
+        直接一次 yield 完整回答；串流結束後將完整回答寫入快取。
         
         Args:
-            text: 要檢查的文本
+            user_question: 使用者問題
+            n_results: RAG 檢索結果數量
             
-        Returns:
-            是否包含系所關鍵字
+        Yields:
+            回答文字片段
         """
-        # 先檢查標準格式（XX系、XX碩）
-        if re.search(r'\S+系|\S+碩', text):
-            return True
+        key = self._cache_key(user_question, n_results)
+        cached_answer = self._get_cached_answer(key)
+        if cached_answer is not None:
+            yield cached_answer
+            return
         
-        # 檢查是否包含任何系所簡稱
-        for keyword in self.dept_keywords:
-            if keyword in text:
-                return True
+        prepared = self._prepare_answer(user_question, n_results)
+        if isinstance(prepared, str):
+            self._store_answer(key, prepared)
+            yield prepared
+            return
         
-        return False
+        parts = []
+        try:
+            stream = self.openai_client.chat.completions.create(stream=True, **prepared)
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                piece = chunk.choices[0].delta.content or ''
+                if piece:
+                    parts.append(piece)
+                    yield piece
+        except Exception as e:
+            yield f"❌ 查詢時發生錯誤：{str(e)}"
+            return
+        # 串流沒有產生任何內容時不快取，避免之後相同問題一直回傳空字串
+        if parts:
+            self._store_answer(key, ''.join(parts))
     
-    def query(self, user_question: str, n_results: int = 10) -> str:
+    def invalidate_cache(self):
+        """
+        清空回答快取與 collection 快照（重建向量資料庫或更新課程資料後呼叫）
         """
-        處理使用者查詢，結合 RAG 與 LLM 生成回答
+        with self._cache_lock:
+            self._answer_cache.clear()
+            self._answer_cache_token = None
+            self._course_ids = []
+            self._course_metas = []
+            self._course_docs = {}
+            self._course_row_keys = []
+            self._course_metas_token = None
+            self._course_metas_at = 0.0
+            self._schedule_groups = {}
+            self._time_index = {}
+            self._grade_index = {}
+    
+    def _answer_question(self, user_question: str, n_results: int = 10) -> str:
+        """
+        實際處理使用者查詢：RAG 檢索、條件過濾，再交由 LLM 或 deterministic 格式產生回答
         
         Args:
             user_question: 使用者問題
@@ -135,100 +1292,34 @@ class CourseQuerySystem:
         Returns:
             LLM 生成的回答
         """
-        # 1. 使用 RAG 檢索相關課程
-        # 優化搜尋策略：使用更精確的關鍵詞組合
-        import re
+        prepared = self._prepare_answer(user_question, n_results)
+        if isinstance(prepared, str):
+            return prepared
         
-        # 基本問候/常見問題快速回應，避免進入重運算
-        def basic_chat_response(q: str) -> Optional[str]:
-            text = q.strip()
-            low = text.lower()
-            # 問候
-            greet_kw = ['嗨', 'hi', 'hello', '哈囉', '你好', '您好', '早安', '午安', '晚安']
-            if any(k in text for k in greet_kw):
-                return "嗨！想查課程、教室或選課資訊嗎？可以直接輸入「系所 + 時間」或「課程名稱」。"
-            
-            # 檢查是否為實際的課程查詢（包含系所名稱或年級）
-            # 如果包含系所或年級關鍵詞，則視為實際查詢，不返回提示
-            has_dept = self._has_dept_keyword(text)
-            has_grade = bool(re.search(r'[一二三四1234]|大[一二三四]|碩[一二三]', text))
-            
-            # 課程資訊/選課（僅當沒有系所或年級時才返回提示）
-            course_kw = ['課程資訊', '選課', '加退選', '加選', '退選']
-            if any(k in text for k in course_kw) and not (has_dept or has_grade):
-                return "可以直接問我「系所/年級/必選修/時間」組合，例如「通訊系禮拜三早上有什麼課」或「資工系大三必修」。想找特定課程也能輸入課名或代碼。"
-            
-            # 如果只有「必修」或「選修」但沒有系所或年級，可能是詢問一般性問題
-            if ('必修' in text or '選修' in text) and not (has_dept or has_grade):
-                return "可以直接問我「系所/年級/必選修/時間」組合，例如「通訊系禮拜三早上有什麼課」或「資工系大三必修」。想找特定課程也能輸入課名或代碼。"
-            
-            # 教室地點
-            if '教室' in text and not (has_dept or has_grade):
-                return "教室會寫在課程的上課時間旁，如「每週三2~4 電4F08」。你可以提供課程名稱或時間，我幫你查到對應教室。"
-            # 校園基本對話
-            if ('課程代碼' in text or '課號' in text) and not (has_dept or has_grade):
-                return "你可以輸入課程名稱，我會列出課程代碼；也能直接輸入課程代碼來查時段與教師。"
-            return None
+        # 4. 呼叫 LLM 生成回答
+        try:
+            response = self.openai_client.chat.completions.create(**prepared)
+            answer = response.choices[0].message.content
+            return answer
         
-        chat_reply = basic_chat_response(user_question)
-        if chat_reply:
-            return chat_reply
+        except Exception as e:
+            return f"❌ 查詢時發生錯誤：{str(e)}"
+    
+    def _parse_query_targets(self, user_question: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        從問題中提取目標年級與系所
         
-        # 提取系所和年級資訊
+        Args:
+            user_question: 使用者問題
+            
+        Returns:
+            (target_grade, target_dept)，沒有時為 None
+        """
         # 先提取年級（可能會包含系所資訊）
         target_grade = extract_grade_from_query(user_question)
         
-        # 從年級中提取系所（如果有的話）
-        if target_grade:
-            # 例如：「統計系1」→「統計系」
-            dept_match = re.search(r'(\S+系)', target_grade)
-            if dept_match:
-                target_dept = dept_match.group(1)
-            else:
-                # 嘗試匹配「XX碩」格式
-                dept_match = re.search(r'(\S+碩)', target_grade)
-                if dept_match:
-                    target_dept = dept_match.group(1)
-                else:
-                    target_dept = None
-        else:
-            target_dept = None
-        
-        # 如果沒有從年級中提取到系所，嘗試直接從查詢中提取
-        if not target_dept:
-            # 先移除常見的問句詞彙和時間詞彙，然後再匹配系所
-            # 移除問句詞彙：有什麼、哪些、什麼、查詢、找、幫我、請等
-            cleaned_query = user_question
-            question_words = ['有什麼', '哪些', '什麼', '查詢', '找', '幫我', '請', '的', '課程', '課']
-            for qw in question_words:
-                cleaned_query = cleaned_query.replace(qw, ' ')
-            
-            # 移除時間相關詞彙
-            time_words = ['週一', '週二', '週三', '週四', '週五', '週六', '週日', 
-                         '周一', '周二', '周三', '周四', '周五', '周六', '周日',
-                         '星期一', '星期二', '星期三', '星期四', '星期五', '星期六', '星期日',
-                         '禮拜一', '禮拜二', '禮拜三', '禮拜四', '禮拜五', '禮拜六', '禮拜日',
-                         '早上', '上午', '下午', '晚上', '夜間', 'AM', 'PM']
-            for tw in time_words:
-                cleaned_query = cleaned_query.replace(tw, ' ')
-            
-            # 現在匹配系所（只匹配簡短的系所名稱，通常是1-4個字）
-            dept_pattern_match = re.search(r'([^\s]{1,4}系)', cleaned_query)
-            if dept_pattern_match:
-                target_dept = dept_pattern_match.group(1).strip()
-                # 再次檢查，確保不是時間相關的詞彙或問句詞彙
-                if any(kw in target_dept for kw in ['週', '周', '星期', '禮拜', '早上', '下午', '晚上', '夜間', '有什麼', '哪些', '什麼']):
-                    target_dept = None
-            else:
-                # 嘗試匹配「XX碩」格式（例如「資工碩一」）
-                dept_pattern_match = re.search(r'([^\s]{1,4}碩)', cleaned_query)
-                if dept_pattern_match:
-                    target_dept = dept_pattern_match.group(1).strip()
-                    # 再次檢查，確保不是時間相關的詞彙或問句詞彙
-                    if any(kw in target_dept for kw in ['週', '周', '星期', '禮拜', '早上', '下午', '晚上', '夜間', '有什麼', '哪些', '什麼']):
-                        target_dept = None
-                else:
-                    target_dept = None
+        # 從年級中提取系所（如果有的話），否則直接從查詢中提取
+        target_dept = (_dept_from_grade(target_grade) if target_grade else None) or _dept_from_question(user_question)
         
         # 特殊處理：如果查詢中包含「通識」，直接設置為「通識」
         if not target_dept and '通識' in user_question:
@@ -236,139 +1327,98 @@ class CourseQuerySystem:
         
         # 如果仍未取得系所，嘗試使用動態載入的系所關鍵詞（省略「系」的口語）
         if not target_dept:
-            # 使用從資料庫載入的系所關鍵字
-            for kw in self.dept_keywords:
-                # 檢查關鍵字是否在查詢中
-                if kw in user_question:
-                    # 如果關鍵字不包含「系」，加上「系」
-                    if '系' not in kw and '碩' not in kw:
-                        target_dept = f"{kw}系"
-                    else:
-                        target_dept = kw
-                    break
+            # 使用從資料庫載入的系所關鍵字（單一正則掃描一次查詢，取最先出現的簡稱）
+            kw_match = self._dept_keyword_re.search(user_question)
+            if kw_match:
+                kw = kw_match.group(0)
+                # 如果關鍵字不包含「系」，加上「系」
+                if '系' not in kw and '碩' not in kw:
+                    target_dept = f"{kw}系"
+                else:
+                    target_dept = kw
         
-        # 構建搜尋查詢（使用多個關鍵詞組合提高召回率）
-        search_queries = []
         
-        if target_dept:
-            # 基礎查詢：系所名稱（處理「系」和「碩」的差異）
-            # 如果 target_dept 是「資工碩」，也搜尋「資工系碩」和「資工碩」
-            search_queries.append(target_dept)
-            if '碩' in target_dept and '系' not in target_dept:
-                # 如果是「資工碩」，也搜尋「資工系碩」
-                dept_with_xi = target_dept.replace('碩', '系碩')
-                search_queries.append(dept_with_xi)
-            
-            # 如果有年級資訊，加入相關關鍵詞
-            if target_grade:
-                # 使用完整的 grade（例如「經濟系1A」或「資工碩1」）
-                search_queries.append(f"{target_dept} {target_grade}")
-                
-                # 如果 grade 中有數字，也使用數字
-                grade_num_match = re.search(r'(\d+)', target_grade)
-                if grade_num_match:
-                    search_queries.append(f"{target_dept} {grade_num_match.group(1)}")
-            
-            # 如果有必選修關鍵詞，加入
-            if '必修' in user_question:
-                search_queries.append(f"{target_dept} 必修")
-                if target_grade:
-                    search_queries.append(f"{target_dept} {target_grade} 必修")
-            elif '選修' in user_question:
-                search_queries.append(f"{target_dept} 選修")
-                if target_grade:
-                    search_queries.append(f"{target_dept} {target_grade} 選修")
-        else:
-            # 沒有系所資訊，使用原始查詢
-            search_queries.append(user_question)
-
         # 額外啟發式：如果使用者問「體育課」且尚未解析到系所，預設系所包含「體育」
         if not target_dept and ('體育課' in user_question or '體育' in user_question):
             target_dept = '體育'
+        return target_grade, target_dept
+    
+    def prefetch_search_embeddings(self, user_questions: List[str]):
+        """
+        預先以單次請求向量化多個問題會用到的檢索查詢（例如批次測試），
+        之後逐一呼叫 query 時直接使用快取的查詢向量
         
-        # 選擇最佳搜尋策略
-        # 如果有特定 grade，使用包含 grade 和必選修的關鍵詞組合
-        # 如果沒有 grade，使用包含必選修的關鍵詞
-        # 對於碩士班，也搜尋「專題研討」或「Seminar」相關課程
-        if target_dept:
-            # 特殊處理：法律系搜尋擴展，確保能搜尋到各組別（法學、司法、財法）
-            search_dept_term = target_dept
-            if '法律' in target_dept:
-                search_dept_term = f"{target_dept} 法學組 司法組 財經法學組"
+        Args:
+            user_questions: 使用者問題列表
+        """
+        search_queries = []
+        for user_question in user_questions:
+            if self._basic_chat_response(user_question):
+                continue
+            has_required_kw = '必修' in user_question
+            has_elective_kw = '選修' in user_question
+            target_grade, target_dept = self._parse_query_targets(user_question)
+            search_queries.append(
+                _primary_search_query(user_question, target_grade, target_dept, has_required_kw, has_elective_kw)
+            )
+            if target_grade and '碩' in target_grade and has_required_kw:
+                search_queries.append(_MASTER_SEMINAR_QUERY)
+        if search_queries:
+            self.rag_system.prefetch_query_embeddings(list(dict.fromkeys(search_queries)))
+    
+    def _prepare_answer(self, user_question: str, n_results: int = 10) -> Union[str, Dict[str, Any]]:
+        """
+        RAG 檢索、條件過濾並組出 prompt
+        
+        Args:
+            user_question: 使用者問題
+            n_results: RAG 檢索結果數量
             
-            if target_grade:
-                # 有 grade：使用系所 + grade + 必選修關鍵詞（提高召回率）
-                if '必修' in user_question:
-                    primary_search_query = f"{search_dept_term} {target_grade} 必修"
-                elif '選修' in user_question:
-                    primary_search_query = f"{search_dept_term} {target_grade} 選修"
-                else:
-                    # 沒有必選修關鍵詞，使用系所 + grade
-                    primary_search_query = f"{search_dept_term} {target_grade}"
-            else:
-                # 沒有 grade：使用系所 + 必選修關鍵詞
-                if '必修' in user_question:
-                    primary_search_query = f"{search_dept_term} 必修"
-                elif '選修' in user_question:
-                    primary_search_query = f"{search_dept_term} 選修"
-                else:
-                    primary_search_query = search_dept_term
-        else:
-            primary_search_query = user_question
+        Returns:
+            不需呼叫 LLM 時為最終回答字串，否則為 chat.completions.create 的參數
+        """
+        # 1. 使用 RAG 檢索相關課程
+        # 優化搜尋策略：使用更精確的關鍵詞組合
         
-        # 2. 提取查詢中的 grade 和 required 資訊（已在上面提取，這裡確認）
-        if not target_grade:
-            target_grade = extract_grade_from_query(user_question)
+        # 基本問候/常見問題快速回應，避免進入重運算
+        chat_reply = self._basic_chat_response(user_question)
+        if chat_reply:
+            return chat_reply
         
-        target_required = None
-        if '必修' in user_question:
-            target_required = '必'
-        elif '選修' in user_question:
-            target_required = '選'
+        # 查詢中的必修/選修關鍵字（後續多處判斷共用）
+        has_required_kw = '必修' in user_question
+        has_elective_kw = '選修' in user_question
         
-        # 確認系所名稱（如果問題中有「XX系」或「XX碩」）
-        if not target_dept:
-            # 先移除常見的問句詞彙和時間詞彙，然後再匹配系所
-            cleaned_query = user_question
-            question_words = ['有什麼', '哪些', '什麼', '查詢', '找', '幫我', '請', '的', '課程', '課']
-            for qw in question_words:
-                cleaned_query = cleaned_query.replace(qw, ' ')
-            
-            # 移除時間相關詞彙
-            time_words = ['週一', '週二', '週三', '週四', '週五', '週六', '週日', 
-                         '周一', '周二', '周三', '周四', '周五', '周六', '周日',
-                         '星期一', '星期二', '星期三', '星期四', '星期五', '星期六', '星期日',
-                         '禮拜一', '禮拜二', '禮拜三', '禮拜四', '禮拜五', '禮拜六', '禮拜日',
-                         '早上', '上午', '下午', '晚上', '夜間', 'AM', 'PM']
-            for tw in time_words:
-                cleaned_query = cleaned_query.replace(tw, ' ')
-            
-            # 現在匹配系所（只匹配簡短的系所名稱，通常是1-4個字）
-            dept_pattern_match = re.search(r'([^\s]{1,4}系)', cleaned_query)
-            if dept_pattern_match:
-                target_dept = dept_pattern_match.group(1).strip()
-                # 再次檢查，確保不是時間相關的詞彙或問句詞彙
-                if any(kw in target_dept for kw in ['週', '周', '星期', '禮拜', '早上', '下午', '晚上', '夜間', '有什麼', '哪些', '什麼']):
-                    target_dept = None
-            else:
-                # 嘗試匹配「XX碩」格式（例如「資工碩一」）
-                dept_pattern_match = re.search(r'([^\s]{1,4}碩)', cleaned_query)
-                if dept_pattern_match:
-                    target_dept = dept_pattern_match.group(1).strip()
-                    # 再次檢查，確保不是時間相關的詞彙或問句詞彙
-                    if any(kw in target_dept for kw in ['週', '周', '星期', '禮拜', '早上', '下午', '晚上', '夜間', '有什麼', '哪些', '什麼']):
-                        target_dept = None
+        # 提取系所和年級資訊
+        target_grade, target_dept = self._parse_query_targets(user_question)
+        is_law_dept = bool(target_dept) and '法律' in target_dept
+        
+        # 選擇最佳搜尋策略
+        primary_search_query = _primary_search_query(user_question, target_grade, target_dept, has_required_kw, has_elective_kw)
+        
+        # 2. 查詢中的必選修條件
+        target_required = '必' if has_required_kw else '選' if has_elective_kw else None
         
         # 檢查是否需要過濾必修課程
-        need_required_filter = '必修' in user_question or '選修' in user_question
+        need_required_filter = has_required_kw or has_elective_kw
         
         # 提取時間條件
         time_condition = extract_time_from_query(user_question)
+        time_day, time_period = time_condition.get('day'), time_condition.get('period')
+        has_time_condition = bool(time_day or time_period)
+        
+        # 碩士班必修查詢（擴大檢索並額外搜尋「專題研討」）
+        is_master_required_query = bool(target_grade) and '碩' in target_grade and need_required_filter and target_required == '必'
+        is_law_grade = bool(target_grade) and '法律' in target_grade
+        
+        # 系所簡稱與院級關鍵字只與 target_dept 有關，計算一次供過濾、補強與時間條件分支共用
+        target_dept_short = target_dept.replace('系', '') if target_dept else ''
+        college_pattern = _keyword_pattern(_COLLEGE_MAPPINGS.get(target_dept, ())) if target_dept else None
         
         # 擴大搜尋範圍，取得更多候選課程
         # 時間條件與年級/必修/系所都會適度放大，避免漏掉跨時段課
         if target_grade:
-            if '碩' in target_grade and need_required_filter and target_required == '必':
+            if is_master_required_query:
                 search_n_results = n_results * 20
             else:
                 search_n_results = n_results * 15
@@ -379,60 +1429,23 @@ class CourseQuerySystem:
         else:
             search_n_results = n_results * 5
         # 如果有時間條件，進一步放大
-        if time_condition.get('day') or time_condition.get('period'):
+        if has_time_condition:
             search_n_results = max(search_n_results, n_results * 10)
         
         # 對於碩士班必修查詢，也使用「專題研討」或「Seminar」作為搜尋關鍵詞
         # 因為有些課程（如「專題研討」）的系所可能不同，但年級中包含目標年級
-        if target_grade and '碩' in target_grade and need_required_filter and target_required == '必':
-            # 額外搜尋「專題研討」或「Seminar」相關課程
-            seminar_results = self.rag_system.search_courses('專題研討 Seminar', n_results=50)
-            # 合併結果（去重）
-            relevant_courses = self.rag_system.search_courses(primary_search_query, n_results=search_n_results)
-            # 合併兩個搜尋結果
-            seen_serials = set()
-            combined_results = []
-            for course in relevant_courses:
-                serial = course.get('metadata', {}).get('serial', '')
-                if serial not in seen_serials:
-                    combined_results.append(course)
-                    seen_serials.add(serial)
-            for course in seminar_results:
-                serial = course.get('metadata', {}).get('serial', '')
-                if serial not in seen_serials:
-                    combined_results.append(course)
-                    seen_serials.add(serial)
-            relevant_courses = combined_results
+        if is_master_required_query:
+            # 額外搜尋「專題研討」或「Seminar」相關課程，與主要查詢一次批次檢索（結果已依課程代碼去重）
+            relevant_courses = self.rag_system.search_courses(
+                [primary_search_query, _MASTER_SEMINAR_QUERY],
+                n_results=max(50, search_n_results)
+            )
         else:
             # 如果有明確的時間條件，直接全庫掃描以免漏抓不同時段
-            if time_condition.get('day') or time_condition.get('period'):
+            if has_time_condition:
                 relevant_courses = []
                 try:
-                    total = self.rag_system.collection.count()
-                    batch_size = 500
-                    for offset in range(0, total, batch_size):
-                        all_results = self.rag_system.collection.get(
-                            include=['documents', 'metadatas'],
-                            limit=batch_size,
-                            offset=offset
-                        )
-                        docs = all_results.get('documents', [])
-                        metas = all_results.get('metadatas', [])
-                        for doc, md in zip(docs, metas):
-                            schedule = md.get('schedule', '')
-                            if not schedule:
-                                continue
-                            if not check_time_match(schedule, time_condition):
-                                continue
-                            relevant_courses.append({
-                                'document': doc,
-                                'metadata': md,
-                                'distance': None,
-                                'similarity': 0.0,
-                                'embedding_score': 0.0,
-                                'bm25_score': 0.0,
-                                'hybrid_score': 0.0
-                            })
+                    relevant_courses = self._get_scanned_courses(self._get_time_matched_indices(time_condition))
                     # 若沒有找到，退回混合檢索
                     if not relevant_courses:
                         relevant_courses = self.rag_system.search_courses(primary_search_query, n_results=search_n_results)
@@ -441,258 +1454,97 @@ class CourseQuerySystem:
             else:
                 relevant_courses = self.rag_system.search_courses(primary_search_query, n_results=search_n_results)
         
-        # helper: 判斷 grade 欄位中是否包含目標系所（須為獨立年級/組別，而非學程名稱）
-        def grade_has_target_dept(grade_text: str, target_dept: str) -> bool:
-            if not grade_text or not target_dept:
-                return False
-            
-            # 特殊處理：法律系包含法學組、司法組、財經法學組
-            if '法律' in target_dept:
-                if any(k in grade_text for k in ['法學', '司法', '財法', '法律']):
-                    return True
-            
-            # 建立不含「系」的短版本，用於匹配省略「系」的情況（如「法律1」）
-            target_dept_short = target_dept.replace('系', '') if '系' in target_dept else target_dept
-            
-            # 檢查目標系所是否為學士班（不包含「碩」）
-            target_is_undergrad = '碩' not in target_dept
-            
-            tokens = re.split(r'[\\|,，/\\s]+', grade_text)
-            for tk in tokens:
-                if not tk:
-                    continue
-                
-                # 排除學程名稱（包含「學程」的 token 不應該匹配）
-                if '學程' in tk:
-                    continue
-                
-                # 如果目標是學士班，排除碩士班的 token（例如「資工碩1」不應該匹配「資工系2」）
-                if target_is_undergrad and '碩' in tk:
-                    continue
-                
-                # 如果目標是碩士班，排除學士班的 token（例如「資工系2」不應該匹配「資工碩1」）
-                if not target_is_undergrad and '系' in tk and '碩' not in tk:
-                    continue
-                
-                # 1. 精確匹配完整系名 (e.g. "法律系" matches "法律系...")
-                if tk.startswith(target_dept):
-                        return True
-                
-                # 2. 匹配短版本 (e.g. "法律" matches "法律1", "法律法學組")
-                if tk.startswith(target_dept_short):
-                    if len(tk) == len(target_dept_short):
-                        return True
-                    next_ch = tk[len(target_dept_short)]
-                    # 允許：數字、碩、年級、班級、組別、系
-                    # 特別加入法律系常見分組字首：法、司、財
-                    # 但如果目標是學士班，不允許「碩」；如果目標是碩士班，不允許「系」（除非是「系碩」）
-                    if target_is_undergrad and next_ch == '碩':
-                        continue
-                    if not target_is_undergrad and next_ch == '系' and '碩' not in tk:
-                        continue
-                    if next_ch in '1234567890碩一二三四ABCDEFX系法司財':
-                        return True
-            return False
-
         filtered_courses = []  # 初始化 filtered_courses
+        # 過濾後最多保留的筆數（大幅增加保留數量，避免因必修課分班多而擠掉選修課）；
+        # 收集滿了就停止過濾，多出的候選反正會被捨棄
+        keep_limit = n_results * 10
         
         if need_required_filter or target_dept or target_grade:
+            # 系所比對用的關鍵字只與 target_dept 有關，在迴圈外計算一次
+            if target_dept:
+                # 取得搜尋關鍵字列表（預設使用去「系」後的簡稱）
+                dept_name_keywords = _DEPT_MAPPINGS.get(target_dept, (target_dept_short,))
+                
+                # 特殊處理法律系
+                if is_law_dept:
+                    dept_name_keywords = ('法律', '法學', '司法', '財經法')
+                dept_name_pattern = _keyword_pattern(dept_name_keywords)
+            
+            # 年級比對用的數字只與 target_grade 有關，同樣在迴圈外計算一次
+            target_grade_nums = _DIGITS_RE.findall(target_grade) if target_grade else []
+            target_grade_num = target_grade_nums[0] if target_grade_nums else ''
+            
             for course in relevant_courses:
                 document = course.get('document', '')
                 metadata = course.get('metadata', {})
+                # 常用欄位只讀取一次，後續各項檢查直接使用
+                meta_grade = metadata.get('grade', '')
+                meta_dept = metadata.get('dept', '')
+                meta_required = metadata.get('required', '')
+                meta_mapping = metadata.get('grade_required_mapping', '')
+                meta_schedule = metadata.get('schedule', '')
+                meta_name = metadata.get('name', '')
                 
                 # 檢查系所條件：
                 # 1. 年級欄位包含目標系所 (針對必修課，或指定對象的選修)
                 # 2. 開課系所包含目標系所 (針對該系開設的課程，包含選修)
                 dept_matches = True
                 if target_dept:
-                    grade_text = metadata.get('grade', '')
-                    dept_text = metadata.get('dept', '')
-                    
-                    # 排除學位學程與微學程
-                    # 修正：只排除「只屬於」學位學程或微學程的課程，而不是排除所有包含學位學程名稱的課程
-                    # 檢查 grade_text 中是否「只有」學位學程或微學程（沒有系所年級）
-                    tokens = re.split(r'[\\|,，/\\s]+', grade_text) if grade_text else []
-                    has_dept_grade = False
-                    for tk in tokens:
-                        if not tk:
-                            continue
-                        # 檢查是否包含系所年級（例如「通訊系3」、「資工系2」等）
-                        if re.search(r'系\d+|系[一二三四]', tk):
-                            has_dept_grade = True
-                            break
-                    
-                    # 如果 grade_text 中只有學位學程或微學程，沒有系所年級，則排除
-                    if not has_dept_grade and ('學位學程' in grade_text or '微學程' in grade_text):
-                        continue
-                    
-                    # 如果 dept_text 是學位學程或微學程，則排除
-                    if '學位學程' in dept_text or '微學程' in dept_text:
+                    dept_matches = _course_matches_target_dept(
+                        meta_grade, meta_dept,
+                        target_dept, dept_name_pattern, college_pattern
+                    )
+                    # 系所不符的課程不可能通過最終條件，直接略過後續年級/必選修檢查
+                    if not dept_matches:
                         continue
-                    
-                    # 定義學院映射關係（解決微積分、物理等院級課程匹配問題）
-                    college_mappings = {
-                        '通訊系': ['電機資訊學院', '電資院'],
-                        '資工系': ['電機資訊學院', '電資院'],
-                        '電機系': ['電機資訊學院', '電資院'],
-                        '經濟系': ['社會科學學院', '社科院'],
-                        '社工系': ['社會科學學院', '社科院'],
-                        '社會系': ['社會科學學院', '社科院'],
-                        '法律系': ['法律學院', '法學院'],
-                    }
-                    
-                    # 1. 檢查年級欄位
-                    grade_match = grade_has_target_dept(grade_text, target_dept) if grade_text else False
-                    
-                    # 2. 檢查開課系所 (支援簡稱匹配全名)
-                    dept_match = False
-                    if dept_text:
-                        # 定義常見系所簡稱與全名對應
-                        dept_mappings = {
-                            '資工系': ['資訊工程', '資工'],
-                            '通訊系': ['通訊工程', '通訊'],
-                            '電機系': ['電機工程', '電機'],
-                            '企管系': ['企業管理', '企管'],
-                            '社工系': ['社會工作', '社工'],
-                            '公行系': ['公共行政', '公行'],
-                            '不動系': ['不動產', '不動'],
-                            '休運系': ['休閒運動', '休運'],
-                        }
-                        # 取得搜尋關鍵字列表（預設使用去「系」後的簡稱）
-                        target_dept_short = target_dept.replace('系', '') if '系' in target_dept else target_dept
-                        keywords = dept_mappings.get(target_dept, [target_dept_short])
-                        
-                        # 特殊處理法律系
-                        if '法律' in target_dept:
-                            keywords = ['法律', '法學', '司法', '財經法']
-                            
-                        # 加入學院關鍵字檢查（針對院級必修）
-                        college_keywords = college_mappings.get(target_dept, [])
-                        
-                        dept_match = any(kw in dept_text for kw in keywords)
-                        
-                        # 檢查年級欄位是否包含學院名稱（例如「電資院1」）
-                        college_grade_match = any(kw in grade_text for kw in college_keywords) if grade_text else False
-                    
-                    # 只要符合其中一個條件即可
-                    dept_matches = grade_match or dept_match or college_grade_match
-                    # dept_matches = grade_match or dept_match or college_grade_match
-                    
-                    # 修正：優先使用應修系級 (grade) 判斷，避免開課系所造成的誤判
-                    # 特別處理：如果目標是學士班（不包含「碩」），排除碩士班的課程
-                    target_is_undergrad = '碩' not in target_dept
-                    if target_is_undergrad:
-                        # 檢查 grade_text 中是否只有碩士班的年級
-                        if grade_text:
-                            tokens = re.split(r'[\\|,，/\\s]+', grade_text)
-                            has_undergrad_grade = False
-                            has_master_grade_only = True
-                            for tk in tokens:
-                                if not tk:
-                                    continue
-                                if '學程' in tk:
-                                    continue
-                                # 檢查是否有學士班的年級（例如「資工系2」）
-                                if '系' in tk and '碩' not in tk:
-                                    has_undergrad_grade = True
-                                    has_master_grade_only = False
-                                    break
-                                # 檢查是否只有碩士班的年級（例如「資工碩1」）
-                                if '碩' in tk:
-                                    has_master_grade_only = True
-                                else:
-                                    has_master_grade_only = False
-                            
-                            # 如果只有碩士班的年級，沒有學士班的年級，則排除
-                            if has_master_grade_only and not has_undergrad_grade:
-                                dept_matches = False
-                                grade_match = False
-                    
-                    if grade_match:
-                        dept_matches = True
-                    elif dept_match:
-                        # 開課系所符合，但須檢查應修系級是否明確排除了該系（例如通識課）
-                        if '通識' in grade_text and '通識' not in target_dept:
-                            dept_matches = False
-                        elif '體育' in grade_text and '體育' not in target_dept:
-                            dept_matches = False
-                        # 如果目標是學士班，但開課系所是碩士班，且 grade_text 中只有碩士班的年級，則排除
-                        elif target_is_undergrad and '碩' in dept_text:
-                            # 檢查 grade_text 中是否有學士班的年級
-                            if grade_text:
-                                tokens = re.split(r'[\\|,，/\\s]+', grade_text)
-                                has_undergrad_grade = False
-                                for tk in tokens:
-                                    if not tk:
-                                        continue
-                                    if '學程' in tk:
-                                        continue
-                                    # 檢查是否有學士班的年級（例如「資工系2」）
-                                    if '系' in tk and '碩' not in tk:
-                                        has_undergrad_grade = True
-                                        break
-                                # 如果沒有學士班的年級，則排除
-                                if not has_undergrad_grade:
-                                    dept_matches = False
-                        else:
-                            # 若應修系級沒有明確排除（例如只寫「1」或「選修」），則接受開課系所
-                            dept_matches = True
-                    else:
-                        dept_matches = college_grade_match
                 
                 # 當有指定年級時，需要嚴格檢查 grade 欄位是否包含目標年級
                 # 例如：當 target_grade 為「統計系3」時，grade_text 必須包含「統計系3」
                 # 不能只包含系所或只包含年級數字
                 grade_matches = True
                 if target_grade:
-                    grade_text = metadata.get('grade', '')
+                    grade_text = meta_grade
                     if not grade_text:
                         # 如果沒有 grade_text，嘗試從 document 中提取
-                        grade_match = re.search(r'年級：([^\n]+)', document)
-                        if grade_match:
-                            grade_text = grade_match.group(1).strip()
+                        doc_grade = extract_document_grade_required(document)[0]
+                        if doc_grade is not None:
+                            grade_text = doc_grade
                     
                     if grade_text:
                         # 使用 check_grade_required 的邏輯來檢查 grade 匹配
                         # 但這裡我們只需要檢查是否有匹配，不需要檢查必選修狀態
                         # 先嘗試使用 grade_required_mapping
-                        mapping_json = metadata.get('grade_required_mapping', '')
+                        mapping_json = meta_mapping
                         found_grade_match = False
                         
                         if mapping_json:
-                            try:
-                                mapping_data = json.loads(mapping_json)
-                                mapping = mapping_data.get('mapping', [])
-                                
-                                # 檢查 mapping 中是否有任何 grade_item 匹配 target_grade
-                                for grade_item, _ in mapping:
-                                    # 使用類似 check_grade_required 的匹配邏輯
-                                    if grade_item == target_grade:
+                            # 檢查 mapping 中是否有任何 grade_item 匹配 target_grade（格式錯誤時視為沒有）
+                            for grade_item, _ in safe_load_mapping_status(mapping_json) or ():
+                                # 使用類似 check_grade_required 的匹配邏輯
+                                if grade_item == target_grade:
+                                    found_grade_match = True
+                                    break
+                                elif grade_item.startswith(target_grade):
+                                    diff = grade_item[len(target_grade):].strip()
+                                    if len(diff) == 0 or \
+                                       (len(diff) == 1 and diff in _SECTION_LETTERS) or \
+                                       (len(diff) > 0 and not diff[0].isdigit()):
+                                        found_grade_match = True
+                                        break
+                                elif target_grade.startswith(grade_item):
+                                    diff = target_grade[len(grade_item):].strip()
+                                    if len(diff) == 0 or \
+                                       (len(diff) == 1 and diff in _SECTION_LETTERS):
                                         found_grade_match = True
                                         break
-                                    elif grade_item.startswith(target_grade):
-                                        diff = grade_item[len(target_grade):].strip()
-                                        if len(diff) == 0 or \
-                                           (len(diff) == 1 and diff in ['A', 'B', 'C', 'D', 'E', 'F']) or \
-                                           (len(diff) > 0 and not diff[0].isdigit()):
-                                            found_grade_match = True
-                                            break
-                                    elif target_grade.startswith(grade_item):
-                                        diff = target_grade[len(grade_item):].strip()
-                                        if len(diff) == 0 or \
-                                           (len(diff) == 1 and diff in ['A', 'B', 'C', 'D', 'E', 'F']):
-                                            found_grade_match = True
-                                            break
-                            except:
-                                pass
                         
                         # 如果 grade_required_mapping 沒有匹配，使用傳統方式檢查
                         if not found_grade_match:
-                            required = metadata.get('required', '')
+                            required = meta_required
                             if not required:
-                                required_match = re.search(r'必選修：([^\n]+)', document)
-                                if required_match:
-                                    required = required_match.group(1).strip()
+                                doc_required = extract_document_grade_required(document)[1]
+                                if doc_required is not None:
+                                    required = doc_required
                             
                             if grade_text and required:
                                 course_dict = {'grade': grade_text, 'required': required}
@@ -704,7 +1556,7 @@ class CourseQuerySystem:
                         # 如果還是沒有匹配，檢查 grade_text 中是否直接包含 target_grade
                         if not found_grade_match:
                             # 將 grade_text 按分隔符分割，檢查每個 token
-                            tokens = re.split(r'[\\|,，/\\s]+', grade_text)
+                            tokens = _split_grade_tokens(grade_text)
                             for tk in tokens:
                                 if not tk:
                                     continue
@@ -716,18 +1568,17 @@ class CourseQuerySystem:
                                 elif tk.startswith(target_grade):
                                     diff = tk[len(target_grade):].strip()
                                     if len(diff) == 0 or \
-                                       (len(diff) == 1 and diff in ['A', 'B', 'C', 'D', 'E', 'F']):
+                                       (len(diff) == 1 and diff in _SECTION_LETTERS):
                                         found_grade_match = True
                                         break
                                 # 反向匹配：target_grade 以 tk 開頭，且差異是字母或數字
                                 elif target_grade.startswith(tk):
                                     diff = target_grade[len(tk):].strip()
                                     # 檢查 tk 是否包含系所和年級
-                                    if any(c.isdigit() for c in tk) and any(c.isdigit() for c in target_grade):
+                                    if target_grade_nums and _DIGITS_RE.search(tk):
                                         # 提取數字進行比較
-                                        tk_nums = re.findall(r'\d+', tk)
-                                        tg_nums = re.findall(r'\d+', target_grade)
-                                        if tk_nums and tg_nums and tk_nums[0] == tg_nums[0]:
+                                        tk_nums = _DIGITS_RE.findall(tk)
+                                        if tk_nums and tk_nums[0] == target_grade_num:
                                             found_grade_match = True
                                             break
                         
@@ -743,14 +1594,14 @@ class CourseQuerySystem:
                 is_required = True  # 預設為 True，如果沒有過濾條件就不過濾
                 
                 # 調試：檢查特定課程
-                course_name_debug = metadata.get('name', '')
-                debug_courses = ['計算機結構', '通訊原理', '多媒體訊號處理', '專題製作']
-                if any(dc in course_name_debug for dc in debug_courses):
+                course_name_debug = meta_name
+                trace_filter = _DEBUG_COURSE_TRACE and any(dc in course_name_debug for dc in _DEBUG_FILTER_COURSES)
+                if trace_filter:
                     print(f"  🔍 [初始過濾] 檢查 {course_name_debug}:")
                     print(f"      target_grade: {target_grade}, target_required: {target_required}")
-                    print(f"      grade_text: {metadata.get('grade', '')}")
-                    print(f"      required: {metadata.get('required', '')}")
-                    print(f"      grade_required_mapping: {metadata.get('grade_required_mapping', '')[:200] if metadata.get('grade_required_mapping') else '無'}...")
+                    print(f"      grade_text: {meta_grade}")
+                    print(f"      required: {meta_required}")
+                    print(f"      grade_required_mapping: {meta_mapping[:200] if meta_mapping else '無'}...")
                 
                 # 只有在明確要求必選修過濾時才進行過濾
                 # 如果只指定年級但沒有必選修要求，則不過濾必選修
@@ -759,7 +1610,7 @@ class CourseQuerySystem:
                     is_required = False  # 預設為 False，需要明確匹配才通過
                     
                     # 優先使用 grade_required_mapping JSON 欄位（如果存在）
-                    mapping_json = metadata.get('grade_required_mapping', '')
+                    mapping_json = meta_mapping
                     grade_required = None
                     
                     if target_grade and mapping_json:
@@ -785,141 +1636,71 @@ class CourseQuerySystem:
                                 grade_required = all_matches[0][1]
                         
                         # 特殊處理：法律系 (如果標準匹配失敗)
-                        if not all_matches and '法律' in target_grade:
-                            try:
-                                m_data = json.loads(mapping_json)
-                                mapping = m_data.get('mapping', [])
-                                import re
-                                num_match = re.search(r'\d+', target_grade)
-                                target_num = num_match.group(0) if num_match else ''
-                                for g_item, r_item in mapping:
-                                    if any(k in g_item for k in ['法學', '司法', '財法', '法律']):
-                                        if not target_num or target_num in g_item:
-                                            req_status = '必' if '必' in r_item else '選' if '選' in r_item else r_item
-                                            if not target_required or req_status == target_required:
-                                                grade_required = req_status
-                                                break
-                            except:
-                                pass
+                        if not all_matches and is_law_grade:
+                            target_num = target_grade_num
+                            for g_item, req_status in safe_load_mapping_status(mapping_json) or ():
+                                if _LAW_GROUP_RE.search(g_item):
+                                    if not target_num or target_num in g_item:
+                                        if not target_required or req_status == target_required:
+                                            grade_required = req_status
+                                            break
                         
                         # 如果 mapping_json 存在但 all_matches 為空，改用傳統方式檢查
                         if not all_matches and grade_required is None:
                             # 使用傳統方式檢查
-                            grade = metadata.get('grade', '')
-                            required = metadata.get('required', '')
-                            
-                            # 如果 metadata 中沒有，從 document 中提取
-                            if not grade or not required:
-                                grade_match = re.search(r'年級：([^\n]+)', document)
-                                required_match = re.search(r'必選修：([^\n]+)', document)
-                                
-                                if grade_match:
-                                    grade = grade_match.group(1).strip()
-                                if required_match:
-                                    required = required_match.group(1).strip()
-                            
-                            # 如果有 target_grade，檢查該 grade 的必選修狀態
-                            if grade and required:
-                                course_dict = {'grade': grade, 'required': required}
-                                grade_required = check_grade_required(course_dict, target_grade)
+                            grade_required = _fallback_grade_required(meta_grade, meta_required, document, target_grade)
 
                     elif target_grade:
                         # 傳統方式：從 metadata 或 document 中取得 grade 和 required
-                        grade = metadata.get('grade', '')
-                        required = metadata.get('required', '')
-                        
-                        # 如果 metadata 中沒有，從 document 中提取
-                        if not grade or not required:
-                            grade_match = re.search(r'年級：([^\n]+)', document)
-                            required_match = re.search(r'必選修：([^\n]+)', document)
-                            
-                            if grade_match:
-                                grade = grade_match.group(1).strip()
-                            if required_match:
-                                required = required_match.group(1).strip()
-                        
-                        # 如果有 target_grade，檢查該 grade 的必選修狀態
-                        if grade and required:
-                            course_dict = {'grade': grade, 'required': required}
-                            grade_required = check_grade_required(course_dict, target_grade)
-                        # 如果還是沒有 grade 和 required，嘗試從 document 中解析 JSON
-                        elif mapping_json:
-                            # 如果 metadata 中沒有但 document 中有，嘗試解析
-                            try:
-                                mapping_data = json.loads(mapping_json)
-                                # 從 document 中提取 grade 資訊並匹配
-                                # 這裡已經有 grade_required_mapping，應該在上面就處理了
-                                pass
-                            except:
-                                pass
+                        grade_required = _fallback_grade_required(meta_grade, meta_required, document, target_grade)
                     
                     # 根據 grade_required 判斷 is_required
                     # 必須嚴格依照 grade 和 required 的對應關係來判斷
                     if target_required and grade_required is not None:
                         # 有明確的必選修要求，檢查是否符合
                         is_required = (grade_required == target_required)
-                        if '計算機結構' in course_name_debug:
+                        if trace_filter and '計算機結構' in course_name_debug:
                             print(f"      [初始過濾] grade_required={grade_required}, target_required={target_required}, is_required={is_required}")
                     elif target_grade and grade_required is not None:
                         # 有 grade 要求但沒有必選修要求，只要有對應的 grade 就通過
                         is_required = True
-                        if '計算機結構' in course_name_debug:
+                        if trace_filter and '計算機結構' in course_name_debug:
                             print(f"      [初始過濾] grade_required={grade_required}, 沒有必選修要求, is_required={is_required}")
                     
                     # 如果有 target_grade 但無法確定 grade_required，必須使用 grade 和 required 欄位來檢查
                     # 不能直接使用 meta_required，因為需要對應到 target_grade
                     if is_required is False and target_grade and grade_required is None:
-                        if '計算機結構' in course_name_debug:
+                        if trace_filter and '計算機結構' in course_name_debug:
                             print(f"      [初始過濾] grade_required 是 None，使用傳統方式檢查...")
-                        # 從 metadata 或 document 中取得 grade 和 required
-                        grade = metadata.get('grade', '')
-                        required = metadata.get('required', '')
-                        
-                        # 如果 metadata 中沒有，從 document 中提取
-                        if not grade or not required:
-                            grade_match = re.search(r'年級：([^\n]+)', document)
-                            required_match = re.search(r'必選修：([^\n]+)', document)
-                            
-                            if grade_match:
-                                grade = grade_match.group(1).strip()
-                            if required_match:
-                                required = required_match.group(1).strip()
-                        
-                        # 使用 grade 和 required 欄位來檢查 target_grade 的必選修狀態
-                        if grade and required:
-                            course_dict = {'grade': grade, 'required': required}
-                            grade_required = check_grade_required(course_dict, target_grade)
-                            
-                            # 根據 grade_required 判斷 is_required
-                            if grade_required is not None:
-                                if target_required:
-                                    is_required = (grade_required == target_required)
-                                else:
-                                    is_required = True
+                        # 從 metadata 或 document 中取得 grade 和 required，檢查 target_grade 的必選修狀態
+                        grade_required = _fallback_grade_required(meta_grade, meta_required, document, target_grade)
+                        # 根據 grade_required 判斷 is_required
+                        if grade_required is not None:
+                            if target_required:
+                                is_required = (grade_required == target_required)
+                            else:
+                                is_required = True
                             
                     elif need_required_filter and not target_grade:
                         # 沒有 target_grade，但有必選修要求
                         # 優先使用 grade_required_mapping 檢查該系所是否有符合的必選修狀態
                         if mapping_json:
-                            try:
-                                mapping_data = json.loads(mapping_json)
-                                mapping = mapping_data.get('mapping', [])
-                                
+                            mapping = safe_load_mapping_status(mapping_json)
+                            if mapping is not None:
                                 # 檢查是否有任何一個 grade 包含目標系所，且 required 符合要求
+                                # （mapping 的必選修已正規化為「必」、「選」或原字樣）
                                 found_match = False
-                                for g_item, r_item in mapping:
+                                for g_item, req_status in mapping:
                                     # 檢查 grade 是否包含目標系所
                                     if target_dept:
                                         # 使用 grade_has_target_dept 函數檢查
-                                        if grade_has_target_dept(g_item, target_dept):
-                                            req_status = '必' if '必' in r_item else '選' if '選' in r_item else None
-                                            if req_status == target_required:
+                                        if _grade_has_target_dept(g_item, target_dept):
+                                            if req_status in ('必', '選') and req_status == target_required:
                                                 found_match = True
                                                 break
                                     else:
                                         # 沒有指定系所，直接檢查 required
-                                        req_status = '必' if '必' in r_item else '選' if '選' in r_item else None
-                                        if req_status == target_required:
+                                        if req_status in ('必', '選') and req_status == target_required:
                                             found_match = True
                                             break
                                 
@@ -927,9 +1708,8 @@ class CourseQuerySystem:
                                     is_required = True
                                 else:
                                     is_required = False
-                            except:
+                            else:
                                 # 如果 JSON 解析失敗，退回使用傳統方式
-                                meta_required = metadata.get('required', '')
                                 if target_required == '必' and meta_required and '必' in meta_required:
                                     is_required = True
                                 elif target_required == '選' and meta_required and '選' in meta_required:
@@ -939,18 +1719,7 @@ class CourseQuerySystem:
                         else:
                             # 沒有 grade_required_mapping，使用傳統方式檢查
                             # 必須使用 grade 和 required 欄位的對應關係
-                            grade = metadata.get('grade', '')
-                            required = metadata.get('required', '')
-                            
-                            # 如果 metadata 中沒有，從 document 中提取
-                            if not grade or not required:
-                                grade_match = re.search(r'年級：([^\n]+)', document)
-                                required_match = re.search(r'必選修：([^\n]+)', document)
-                                
-                                if grade_match:
-                                    grade = grade_match.group(1).strip()
-                                if required_match:
-                                    required = required_match.group(1).strip()
+                            grade, required = _resolve_grade_required(meta_grade, meta_required, document)
                             
                             # 檢查 grade 和 required 的對應關係
                             if grade and required:
@@ -960,7 +1729,7 @@ class CourseQuerySystem:
                                 for g_item, r_item in mapping:
                                     # 檢查 grade 是否包含目標系所
                                     if target_dept:
-                                        if grade_has_target_dept(g_item, target_dept):
+                                        if _grade_has_target_dept(g_item, target_dept):
                                             req_status = '必' if '必' in r_item else '選' if '選' in r_item else None
                                             if req_status == target_required:
                                                 found_match = True
@@ -978,18 +1747,17 @@ class CourseQuerySystem:
                 
                 # 檢查時間條件
                 time_matches = True
-                if time_condition.get('day') or time_condition.get('period'):
-                    schedule = metadata.get('schedule', '')
+                if has_time_condition:
+                    schedule = meta_schedule
                     if schedule:
-                        time_matches = check_time_match(schedule, time_condition)
+                        time_matches = _schedule_matches_time(schedule, time_day, time_period)
                     else:
                         # 如果沒有 schedule 資訊，但查詢中有時間條件，則不符合
                         time_matches = False
                 
                 # 同時滿足所有條件
                 # 當有指定年級時，必須同時滿足 grade_matches（年級匹配）
-                debug_courses = ['計算機結構', '通訊原理', '多媒體訊號處理', '專題製作']
-                if any(dc in course_name_debug for dc in debug_courses):
+                if trace_filter:
                     print(f"      [初始過濾] 最終檢查: dept_matches={dept_matches}, grade_matches={grade_matches}, is_required={is_required}, time_matches={time_matches}")
                     if not (dept_matches and grade_matches and is_required and time_matches):
                         print(f"      ❌ [初始過濾] {course_name_debug} 被過濾掉")
@@ -998,10 +1766,12 @@ class CourseQuerySystem:
                 
                 if dept_matches and grade_matches and is_required and time_matches:
                     filtered_courses.append(course)
+                    if len(filtered_courses) >= keep_limit:
+                        break
             
             # 如果過濾後有結果，優先使用過濾後的結果（取多一點以便合併）
             if filtered_courses:
-                relevant_courses = filtered_courses[:n_results * 10]  # 大幅增加保留數量，避免因必修課分班多而擠掉選修課
+                relevant_courses = filtered_courses[:keep_limit]
                 # 調試：檢查過濾後的結果
                 print(f"  📊 過濾後結果數: {len(filtered_courses)}, 使用前 {len(relevant_courses)} 筆")
                 for i, c in enumerate(relevant_courses[:5]):
@@ -1023,243 +1793,149 @@ class CourseQuerySystem:
                     dept_ok = True
                     if target_dept:
                         # 只檢查年級欄位
-                        dept_ok = grade_has_target_dept(grade_text, target_dept) if grade_text else False
+                        dept_ok = _grade_has_target_dept(grade_text, target_dept) if grade_text else False
                     time_ok = True
-                    if time_condition.get('day') or time_condition.get('period'):
-                        time_ok = check_time_match(schedule, time_condition) if schedule else False
+                    if has_time_condition:
+                        time_ok = _schedule_matches_time(schedule, time_day, time_period) if schedule else False
                     
-                    if dept_ok and time_ok:
-                        relaxed.append(course)
-                
-                if relaxed:
-                    relevant_courses = relaxed[:n_results * 10]
-                else:
-                    return "查無課程 請重新輸入"
-        else:
-            # 沒有系所/年級/必修條件，但有時間條件時也要過濾時間
-            if time_condition.get('day') or time_condition.get('period'):
-                time_filtered = []
-                for course in relevant_courses:
-                    metadata = course.get('metadata', {})
-                    schedule = metadata.get('schedule', '')
-                    if schedule and check_time_match(schedule, time_condition):
-                        time_filtered.append(course)
-                if time_filtered:
-                    relevant_courses = time_filtered[:n_results * 10]
-                else:
-                    return "查無課程 請重新輸入"
-        
-        # 年級和必選修條件補強：若結果太少，再全量掃描一次 collection 依年級/系所/必選修補充
-        # 這確保不會漏掉任何符合條件的課程（特別是開課系所不同的課程，如「中級會計學」對「統計系3」）
-        # 當有指定年級時，進行全量掃描補強，確保不會漏掉任何符合條件的課程
-        # 如果有指定必選修，則只添加符合必選修條件的課程；如果沒有指定，則添加所有符合年級的課程
-        # 補強邏輯在過濾之後執行，直接添加到 relevant_courses，不需要再次過濾
-        if target_grade:
-            print(f"🔍 執行補強邏輯：target_grade={target_grade}, target_required={target_required}, target_dept={target_dept}, 當前結果數={len(relevant_courses)}")
-            print(f"   補強邏輯將全量掃描 collection，尋找符合條件的課程...")
-            try:
-                total = self.rag_system.collection.count()
-                batch_size = 500
-                seen_ids = set()
-                for c in relevant_courses:
-                    md = c.get('metadata', {})
-                    seen_ids.add(md.get('serial', '') + md.get('schedule', ''))
-
-                def process_batch_for_grade_required(docs, metas):
-                    nonlocal relevant_courses, seen_ids
-                    found_count = 0
-                    checked_count = 0
-                    for doc, md in zip(docs, metas):
-                        checked_count += 1
-                        # 檢查年級匹配
-                        grade_text = md.get('grade', '')
-                        if not grade_text:
-                            continue
-                        
-                        dept_text = md.get('dept', '')
-                        
-                        # 排除學位學程與微學程
-                        if '學位學程' in grade_text or '微學程' in grade_text or \
-                           '學位學程' in dept_text or '微學程' in dept_text:
-                            continue
-                        
-                        # 調試：每檢查100個課程打印一次進度
-                        if checked_count % 100 == 0:
-                            print(f"  ⏳ 已檢查 {checked_count} 個課程，找到 {found_count} 個符合條件的課程...")
-                        
-                        # 使用 grade_has_target_dept 檢查系所
-                        if target_dept:
-                            if not grade_has_target_dept(grade_text, target_dept):
-                                continue
-                        
-                        # 調試：檢查是否找到「中級會計學」
-                        course_name = md.get('name', '')
-                        course_serial = md.get('serial', '')
-                        if '中級會計' in course_name or '計算機結構' in course_name:
-                            print(f"  🔍 找到相關課程: {course_name} ({course_serial})")
-                            print(f"      grade_text: {grade_text}")
-                            print(f"      target_dept: {target_dept}")
-                            print(f"      grade_has_target_dept: {grade_has_target_dept(grade_text, target_dept) if target_dept else 'N/A'}")
-                        
-                        # 檢查年級匹配（使用 grade_matches 的邏輯）
-                        mapping_json = md.get('grade_required_mapping', '')
-                        found_grade_match = False
-                        
-                        if mapping_json:
-                            try:
-                                mapping_data = json.loads(mapping_json)
-                                mapping = mapping_data.get('mapping', [])
-                                for grade_item, _ in mapping:
-                                    if grade_item == target_grade:
-                                        found_grade_match = True
-                                        if '中級會計' in course_name or '計算機結構' in course_name:
-                                            print(f"      ✓ 年級匹配（mapping）: {grade_item} == {target_grade}")
-                                        break
-                                    elif grade_item.startswith(target_grade):
-                                        diff = grade_item[len(target_grade):].strip()
-                                        if len(diff) == 0 or \
-                                           (len(diff) == 1 and diff in ['A', 'B', 'C', 'D', 'E', 'F']) or \
-                                           (len(diff) > 0 and not diff[0].isdigit()):
-                                            found_grade_match = True
-                                            if '中級會計' in course_name or '計算機結構' in course_name:
-                                                print(f"      ✓ 年級匹配（mapping，部分）: {grade_item} starts with {target_grade}")
-                                            break
-                            except Exception as e:
-                                if '中級會計' in course_name or '計算機結構' in course_name:
-                                    print(f"      ❌ mapping_json 解析失敗: {e}")
-                                pass
-                        
-                        if not found_grade_match:
-                            # 使用傳統方式檢查
-                            tokens = re.split(r'[\\|,，/\\s]+', grade_text)
-                            for tk in tokens:
-                                if tk == target_grade:
-                                    found_grade_match = True
-                                    break
-                                elif tk.startswith(target_grade):
-                                    diff = tk[len(target_grade):].strip()
-                                    if len(diff) == 0 or \
-                                       (len(diff) == 1 and diff in ['A', 'B', 'C', 'D', 'E', 'F']):
-                                        found_grade_match = True
+                    if dept_ok and time_ok:
+                        relaxed.append(course)
+                        if len(relaxed) >= keep_limit:
+                            break
+                
+                if relaxed:
+                    relevant_courses = relaxed[:keep_limit]
+                else:
+                    return "查無課程 請重新輸入"
+        else:
+            # 沒有系所/年級/必修條件，但有時間條件時也要過濾時間
+            if has_time_condition:
+                time_filtered = []
+                for course in relevant_courses:
+                    metadata = course.get('metadata', {})
+                    schedule = metadata.get('schedule', '')
+                    if schedule and _schedule_matches_time(schedule, time_day, time_period):
+                        time_filtered.append(course)
+                        if len(time_filtered) >= keep_limit:
+                            break
+                if time_filtered:
+                    relevant_courses = time_filtered[:keep_limit]
+                else:
+                    return "查無課程 請重新輸入"
+        
+        # 年級和必選修條件補強：若結果太少，再全量掃描一次 collection 依年級/系所/必選修補充
+        # 這確保不會漏掉任何符合條件的課程（特別是開課系所不同的課程，如「中級會計學」對「統計系3」）
+        # 當有指定年級時，進行全量掃描補強，確保不會漏掉任何符合條件的課程
+        # 如果有指定必選修，則只添加符合必選修條件的課程；如果沒有指定，則添加所有符合年級的課程
+        # 補強邏輯在過濾之後執行，直接添加到 relevant_courses，不需要再次過濾
+        if target_grade:
+            print(f"🔍 執行補強邏輯：target_grade={target_grade}, target_required={target_required}, target_dept={target_dept}, 當前結果數={len(relevant_courses)}")
+            print(f"   補強邏輯將依年級索引掃描 collection，尋找符合條件的課程...")
+            try:
+                course_metas = self._get_course_metas()
+                row_keys = self._course_row_keys
+                # 年級、系所與學程排除條件只看課程本身，直接取索引，只需再檢查必選修
+                candidate_indices = self._get_grade_matched_indices(target_grade, target_dept)
+                print(f"  📦 年級索引共 {len(candidate_indices)} 個候選課程")
+                seen_ids = _course_keys(relevant_courses)
+                # 只依 metadata 判斷，採用的課程最後再一次補讀 document
+                accepted_indices = []
+                base_count = len(relevant_courses)
+
+                for idx in candidate_indices:
+                    md = course_metas[idx]
+                    grade_text, required, course_name, course_serial, mapping_json = _AUGMENT_META_GETTER(md)
+                    
+                    # 調試：檢查是否找到「中級會計學」
+                    trace = _DEBUG_COURSE_TRACE and ('中級會計' in course_name or '計算機結構' in course_name)
+                    if trace:
+                        print(f"  🔍 找到相關課程: {course_name} ({course_serial})")
+                        print(f"      grade_text: {grade_text}")
+                        print(f"      target_dept: {target_dept}")
+                    
+                    # 檢查必選修
+                    grade_required_status = None
+                    
+                    if mapping_json:
+                        try:
+                            course_dict = {'grade_required_mapping': mapping_json}
+                            all_matches = check_grades_required_from_json(course_dict, target_grade)
+                            if all_matches:
+                                if trace:
+                                    print(f"      all_matches: {all_matches}")
+                                for _, req_status in all_matches:
+                                    if req_status == target_required:
+                                        grade_required_status = target_required
+                                        if trace:
+                                            print(f"      ✓ 必選修匹配（mapping）: {req_status} == {target_required}")
                                         break
+                                if grade_required_status is None:
+                                    grade_required_status = all_matches[0][1]
+                                    if trace:
+                                        print(f"      ⚠️ 必選修狀態不匹配: {grade_required_status} != {target_required}")
+                        except Exception as e:
+                            if trace:
+                                print(f"      ❌ check_grades_required_from_json 失敗: {e}")
+                            pass
+                    
+                    if grade_required_status is None and grade_text and required:
+                        course_dict = {'grade': grade_text, 'required': required}
+                        grade_required_status = check_grade_required(course_dict, target_grade)
+                        if trace:
+                            print(f"      check_grade_required 結果: {grade_required_status}, grade_text={grade_text}, required={required}, target_grade={target_grade}")
+                    
+                    # 如果有指定必選修要求，檢查是否符合；如果沒有指定，則接受所有課程
+                    # 修正：如果 grade_required_status 是 None，表示沒有找到匹配，應該跳過
+                    # 但如果找到了 grade_match，應該再檢查一次 required 欄位
+                    if need_required_filter and target_required:
+                        if grade_required_status is None:
+                            # 如果 grade_required_status 是 None，但已經找到了 grade_match，再檢查一次
+                            if grade_text and required:
+                                # 直接檢查 grade_text 中是否包含 target_grade，以及對應的 required 是否匹配
+                                tokens = _split_grade_tokens(grade_text)
+                                req_tokens = _split_grade_tokens(required)
+                                for i, tk in enumerate(tokens):
+                                    if tk == target_grade or (tk.startswith(target_grade) and len(tk) > len(target_grade) and tk[len(target_grade)] in _SECTION_LETTERS):
+                                        if i < len(req_tokens):
+                                            req_status = req_tokens[i]
+                                            if '選' in req_status and target_required == '選':
+                                                grade_required_status = '選'
+                                                if trace:
+                                                    print(f"      ✓ 直接匹配必選修: {course_name}, req_status={req_status}")
+                                                break
+                                            elif '必' in req_status and target_required == '必':
+                                                grade_required_status = '必'
+                                                if trace:
+                                                    print(f"      ✓ 直接匹配必選修: {course_name}, req_status={req_status}")
+                                                break
                         
-                        if not found_grade_match:
-                            continue
-                        
-                        # 檢查必選修
-                        required = md.get('required', '')
-                        grade_required_status = None
-                        
-                        if mapping_json:
-                            try:
-                                course_dict = {'grade_required_mapping': mapping_json}
-                                all_matches = check_grades_required_from_json(course_dict, target_grade)
-                                if all_matches:
-                                    if '中級會計' in course_name or '計算機結構' in course_name:
-                                        print(f"      all_matches: {all_matches}")
-                                    for _, req_status in all_matches:
-                                        if req_status == target_required:
-                                            grade_required_status = target_required
-                                            if '中級會計' in course_name or '計算機結構' in course_name:
-                                                print(f"      ✓ 必選修匹配（mapping）: {req_status} == {target_required}")
-                                            break
-                                    if grade_required_status is None:
-                                        grade_required_status = all_matches[0][1]
-                                        if '中級會計' in course_name or '計算機結構' in course_name:
-                                            print(f"      ⚠️ 必選修狀態不匹配: {grade_required_status} != {target_required}")
-                            except Exception as e:
-                                if '中級會計' in course_name or '計算機結構' in course_name:
-                                    print(f"      ❌ check_grades_required_from_json 失敗: {e}")
-                                pass
-                        
-                        if grade_required_status is None and grade_text and required:
-                            course_dict = {'grade': grade_text, 'required': required}
-                            grade_required_status = check_grade_required(course_dict, target_grade)
-                            if '中級會計' in course_name or '計算機結構' in course_name:
-                                print(f"      check_grade_required 結果: {grade_required_status}, grade_text={grade_text}, required={required}, target_grade={target_grade}")
-                        
-                        # 如果有指定必選修要求，檢查是否符合；如果沒有指定，則接受所有課程
-                        # 修正：如果 grade_required_status 是 None，表示沒有找到匹配，應該跳過
-                        # 但如果找到了 grade_match，應該再檢查一次 required 欄位
-                        if need_required_filter and target_required:
-                            if grade_required_status is None:
-                                # 如果 grade_required_status 是 None，但已經找到了 grade_match，再檢查一次
-                                if grade_text and required:
-                                    # 直接檢查 grade_text 中是否包含 target_grade，以及對應的 required 是否匹配
-                                    tokens = re.split(r'[\\|,，/\\s]+', grade_text)
-                                    req_tokens = re.split(r'[\\|,，/\\s]+', required)
-                                    for i, tk in enumerate(tokens):
-                                        if tk == target_grade or (tk.startswith(target_grade) and len(tk) > len(target_grade) and tk[len(target_grade)] in 'ABCDEF'):
-                                            if i < len(req_tokens):
-                                                req_status = req_tokens[i]
-                                                if '選' in req_status and target_required == '選':
-                                                    grade_required_status = '選'
-                                                    if '中級會計' in course_name or '計算機結構' in course_name:
-                                                        print(f"      ✓ 直接匹配必選修: {course_name}, req_status={req_status}")
-                                                    break
-                                                elif '必' in req_status and target_required == '必':
-                                                    grade_required_status = '必'
-                                                    if '中級會計' in course_name or '計算機結構' in course_name:
-                                                        print(f"      ✓ 直接匹配必選修: {course_name}, req_status={req_status}")
-                                                    break
-                            
-                            if grade_required_status != target_required:
-                                if '中級會計' in course_name or '計算機結構' in course_name:
-                                    print(f"      ❌ 必選修匹配失敗: {course_name}, grade_required_status={grade_required_status}, target_required={target_required}")
-                                continue
-                        
-                        # 去重
-                        key = md.get('serial', '') + md.get('schedule', '')
-                        if key in seen_ids:
-                            if '中級會計' in course_name or '計算機結構' in course_name:
-                                print(f"      ⚠️ 課程已存在（去重）: {course_name} ({course_serial})")
+                        if grade_required_status != target_required:
+                            if trace:
+                                print(f"      ❌ 必選修匹配失敗: {course_name}, grade_required_status={grade_required_status}, target_required={target_required}")
                             continue
-                        seen_ids.add(key)
-                        
-                        relevant_courses.append({
-                            'document': doc,
-                            'metadata': md,
-                            'distance': None,
-                            'similarity': 0.0,
-                            'embedding_score': 0.0,
-                            'bm25_score': 0.0,
-                            'hybrid_score': 0.0
-                        })
-                        
-                        found_count += 1
-                        
-                        # 打印找到的課程信息以便調試
-                        course_name = md.get('name', '')
-                        course_serial = md.get('serial', '')
+                    
+                    # 去重
+                    key = row_keys[idx]
+                    if key in seen_ids:
+                        if trace:
+                            print(f"      ⚠️ 課程已存在（去重）: {course_name} ({course_serial})")
+                        continue
+                    seen_ids.add(key)
+                    
+                    accepted_indices.append(idx)
+                    if _DEBUG_COURSE_TRACE:
                         print(f"  ✓ 補強邏輯找到課程: {course_name} ({course_serial})")
-                        
-                        # 繼續掃描，不限制數量，確保找到所有符合條件的課程
-                        # 但為了避免過度掃描，可以設定一個合理的上限
-                        if len(relevant_courses) >= n_results * 5:
-                            print(f"  ⚠️ 達到掃描上限 ({n_results * 5})，停止掃描")
-                            return True
-                    if found_count > 0:
-                        print(f"  📊 本批次找到 {found_count} 個符合條件的課程")
-                    return False
-
-                # 分批取出
-                for offset in range(0, total, batch_size):
-                    all_results = self.rag_system.collection.get(
-                        include=['documents', 'metadatas'],
-                        limit=batch_size,
-                        offset=offset
-                    )
-                    docs = all_results.get('documents', [])
-                    metas = all_results.get('metadatas', [])
-                    if docs and metas:
-                        print(f"  📦 處理批次 {offset // batch_size + 1}，包含 {len(docs)} 個課程")
-                        if process_batch_for_grade_required(docs, metas):
-                            print(f"  ⚠️ 達到掃描上限，停止掃描")
-                            break
+                    
+                    # 繼續掃描，不限制數量，確保找到所有符合條件的課程
+                    # 但為了避免過度掃描，可以設定一個合理的上限
+                    if base_count + len(accepted_indices) >= n_results * 5:
+                        print(f"  ⚠️ 達到掃描上限 ({n_results * 5})，停止掃描")
+                        break
+                
+                relevant_courses.extend(self._get_scanned_courses(accepted_indices))
             except Exception as e:
                 # 如果補強失敗，打印錯誤信息以便調試
                 print(f"⚠️ 補強邏輯執行失敗: {e}")
-                import traceback
                 traceback.print_exc()
                 # 繼續使用原有結果
                 pass
@@ -1267,7 +1943,9 @@ class CourseQuerySystem:
                 print(f"🔍 補強邏輯完成：最終結果數={len(relevant_courses)}")
         
         # 時間條件補強：若結果太少，再全量掃描一次 collection 依時間/系所（與必修需求）補充
-        if time_condition.get('day') or time_condition.get('period'):
+        # 補強加入的課程已通過與時間條件回覆相同（或更嚴格）的系所條件，記下 id 免得回覆前再判斷一次
+        time_dept_checked_ids = set()
+        if has_time_condition:
             # 對於通識課程，總是進行全量掃描，確保找到所有符合條件的課程
             should_enhance = len(relevant_courses) < n_results
             if target_dept == '通識':
@@ -1275,22 +1953,22 @@ class CourseQuerySystem:
                 print(f"🔍 開始時間條件補強邏輯：target_dept=通識, 當前結果數={len(relevant_courses)}")
             if should_enhance:
                 try:
-                    total = self.rag_system.collection.count()
+                    course_metas = self._get_course_metas()
+                    row_keys = self._course_row_keys
                     batch_size = 500
-                    seen_ids = set()
-                    for c in relevant_courses:
-                        md = c.get('metadata', {})
-                        seen_ids.add(md.get('serial', '') + md.get('schedule', ''))
+                    seen_ids = _course_keys(relevant_courses)
+
 
-                    def process_batch(docs, metas):
+                    def process_batch(indices):
                         nonlocal relevant_courses, seen_ids
-                        for doc, md in zip(docs, metas):
-                            schedule = md.get('schedule', '')
-                            if not schedule:
-                                continue
-                            # 時間匹配
-                            if not check_time_match(schedule, time_condition):
+                        # 傳入的課程皆已通過時間條件索引篩選；只依 metadata 判斷，採用的課程再補讀 document
+                        accepted_indices = []
+                        for i in indices:
+                            # 去重：已在結果中的課程不必再做系所與必修判斷
+                            key = row_keys[i]
+                            if key in seen_ids:
                                 continue
+                            md = course_metas[i]
                             # 系所匹配（若有）：對於通識課程，檢查年級欄位是否包含「通識」即可
                             if target_dept:
                                 grade_text = md.get('grade', '')
@@ -1298,13 +1976,13 @@ class CourseQuerySystem:
                                 # 對於通識課程，檢查年級欄位是否包含「通識」即可
                                 # 因為通識課程可能由不同系所開設（例如「歷史系」、「體育」），但年級欄位中包含「通識」
                                 if target_dept == '通識':
-                                    grade_ok = grade_has_target_dept(grade_text, target_dept) if grade_text else False
+                                    grade_ok = _grade_has_target_dept(grade_text, target_dept) if grade_text else False
                                     if not grade_ok:
                                         continue
                                 else:
                                     # 對於其他系所，必須同時滿足：年級欄位中包含目標系所，且開課系所也要匹配
-                                    grade_ok = grade_has_target_dept(grade_text, target_dept) if grade_text else False
-                                    dept_ok = (target_dept.replace('系', '') in dept_text) if dept_text else False
+                                    grade_ok = _grade_has_target_dept(grade_text, target_dept) if grade_text else False
+                                    dept_ok = (target_dept_short in dept_text) if dept_text else False
                                     # 必須同時滿足 grade_ok 和 dept_ok，避免誤匹配其他系開設的課程
                                     if not (grade_ok and dept_ok):
                                         continue
@@ -1315,279 +1993,92 @@ class CourseQuerySystem:
                                     continue
                                 if target_required == '選' and ('選' not in req or '必' in req):
                                     continue
-                            # 去重
-                            key = md.get('serial', '') + schedule
-                            if key in seen_ids:
-                                continue
                             seen_ids.add(key)
-                            relevant_courses.append({
-                                'document': doc,
-                                'metadata': md,
-                                'distance': None,
-                                'similarity': 0.0,
-                                'embedding_score': 0.0,
-                                'bm25_score': 0.0,
-                                'hybrid_score': 0.0
-                            })
-
-                    # 分批取出，避免 get() 預設只取少量
-                    for offset in range(0, total, batch_size):
-                        all_results = self.rag_system.collection.get(
-                            include=['documents', 'metadatas'],
-                            limit=batch_size,
-                            offset=offset
-                        )
-                        docs = all_results.get('documents', [])
-                        metas = all_results.get('metadatas', [])
-                        if docs and metas:
-                            process_batch(docs, metas)
+                            accepted_indices.append(i)
+                        scanned = self._get_scanned_courses(accepted_indices)
+                        if target_dept:
+                            time_dept_checked_ids.update(id(c) for c in scanned)
+                        relevant_courses.extend(scanned)
+
+                    # 依時間條件索引取出候選，並維持原本每 500 筆為一批的上限檢查
+                    for _, group in groupby(self._get_time_matched_indices(time_condition), key=lambda i: i // batch_size):
+                        process_batch(list(group))
                         # 對於通識課程，不限制數量，確保找到所有符合條件的課程
                         if target_dept != '通識' and len(relevant_courses) >= n_results * 3:
                             break
                 except Exception as e:
                     # 打印錯誤信息以便調試
                     print(f"⚠️ 時間條件補強邏輯執行失敗: {e}")
-                    import traceback
                     traceback.print_exc()
                     pass
                 finally:
                     if target_dept == '通識':
                         print(f"🔍 時間條件補強邏輯完成：最終結果數={len(relevant_courses)}")
 
-        # 3. 建立 context（相關課程資訊）
-        # 如果有 target_grade，傳遞 target_grade 以便在 context 中顯示所有匹配的年級
-        context = self._build_context(relevant_courses, target_grade=target_grade, target_required=target_required, target_dept=target_dept)
-        
-        # 調試：檢查 context 中是否包含計算機結構
-        if '計算機結構' in context:
-            print(f"  ✓ context 中包含計算機結構")
-        else:
-            print(f"  ❌ context 中不包含計算機結構")
-            # 檢查 relevant_courses 中是否有計算機結構
-            for c in relevant_courses:
-                md = c.get('metadata', {})
-                if '計算機結構' in md.get('name', ''):
-                    print(f"  ⚠️ relevant_courses 中有計算機結構，但 context 中沒有")
-                    print(f"      課程名稱: {md.get('name', '')}")
-                    print(f"      課程代碼: {md.get('serial', '')}")
-                    break
+        # 系所 + 必選修 / 年級的清單型查詢，若結果不多就直接產生 deterministic 回覆，省去 LLM 呼叫
+        # （有時間條件時由下方的時間條件分支處理）
+        is_list_query = bool(target_dept) and (
+            (need_required_filter and target_required in ('必', '選')) or bool(target_grade)
+        )
+        if not has_time_condition and is_list_query and 0 < len(relevant_courses) <= n_results:
+            groups = sorted(self._group_courses(relevant_courses), key=lambda g: (g['grade'], g['schedule']))
+            required_labels = self._required_labels(groups, target_grade)
+            # 跨系級課程（必選修為「必|選」）無法判斷對目標年級的狀態時，交給 LLM 依 context 說明
+            if not any(_is_mixed_required(label) for label in required_labels):
+                return self._format_course_list(groups, "嗨！以下是符合你條件的課程：\n", required_labels)
         
         # 若有時間條件，直接用分組結果生成 deterministic 回覆（單一顯示，不進行合併）
-        if time_condition.get('day') or time_condition.get('period'):
+        if has_time_condition:
             # 進一步依系所過濾：優先使用年級欄位，避免誤匹配開課系所
             if target_dept:
                 filtered = []
-                # 定義學院映射關係（確保在確定性模式下也能匹配院級課程）
-                college_mappings = {
-                    '通訊系': ['電機資訊學院', '電資院'],
-                    '資工系': ['電機資訊學院', '電資院'],
-                    '電機系': ['電機資訊學院', '電資院'],
-                    '經濟系': ['社會科學學院', '社科院'],
-                    '社工系': ['社會科學學院', '社科院'],
-                    '社會系': ['社會科學學院', '社科院'],
-                    '法律系': ['法律學院', '法學院'],
-                }
-                college_keywords = college_mappings.get(target_dept, [])
-                
                 for c in relevant_courses:
-                    md = (c.get('metadata', {}) or {})
-                    grade_text = md.get('grade', '')
-                    dept_text = md.get('dept', '')
-                    grade_ok = grade_has_target_dept(grade_text, target_dept) if grade_text else False
-                    # 對於通識課程，需要特殊處理，因為開課系所可能是「通識」、「(進修)通識」、「語文通識」等
-                    if target_dept == '通識':
-                        dept_ok = '通識' in dept_text if dept_text else False
-                    else:
-                        dept_ok = (target_dept.replace('系', '') in dept_text) if dept_text else False
-                    college_ok = any(kw in grade_text for kw in college_keywords) if grade_text else False
-                    
-                    # 當有時間條件時，對於通識課程，檢查年級欄位是否包含「通識」即可
-                    # 因為通識課程可能由不同系所開設（例如「歷史系」、「體育」），但年級欄位中包含「通識」
-                    if target_dept == '通識':
-                        if grade_ok:
-                            # 年級欄位中包含「通識」即可
-                            filtered.append(c)
-                    else:
-                        # 對於其他系所，必須同時滿足：
-                        # 1. 年級欄位中包含目標系所（grade_ok）
-                        # 2. 開課系所也要匹配（dept_ok），避免顯示其他系開設但年級欄位中包含目標系所的課程
-                        # 或者學院級課程（college_ok）
-                        if grade_ok and dept_ok:
-                            # 年級欄位和開課系所都匹配，優先顯示
-                            filtered.append(c)
-                        elif grade_ok and college_ok:
-                            # 學院級課程（例如「電資院1」）也可以匹配
-                            filtered.append(c)
-                    # 不包含只有 grade_ok 或只有 dept_ok 的情況，避免誤匹配
+                    if id(c) in time_dept_checked_ids:
+                        filtered.append(c)
+                        continue
+                    md = c.get('metadata', {}) or {}
+                    if _time_branch_dept_match(md.get('grade', ''), md.get('dept', ''),
+                                               target_dept, target_dept_short, college_pattern):
+                        filtered.append(c)
                 if filtered:
                     relevant_courses = filtered
             # 如果沒有明確系所，但關鍵詞有「體育」，也只保留系所含「體育」
             elif '體育' in user_question:
-                filtered = []
-                for c in relevant_courses:
-                    dept = (c.get('metadata', {}) or {}).get('dept', '')
-                    if '體育' in dept:
-                        filtered.append(c)
+                filtered = [c for c in relevant_courses if '體育' in (c.get('metadata', {}) or {}).get('dept', '')]
                 if filtered:
                     relevant_courses = filtered
 
             groups = self._group_courses(relevant_courses)
-            lines = ["嗨！以下是符合你時間條件的課程：\n"]
-            for g in groups:
-                title_suffix = ""
-                if g['schedule']:
-                    title_suffix += f"（{g['schedule']}）"
-                if g['dept']:
-                    title_suffix += f"［{g['dept']}］"
-                lines.append(f"課程名稱：{g['name']}{title_suffix}")
-                if g['serials']:
-                    lines.append(f"課程代碼：{', '.join(g['serials'])}")
-                if g['teachers']:
-                    # 單一顯示：每個課程單獨顯示，教師以 | 區隔
-                    teachers_list = sorted(g['teachers'])
-                    lines.append(f"授課教師：{'|'.join(teachers_list)}")
-                if g['required']:
-                    lines.append(f"必選修：{g['required']}")
-                if g['schedule']:
-                    lines.append(f"上課時間：{g['schedule']}")
-                if g['grade']:
-                    lines.append(f"年級：{g['grade']}")
-                lines.append("")  # blank line between courses
-            lines.append(f"共找到 {len(groups)} 門課程。")
-            return "\n".join(lines)
+            return self._format_course_list(groups, "嗨！以下是符合你時間條件的課程：\n",
+                                            self._required_labels(groups, target_grade))
         
-        # 4. 建立 prompt
-        system_prompt = """你是一個友善的課程查詢助手，專門協助學生查詢國立臺北大學的課程資訊。
-
-⚠️ 重要規則：
-1. 你必須完全根據提供的「相關課程資料」來回答，絕對不能編造、發明或猜測任何課程資訊
-2. 如果提供的資料中沒有某個資訊，就說「資料中未提供」，不要編造
-3. 只能使用「相關課程資料」中實際存在的課程，不能自己創造課程
-
-【課程回答時的指導原則】
-1. 使用繁體中文回答，語氣自然、像跟同學聊天，簡短問候開頭也可以（不要太長）
-2. 仔細閱讀「相關課程資料」中的每一筆課程資訊
-3. 仔細閱讀課程資料中的必選修資訊：
-   - 課程的必選修狀態可能因不同的年級/組別而不同
-   - 如果課程資料中有「年級組別與必選修對應」，這表示不同組別可能有不同的必選修狀態
-   - 例如：「經濟系1A：選修課程，經濟系1B：選修課程」表示對經濟系1A和1B來說是選修
-   - 如果標記為「✅ 對於 XX，這是必修課程」，表示對該組別來說是必修
-   - 如果標記為「📝 對於 XX，這是選修課程」，表示對該組別來說是選修
-   - 如果「必選修」欄位中包含「必」字（如「必選修：必|必」），且沒有特定組別標記，表示這是必修課程
-   - 如果「必選修」欄位中只有「選」字（如「必選修：選|選」），且沒有特定組別標記，表示這是選修課程
-
-4. 當使用者詢問「XX系XX年級的下午xx節的必/選修課程？」時，基本上分成四個面向:「指定系所」、「指定年級」、「指定必選修」、「指定時間」，針對這些面向細部建立原則:
-   - 系所、組別、年級、時間相關原則:
-     1) 應注重「應修系級」去做判定，因為有些課程老師是某系所，但開的課程可能是其他系所或是通識,應修系級指的就是grade欄位，中文字就是系名(可能是簡稱，法律系可能會包含組別)
-     2) 年級的部分，例如:「通訊3」、「不動1A」、「企管2B」、「法律學系財法組4」，其數字所代表的便是年級。
-     3) 分組問題如不動1A、經濟3B、企管4A等等，有強調英文字母者，代表班別「A班、B班、C班」。
-     4) 分組問題如法律財法組2、法律學系法學組3、法律系司法1，本身便以中文組別分類為班(數字同樣代表年級)。
-     5) 使用者詢問時間相關的問題（例如「週二早上」、「下午」），請只列出符合時間條件的課程:
-        * 如果使用者問「下午」的課程，只顯示節次為5-8節的課程。
-        * 如果使用者問「晚上」的課程，只顯示節次為9-12節的課程。
-        * 如果使用者問「早上」的課程，只顯示節次為1-4節的課程。
-        * 例如:如果使用者問「週二早上」的課程，只顯示上課時間包含「週二」且節次為1-4節的課程。
-        * 若問「平日」則代表周一到周五；若問假日則代表周六、周日。
-        * 若問節數，例如2-3節的課，則須找吻合的課程時間，1-3節雖有包含2-3節，但仍舊視作不吻合，僅能恰好顯示符合要求的範圍。
-
-   - 根據使用者提問課程相關內容，一些重要的原則:
-     1) 特別注意課程資料中是否有針對該年級/組別的必選修標記。
-     2) 例如：如果用戶問「經濟系1A的必修課程」，只顯示標記為「✅ 對於 經濟系1A，這是必修課程」的課程
-     3) 從「相關課程資料」中找出所有符合條件的課程，並列出所有符合條件的課程，不要遺漏。
-     4) 對於每門課程，從「相關課程資料」中提取實際的資訊：課程名稱、課程代碼、教師、上課時間、學分數、年級等
-     5) 如果有多門相同名稱的課程（例如不同教師開的專題製作），請全部列出
-     6) 使用者的輸入可能容易因為簡稱而造成查詢與回答上的錯誤，因此簡易列數個可能問題與概念，助於改善問題:
-        * 學系、系是同樣意思概念，有時候甚至會省略
-        * 法律學系(簡稱法律系、法律)是一個統稱，包含財經法組(或簡稱財法組、財法、財經法)、司法組(或簡稱司法)、法學組(或簡稱法學)
-        * 不動產與城鄉環境學系可能簡稱不動(系)、地政(系)
-        * 金融與合作經營學系，多會簡稱金融(系)
-        * 休閒運動管理學系，多會簡稱休運(系)；企業管理學系，多會簡稱企管(系)
-        * 電機工程學系，多會簡稱電機(系)；通訊工程學系，多會簡稱通訊(系)；資訊工程學系，多會簡稱資工(系)
-        * 公共行政暨政策學系，多會簡稱公行(系)或行政(系)
-        * 社會工作學系，多會簡稱社工(系)
-        * 中國文學系，簡稱中文系；應用外語系，簡稱外語(系)、應外(系)
-        * 師資培育，簡稱師培
-     7) 若提問缺少系所，則代表不分系所顯示；若缺少組別，則不分組別顯示；若缺少年級，則不分年級顯示；若缺少必選修，則不分必選修顯示；若缺少時間，則不分時間顯示。
-     8) 如果課程對不同組別有不同的必選修狀態，可加以說明。
-     9)延續7)，基本上就是有提供的條件一定要在條件內執行，未提供條件限制者，則視作不受限制，該顯示的都要顯示。
-     10)例如:「通訊系星期二早上的課程」，未提及年級代表所有年級都要顯示；未提及必修選修，則必修與選修都要顯示。
-
-5. 課程顯示邏輯與格式（非常重要，必須嚴格遵守）：
-   - 基本格式為:
-       ```
-       課程名稱：科目名稱 / 科目英文名稱
-       課程代碼：UXXXX
-       授課教師：XXX
-       系所：如XX系orXX學系
-       必選修類型：如選修
-       上課時間：如每週五1-2
-       學分數：如3
-       年級：如XX系1
-       ```
-   - 顯示規則（必須執行）：
-        1) 每筆課程都必須單獨顯示，不進行合併。
-        2) 即使課程名稱相同、上課時間相同，也要分開顯示。
-        3) 同一門課有兩個以上的授課老師，則以「|」來區隔，格式如「教師A|教師B|教師C」
-   
-   - 顯示格式：每筆課程必須包含：
-        * 課程名稱、課程代碼（必須是資料中實際的課程代碼）
-        * 授課教師（必須是資料中實際的教師姓名，若有多位教師則以「|」區隔）
-        * 系所、必選修類型（明確標示為「必修」或「選修」，除非資料本身不是標明此兩者）
-        * 上課時間、學分數、年級（必須是資料中實際的資訊）     
-  
-   - 顯示順序：
-        - 先顯示課程名稱不同的課程
-        - 相同課程名稱的，按照上課時間排序
-   
-   - 範例：如果有4個「統計學」課程，都是「每週四2~4」，但教師不同，各自對應的課程代碼是（U1017, U1166, U1011, U1012），則必須分開顯示為4筆：
-       ```
-       課程名稱：統計學 / Statistics
-       課程代碼：U1017
-       授課教師：林定香
-       系所：統計系
-       必選修類型：必修
-       上課時間：每週四2~4
-       學分數：3
-       年級：統計系1
-       
-       課程名稱：統計學 / Statistics
-       課程代碼：U1166
-       授課教師：莊惠菁
-       系所：統計系
-       必選修類型：必修
-       上課時間：每週四2~4
-       學分數：3
-       年級：統計系1
-       ```
-       （以此類推，顯示所有4筆）
-   
-   - 只有在「相關課程資料」中完全沒有任何符合條件的課程時，請回答「查無課程 請重新輸入」。
-  
-   - 可以根據課程限制、選課人數等資訊提供建議。
-   
-   - 重要：計算和顯示課程數量時：
-        * 請按照實際的課程筆數來計算，每筆課程都單獨計算。
-        * 例如：如果有4筆「統計學」課程，加上1筆「電腦概論」課程，總共應該顯示「共找到 5 個符合條件的課程」。
-        * 不要顯示「前 N 個」，而是顯示實際的課程數量
-   
-   - 回覆課程資訊之整體格式：
-        * 先開頭句，含問候。
-        * 依前述格式顯示課程
-        * 課程顯示完後，顯示「共找到 N 個符合條件的課程」。
-        * 有需其他補充資訊或是問候等可以寫在最後面，例如導引使用者查詢課程「如需更多資訊請輸入系所、時間或課程名稱等。
+        # 3. 建立 context（相關課程資訊）
+        # 時間條件與清單型查詢已在上方直接回覆，只有需要 LLM 時才分組並建立 context
+        # 回答一次最多顯示 _MAX_PROMPT_COURSES 筆，超過的課程不必格式化也不送進 prompt
+        if not relevant_courses:
+            return "查無課程 請重新輸入"
+        total_courses = len(relevant_courses)
+        relevant_courses = relevant_courses[:_MAX_PROMPT_COURSES]
+        # 如果有 target_grade，傳遞 target_grade 以便在 context 中顯示所有匹配的年級
+        context = self._build_context(relevant_courses, target_grade=target_grade, target_required=target_required, target_dept=target_dept, max_chars=_CONTEXT_CHAR_BUDGET)
         
-   - 課堂數量限制:
-        * 課程一次最多顯示15筆。
-        * 如果課程數量超過15筆，則僅顯示15筆，並告知課程未完全顯示，並要求提問者修改提問方式，縮小查詢範圍。
-
-   - 課堂範圍限制:
-        * 若系所、應修系級出現北醫大(全名台北醫學大學，或簡稱北醫)、北科大(全名臺北科技大學，或簡稱北科)相關課程，一律不顯示。
-        * 若提問者有提問關於這此兩校，則回應臺北大學以外的學校暫時不在範圍搜尋範圍內。
-        * 若提問者查詢微學程、學士學位學程，也回應暫時不在查詢範圍
-【重要提醒】
-- 當你看到「相關課程資料」中有多筆標記為「✅ 這是必修課程」且系所為「資工系」的課程時，你必須全部列出，不要忽略任何一筆！
-- 絕對不要編造課程資訊！只能使用「相關課程資料」中實際存在的資訊！
-- **極其重要**：你必須列出「相關課程資料」中**所有**符合條件的課程，絕對不能遺漏任何一筆！如果資料中有 4 筆課程，你必須顯示 4 筆；如果有 5 筆，你必須顯示 5 筆。不要因為任何原因（如格式、長度等）而省略任何課程！"""
+        # 調試：檢查 context 中是否包含計算機結構
+        if _DEBUG_COURSE_TRACE:
+            if '計算機結構' in context:
+                print(f"  ✓ context 中包含計算機結構")
+            else:
+                print(f"  ❌ context 中不包含計算機結構")
+                # 檢查 relevant_courses 中是否有計算機結構
+                for c in relevant_courses:
+                    md = c.get('metadata', {})
+                    if '計算機結構' in md.get('name', ''):
+                        print(f"  ⚠️ relevant_courses 中有計算機結構，但 context 中沒有")
+                        print(f"      課程名稱: {md.get('name', '')}")
+                        print(f"      課程代碼: {md.get('serial', '')}")
+                        break
+        
+        # 4. 建立 prompt
+        system_prompt = _build_system_prompt(user_question, relevant_courses)
         
         # 提取所有課程名稱，用於在 prompt 中明確列出
         course_names_list = []
@@ -1601,11 +2092,15 @@ class CourseQuerySystem:
         
         course_names_str = '、'.join(course_names_list) if course_names_list else '無'
         
+        truncated_hint = ""
+        if total_courses > len(relevant_courses):
+            truncated_hint = f"\n（實際共有 {total_courses} 筆符合條件的課程，以上僅提供前 {len(relevant_courses)} 筆，請告知使用者課程未完全顯示，並建議縮小查詢範圍）\n"
+        
         user_prompt = f"""使用者問題：{user_question}
 
 以下是相關課程資料（已過濾出符合條件的課程，共 {len(relevant_courses)} 筆）：
 {context}
-
+{truncated_hint}
 **極其重要**：以上資料中共有 {len(relevant_courses)} 筆符合條件的課程，課程名稱分別為：{course_names_str}。
 
 你必須**全部**列出這 {len(relevant_courses)} 筆課程，絕對不能遺漏任何一筆！請按照以下順序逐一檢查並顯示：
@@ -1630,30 +2125,25 @@ class CourseQuerySystem:
 """
 
         
-        # 4. 呼叫 LLM 生成回答
-        try:
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",  # 可以使用 gpt-4o 或 gpt-3.5-turbo
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.1,  # 極低溫度以嚴格遵循格式要求
-                max_tokens=4000  # 增加 tokens 以確保能顯示所有課程資訊
-            )
-            
-            answer = response.choices[0].message.content
-            return answer
-        
-        except Exception as e:
-            return f"❌ 查詢時發生錯誤：{str(e)}"
+        # 4. 組出 LLM 呼叫參數（由 _answer_question / query_stream 實際送出）
+        return {
+            "model": "gpt-4o-mini",  # 可以使用 gpt-4o 或 gpt-3.5-turbo
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "temperature": 0.1,  # 極低溫度以嚴格遵循格式要求
+            # 依實際送出的課程數估算回答長度，課程少時不必保留整個上限
+            "max_tokens": min(_MAX_ANSWER_TOKENS, _ANSWER_BASE_TOKENS + _ANSWER_TOKENS_PER_COURSE * len(relevant_courses))
+        }
     
-    def _build_context(self, courses: List[Dict], target_grade: Optional[str] = None, target_required: Optional[str] = None, target_dept: Optional[str] = None) -> str:
+    def _build_context(self, courses: List[Dict], target_grade: Optional[str] = None, target_required: Optional[str] = None, target_dept: Optional[str] = None, max_chars: Optional[int] = None) -> str:
         """
         將檢索到的課程資料格式化為 context
         
         Args:
             courses: 檢索到的課程列表
+            max_chars: context 字數上限；超過時優先捨棄 hybrid_score 最低的課程
             
         Returns:
             格式化的 context 文字
@@ -1662,70 +2152,37 @@ class CourseQuerySystem:
             return "未找到相關課程。"
         
         grouped = self._group_courses(courses)
-        context_parts = []
-        for i, info in enumerate(grouped, 1):
-            context_parts.append(f"\n【課程 {i}】")
-            title_suffix = ""
-            if info['schedule']:
-                title_suffix += f"（{info['schedule']}）"
-            if info['dept']:
-                title_suffix += f"［{info['dept']}］"
-            if info['name']:
-                context_parts.append(f"課程名稱：{info['name']}{title_suffix}")
-            if info['serials']:
-                context_parts.append(f"課程代碼：{', '.join(info['serials'])}")
-            if info['teachers']:
-                # 單一顯示：每個課程單獨顯示，教師以 | 區隔
-                teachers_list = sorted(info['teachers'])
-                context_parts.append(f"授課教師：{'|'.join(teachers_list)}")
-            if info['dept']:
-                context_parts.append(f"系所：{info['dept']}")
-            if info['required']:
-                context_parts.append(f"必選修：{info['required']}")
-            if info['schedule']:
-                context_parts.append(f"上課時間：{info['schedule']}")
-            if info['grade']:
-                context_parts.append(f"年級：{info['grade']}")
+        # 每門課程各自組成一個區塊，最後再依字數上限挑選並以 join 串接
+        blocks = []
+        scores = []
+        # 內容完全相同的課程（重複的檢索結果）只放入一次，節省 prompt token
+        seen_documents = set()
+        # 只與查詢條件有關的判斷在迴圈外計算一次
+        law_target_num = _law_target_num(target_grade) if target_grade else None
+        is_law_dept = bool(target_dept) and '法律' in target_dept
+        for info in grouped:
             document_combined = "\n".join(info['documents'])
+            if document_combined:
+                if document_combined in seen_documents:
+                    continue
+                seen_documents.add(document_combined)
+            context_parts = [_course_title_line(info)] if info['name'] else []
+            context_parts.extend(_course_field_lines(info, include_dept=True))
             show_required = info['required']
             if not show_required and '必選修：' in document_combined:
-                import re
-                match = re.search(r'必選修：([^\n]+)', document_combined)
-                if match:
-                    show_required = match.group(1).strip()
+                show_required = extract_document_field(document_combined, '必選修：') or show_required
             
-            # 取得詳細的必選修對應資訊
-            mapping_info = get_grade_required_info(info)
-            req_groups = mapping_info.get('required_groups', [])
-            ele_groups = mapping_info.get('elective_groups', [])
+            # 取得詳細的必選修對應資訊（指定年級時改用年級判斷，不需要）
+            if target_grade:
+                req_groups = ele_groups = []
+            else:
+                mapping_info = get_grade_required_info(info)
+                req_groups = mapping_info.get('required_groups', [])
+                ele_groups = mapping_info.get('elective_groups', [])
             
             if target_grade:
                 # 如果有指定年級，嘗試判斷該年級的必選修狀態
-                status = None
-                dummy_course = {
-                    'grade': info['grade'],
-                    'required': info['required'],
-                    'grade_required_mapping': info.get('grade_required_mapping', '')
-                }
-                status = check_grade_required_from_json(dummy_course, target_grade)
-                if not status:
-                    status = check_grade_required(dummy_course, target_grade)
-                
-                # 特殊處理：法律系 fallback
-                if not status and '法律' in target_grade:
-                    try:
-                        m_data = json.loads(info.get('grade_required_mapping', '{}'))
-                        mapping = m_data.get('mapping', [])
-                        import re
-                        num_match = re.search(r'\d+', target_grade)
-                        target_num = num_match.group(0) if num_match else ''
-                        for g_item, r_item in mapping:
-                            if any(k in g_item for k in ['法學', '司法', '財法', '法律']):
-                                if not target_num or target_num in g_item:
-                                    status = '必' if '必' in r_item else '選' if '選' in r_item else r_item
-                                    break
-                    except:
-                        pass
+                status = _target_grade_status(info, target_grade, law_target_num)
                 
                 if status == '必':
                         context_parts.append(f"✅ 對於 {target_grade}，這是必修課程")
@@ -1736,10 +2193,10 @@ class CourseQuerySystem:
             
             elif target_dept:
                 # 如果有指定系所（但無年級），顯示該系所的必選修狀態
-                if '法律' in target_dept:
+                if is_law_dept:
                     # 法律系統籌：顯示所有法律相關組別（法學、司法、財法）
-                    dept_reqs = [g for g in req_groups if any(k in g for k in ['法學', '司法', '財法', '法律'])]
-                    dept_eles = [g for g in ele_groups if any(k in g for k in ['法學', '司法', '財法', '法律'])]
+                    dept_reqs = [g for g in req_groups if _LAW_GROUP_RE.search(g)]
+                    dept_eles = [g for g in ele_groups if _LAW_GROUP_RE.search(g)]
                 else:
                     dept_reqs = [g for g in req_groups if target_dept in g]
                     dept_eles = [g for g in ele_groups if target_dept in g]
@@ -1771,39 +2228,110 @@ class CourseQuerySystem:
                         context_parts.append(f"📝 這是選修課程（必選修：{show_required}）")
             
             context_parts.append(document_combined)
-        return "\n".join(context_parts)
+            blocks.append("\n".join(context_parts))
+            scores.append(info['hybrid_score'])
+        
+        keep = range(len(blocks))
+        if max_chars is not None:
+            total_chars = sum(len(block) for block in blocks)
+            if total_chars > max_chars:
+                # 分數相同時先捨棄排序較後面的課程
+                dropped = set()
+                by_score = sorted(range(len(blocks)), key=lambda idx: (scores[idx], -idx))
+                for idx in by_score:
+                    if total_chars <= max_chars or len(dropped) == len(blocks) - 1:
+                        break
+                    dropped.add(idx)
+                    total_chars -= len(blocks[idx])
+                keep = [idx for idx in range(len(blocks)) if idx not in dropped]
+        
+        return "\n".join(f"\n【課程 {i}】\n{blocks[idx]}" for i, idx in enumerate(keep, 1))
+
+    def _required_labels(self, groups: List[Dict], target_grade: Optional[str]) -> List[str]:
+        """
+        各課程「必選修」欄位的顯示值：有指定年級且能判斷狀態時顯示該年級的必選修（與 _build_context 相同），
+        否則沿用課程原本的必選修欄位
+        
+        Args:
+            groups: _group_courses 的結果
+            target_grade: 目標年級
+            
+        Returns:
+            與 groups 順序相同的顯示值列表
+        """
+        law_target_num = _law_target_num(target_grade) if target_grade else None
+        labels = []
+        for g in groups:
+            status = _target_grade_status(g, target_grade, law_target_num) if target_grade else None
+            if status == '必':
+                labels.append(f"必修（對於 {target_grade}）")
+            elif status == '選':
+                labels.append(f"選修（對於 {target_grade}）")
+            else:
+                labels.append(g['required'])
+        return labels
+
+    def _format_course_list(self, groups: List[Dict], header: str, required_labels: Optional[List[str]] = None) -> str:
+        """
+        將分組後的課程直接排版成回覆文字（不經過 LLM）
+        
+        Args:
+            groups: _group_courses 的結果
+            header: 回覆開頭的問候語
+            required_labels: _required_labels 的結果；None 時顯示課程原本的必選修欄位
+            
+        Returns:
+            格式化的回覆文字
+        """
+        lines = [header]
+        for i, g in enumerate(groups):
+            lines.append(_course_title_line(g))
+            lines.extend(_course_field_lines(g, required=required_labels[i] if required_labels is not None else None))
+            lines.append("")  # blank line between courses
+        lines.append(f"共找到 {len(groups)} 門課程。")
+        return "\n".join(lines)
 
     def _group_courses(self, courses: List[Dict]) -> List[Dict]:
-        """將課程轉換為單一顯示格式（不進行合併）"""
+        """將課程轉換為單一顯示格式（不進行合併；序號與內容皆相同的重複結果只保留第一筆）"""
         result = []
+        seen = set()
         for course in courses:
             metadata = course.get('metadata', {}) or {}
             document = course.get('document', '') or ''
-            name = metadata.get('name', '')
-            dept = metadata.get('dept', '').strip() if metadata.get('dept') else ''
-            schedule = metadata.get('schedule', '').strip() if metadata.get('schedule') else ''
             serial = metadata.get('serial', '')
+            if serial or document:
+                key = (serial, document)
+                if key in seen:
+                    continue
+                seen.add(key)
+            name = metadata.get('name', '')
+            dept = (metadata.get('dept') or '').strip()
+            schedule = (metadata.get('schedule') or '').strip()
             teacher = metadata.get('teacher', '')
             required = metadata.get('required', '')
             grade = metadata.get('grade', '')
             mapping_json = metadata.get('grade_required_mapping', '')
             
             if not schedule and document:
-                import re
-                m = re.search(r'上課時間：([^\n]+)', document)
-                if m:
-                    schedule = m.group(1).strip()
+                schedule = extract_document_field(document, '上課時間：') or schedule
             
+            serials = [serial] if serial else []
+            teachers = {teacher} if teacher else set()
             result.append({
-                    'name': name,
-                    'schedule': schedule,
-                    'dept': dept,
-                'serials': [serial] if serial else [],
-                'teachers': {teacher} if teacher else set(),
-                    'required': required,
-                    'grade': grade,
+                'name': name,
+                'schedule': schedule,
+                'dept': dept,
+                'serials': serials,
+                'teachers': teachers,
+                'required': required,
+                'grade': grade,
                 'documents': [document],
-                'grade_required_mapping': mapping_json
+                'grade_required_mapping': mapping_json,
+                'hybrid_score': course.get('hybrid_score') or 0.0,
+                # 預先組好顯示用字串；單一顯示：每個課程單獨顯示，教師以 | 區隔
+                'serials_display': ', '.join(serials),
+                'teachers_display': '|'.join(sorted(teachers)),
+                'title_suffix': (f"（{schedule}）" if schedule else "") + (f"［{dept}］" if dept else "")
             })
         return result
 
@@ -3,10 +3,19 @@ RAG 系統：將課程資料向量化並建立向量資料庫
 使用 ChromaDB 作為向量資料庫，OpenAI Embeddings 進行向量化
 支援單表和多表結構
 """
+from __future__ import annotations
+
 import sqlite3
 import json
+import hashlib
+import heapq
 import os
-from typing import List, Dict, Optional
+import pickle
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import List, Dict, Optional, Tuple, Union
 from dotenv import load_dotenv
 
 # 載入環境變數
@@ -18,6 +27,256 @@ from openai import OpenAI
 from rank_bm25 import BM25Okapi
 import jieba
 
+from utils import load_mapping_json
+
+# Embedding 模型與向量維度：text-embedding-3-small 支援以 dimensions 參數截短（已重新正規化）
+_EMBEDDING_MODEL = "text-embedding-3-small"
+_EMBEDDING_DIMENSIONS = 512
+# 未記錄維度的舊 collection 以完整 1536 維建立
+_LEGACY_EMBEDDING_DIMENSIONS = 1536
+# 新建 collection 的 metadata（記錄向量維度，查詢時以相同維度向量化）
+_COLLECTION_METADATA = MappingProxyType({
+    "description": "NTPU Courses RAG System",
+    "embedding_dimensions": _EMBEDDING_DIMENSIONS,
+})
+# collection metadata 中記錄課程資料版本的欄位：建立或更新向量資料庫後寫入新值，
+# 查詢端（CourseQuerySystem）據此判斷快照與回答快取是否過期
+_DATA_VERSION_KEY = "data_version"
+# 建立向量資料庫時同時送出的 embeddings 請求數
+_EMBEDDING_WORKERS = 8
+# 遇到速率限制（HTTP 429）時的最大重試次數與初始等待秒數（每次加倍）
+_EMBEDDING_MAX_RETRIES = 5
+_EMBEDDING_RETRY_DELAY = 1.0
+# 查詢向量快取筆數上限（LRU）
+_QUERY_EMBEDDING_CACHE_SIZE = 2048
+# 課程文字格式版本；修改 _create_course_text 的輸出格式時請遞增，使 course_texts 表中的舊文字失效
+_COURSE_TEXT_VERSION = 1
+# SQLite 連線層級的效能設定（只影響本連線，不改變資料庫檔案的 journal 模式）
+_SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+)
+# 多表結構的課程彙整查詢（JOIN 各表並以 GROUP_CONCAT 合併系所、教師與年級）
+_MULTI_TABLE_COURSES_SQL = """
+    SELECT DISTINCT
+        c.yearterm,
+        c.serial,
+        c.name,
+        c.note,
+        c.category,
+        c.credit,
+        c.hours,
+        c.language,
+        c.schedule,
+        c.addable,
+        c.add_limit,
+        c.total_limit,
+        c.enrolled,
+        c.syllabus_url,
+        c.limit_url,
+        c.limits_json,
+        c.edu_type,
+        c.crawl_time,
+        GROUP_CONCAT(DISTINCT d.name) as dept,
+        GROUP_CONCAT(DISTINCT t.name) as teacher,
+        GROUP_CONCAT(DISTINCT cg.grade || '|' || cg.required) as grade_required,
+        MAX(cg.grade_required_mapping) as grade_required_mapping
+    FROM courses_normalized c
+    LEFT JOIN course_departments cd ON c.yearterm = cd.yearterm
+        AND c.serial = cd.serial
+        AND c.edu_type = cd.edu_type
+    LEFT JOIN departments d ON cd.dept_id = d.id
+    LEFT JOIN course_teachers ct ON c.yearterm = ct.yearterm
+        AND c.serial = ct.serial
+        AND c.edu_type = ct.edu_type
+    LEFT JOIN teachers t ON ct.teacher_id = t.id
+    LEFT JOIN course_grades cg ON c.yearterm = cg.yearterm
+        AND c.serial = cg.serial
+        AND c.edu_type = cg.edu_type
+    GROUP BY c.yearterm, c.serial, c.edu_type
+"""
+# 來源表有任何異動時，彙整表需重新建立
+_MULTI_TABLE_SOURCE_TABLES = (
+    'courses_normalized',
+    'course_departments',
+    'departments',
+    'course_teachers',
+    'teachers',
+    'course_grades',
+)
+# 從 SQLite 分批讀取資料列的批次大小
+_FETCH_BATCH_SIZE = 1000
+# Reciprocal Rank Fusion 的平滑常數（常用值 60）
+_RRF_K = 60
+
+
+def _iter_rows(cur: sqlite3.Cursor, size: int = _FETCH_BATCH_SIZE):
+    """
+    以 fetchmany 分批讀取查詢結果，避免 fetchall 一次保留整份結果
+    """
+    while True:
+        batch = cur.fetchmany(size)
+        if not batch:
+            return
+        yield from batch
+
+
+def _build_postings(tokenized_docs: List[List[str]]) -> Dict[str, Tuple[int, ...]]:
+    """
+    建立倒排索引：詞 -> 含有該詞的文件索引（遞增）
+    """
+    postings: Dict[str, List[int]] = {}
+    for i, tokens in enumerate(tokenized_docs):
+        for term in set(tokens):
+            postings.setdefault(term, []).append(i)
+    return {term: tuple(doc_indices) for term, doc_indices in postings.items()}
+
+
+def _documents_fingerprint(doc_ids: List[str], documents: List[str]) -> str:
+    """
+    文件 ID 與內容的指紋（與順序無關），用來確認 BM25 索引快取檔與 collection 內容一致
+    
+    Returns:
+        十六進位雜湊字串
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for doc_id, document in sorted(zip(doc_ids, documents)):
+        digest.update(doc_id.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update((document or '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+# JSON 解析或欄位格式不符時會出現的例外（json/orjson 的解析錯誤皆為 ValueError 子類別）
+_JSON_FIELD_ERRORS = (ValueError, TypeError, AttributeError)
+
+
+def _has_json_object(text) -> bool:
+    """
+    判斷欄位是否可能是 JSON 物件；空字串、None 或非物件格式直接略過，不呼叫 json.loads
+    """
+    return isinstance(text, str) and text.startswith('{')
+
+
+def _mapping_text(mapping_json: str) -> str:
+    """
+    將 grade_required_mapping JSON 轉成課程文字中的「年級組別與必選修對應」段落
+    
+    Returns:
+        多行文字；沒有對應資料時為空字串
+    """
+    if not _has_json_object(mapping_json):
+        return ''
+    lines = []
+    try:
+        mapping_data = load_mapping_json(mapping_json)
+        mapping = mapping_data.get('mapping', [])
+        
+        if mapping:
+            lines.append("年級組別與必選修對應：")
+            for grade_item, required_item in mapping:
+                if '必' in required_item:
+                    lines.append(f"  {grade_item}：必修課程")
+                elif '選' in required_item:
+                    lines.append(f"  {grade_item}：選修課程")
+                else:
+                    lines.append(f"  {grade_item}：{required_item}")
+            
+            # 統計資訊
+            required_groups = mapping_data.get('required_groups', [])
+            elective_groups = mapping_data.get('elective_groups', [])
+            if required_groups:
+                lines.append(f"必修組別：{', '.join(required_groups[:10])}")  # 只顯示前10個
+            if elective_groups:
+                lines.append(f"選修組別：{', '.join(elective_groups[:10])}")  # 只顯示前10個
+    except _JSON_FIELD_ERRORS:
+        pass
+    return "\n".join(lines)
+
+
+def _required_text(required: str) -> str:
+    """
+    將必選修欄位轉成更明確的課程文字標示
+    
+    Returns:
+        文字標示；欄位為空時為空字串
+    """
+    if not required:
+        return ''
+    if '必' in required:
+        return "必選修：必修課程\n課程類型：必修"
+    if '選' in required:
+        return "必選修：選修課程\n課程類型：選修"
+    return f"必選修：{required}"
+
+
+def _limits_text(limits_json: str) -> str:
+    """
+    將 limits_json 轉成「課程限制」文字
+    
+    Returns:
+        文字描述；沒有限制或無法解析時為空字串
+    """
+    # 多數課程沒有限制（"{}"），不需解析
+    if not _has_json_object(limits_json) or limits_json == '{}':
+        return ''
+    try:
+        limits = json.loads(limits_json)
+        if not limits:
+            return ''
+        return "課程限制：" + "".join(f"{key}：{value}；" for key, value in limits.items())
+    except _JSON_FIELD_ERRORS:
+        return ''
+
+
+def _course_source_hash(course: Dict) -> str:
+    """
+    課程來源資料列所有欄位的雜湊，用來判斷 course_texts 表中的文字是否過期
+    
+    不依賴 crawl_time：以 ALTER TABLE 補上的欄位（例如 grade_required_mapping）或多表結構中
+    系所、教師、年級表的異動都不會更新 crawl_time，但會改變這裡的雜湊。
+    
+    Returns:
+        十六進位雜湊字串
+    """
+    payload = json.dumps(course, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _metadata_hash(metadata: Dict) -> str:
+    """
+    向量資料庫 metadata 的雜湊（與鍵的順序無關），用來判斷增量更新時 metadata 是否有變動
+    
+    Returns:
+        十六進位雜湊字串
+    """
+    payload = json.dumps(metadata, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _metadata_with_removed_keys(metadata: Dict, old_metadata: Dict) -> Dict:
+    """
+    ChromaDB 更新既有文件時會與原本的 metadata 合併：將新 metadata 中已不存在的舊欄位設為 None，
+    寫入後即會刪除這些欄位
+    
+    Args:
+        metadata: 新的 metadata
+        old_metadata: 向量資料庫中原本的 metadata
+        
+    Returns:
+        可直接交給 upsert / update 的 metadata
+    """
+    return {**{key: None for key in old_metadata if key not in metadata}, **metadata}
+
+
+def _course_doc_id(metadata: Dict) -> str:
+    """
+    依課程資料組出向量資料庫中的文件 ID（學期_課號_學制）
+    """
+    return f"{metadata.get('yearterm', '')}_{metadata.get('serial', '')}_{metadata.get('edu_type', '')}"
+
 class CourseRAGSystem:
     def __init__(self, db_path: str = "ntpu_courses.db", collection_name: str = "ntpu_courses", use_multi_table: bool = False):
         """
@@ -37,6 +296,8 @@ class CourseRAGSystem:
         if not api_key:
             raise ValueError("請設定 OPENAI_API_KEY 環境變數")
         self.openai_client = OpenAI(api_key=api_key)
+        # 查詢文字 -> 向量（LRU），重複的查詢不再呼叫 OpenAI
+        self._query_embedding_cache: "OrderedDict[str, List[float]]" = OrderedDict()
         
         # 初始化 ChromaDB
         self.chroma_client = chromadb.PersistentClient(
@@ -51,18 +312,52 @@ class CourseRAGSystem:
         except:
             self.collection = self.chroma_client.create_collection(
                 name=collection_name,
-                metadata={"description": "NTPU Courses RAG System"}
+                metadata=dict(_COLLECTION_METADATA)
             )
             print(f"✅ 已建立新的 collection: {collection_name}")
+        self.embedding_dimensions = self._collection_embedding_dimensions()
         
         # BM25 索引（延遲初始化）
         self.bm25_index = None
         self.bm25_documents = []  # 儲存所有文件用於 BM25
         self.bm25_doc_ids = []  # 儲存文件 ID 對應關係
+        self.bm25_doc_positions = {}  # 文件 ID -> BM25 分數索引
+        self.bm25_postings = {}  # 詞 -> 含有該詞的文件索引（倒排索引，RRF 只需為候選文件計分）
+        # BM25 索引快取檔（與向量資料庫放在一起，避免每次啟動重新分詞）
+        self.bm25_index_path = os.path.join("./chroma_db", f"bm25_{collection_name}.pkl")
         
-        # 混合檢索權重（可調整）
+        # 混合檢索融合方式：'rrf'（Reciprocal Rank Fusion，預設）或 'linear'（加權分數）
+        self.fusion_method = 'rrf'
+        self.rrf_k = _RRF_K
+        
+        # 線性融合權重（fusion_method='linear' 時使用，可調整）
         self.embedding_weight = 0.6  # Embedding 權重
         self.bm25_weight = 0.4  # BM25 權重
+        
+        # SQLite 連線（第一次存取課程資料時才建立，之後重複使用）
+        self._db_conn: Optional[sqlite3.Connection] = None
+    
+    def _get_db_connection(self) -> sqlite3.Connection:
+        """
+        取得共用的 SQLite 連線；第一次呼叫時建立並套用 PRAGMA 設定
+        
+        Returns:
+            SQLite 連線
+        """
+        if self._db_conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            for pragma in _SQLITE_PRAGMAS:
+                conn.execute(pragma)
+            self._db_conn = conn
+        return self._db_conn
+    
+    def close(self):
+        """
+        關閉 SQLite 連線
+        """
+        if self._db_conn is not None:
+            self._db_conn.close()
+            self._db_conn = None
     
     def _load_courses_from_db(self) -> List[Dict]:
         """
@@ -71,85 +366,145 @@ class CourseRAGSystem:
         Returns:
             課程資料列表
         """
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
+        cur = self._get_db_connection().cursor()
         
         if self.use_multi_table:
-            # 使用多表結構（從 course_full_view 視圖）
+            # 使用多表結構（從預先彙整好的 course_full_materialized 表）
             print("📖 從多表結構載入課程資料...")
-            cur.execute("""
-                SELECT DISTINCT
-                    c.yearterm,
-                    c.serial,
-                    c.name,
-                    c.note,
-                    c.category,
-                    c.credit,
-                    c.hours,
-                    c.language,
-                    c.schedule,
-                    c.addable,
-                    c.add_limit,
-                    c.total_limit,
-                    c.enrolled,
-                    c.syllabus_url,
-                    c.limit_url,
-                    c.limits_json,
-                    c.edu_type,
-                    c.crawl_time,
-                    GROUP_CONCAT(DISTINCT d.name) as dept,
-                    GROUP_CONCAT(DISTINCT t.name) as teacher,
-                    GROUP_CONCAT(DISTINCT cg.grade || '|' || cg.required) as grade_required,
-                    MAX(cg.grade_required_mapping) as grade_required_mapping
-                FROM courses_normalized c
-                LEFT JOIN course_departments cd ON c.yearterm = cd.yearterm 
-                    AND c.serial = cd.serial 
-                    AND c.edu_type = cd.edu_type
-                LEFT JOIN departments d ON cd.dept_id = d.id
-                LEFT JOIN course_teachers ct ON c.yearterm = ct.yearterm 
-                    AND c.serial = ct.serial 
-                    AND c.edu_type = ct.edu_type
-                LEFT JOIN teachers t ON ct.teacher_id = t.id
-                LEFT JOIN course_grades cg ON c.yearterm = cg.yearterm 
-                    AND c.serial = cg.serial 
-                    AND c.edu_type = cg.edu_type
-                GROUP BY c.yearterm, c.serial, c.edu_type
-            """)
+            self._refresh_multi_table_courses()
+            cur.execute("SELECT * FROM course_full_materialized")
         else:
             # 使用單表結構（從 courses 表）
             print("📖 從單表結構載入課程資料...")
             cur.execute("SELECT * FROM courses")
         
-        courses = cur.fetchall()
-        conn.close()
+        # 欄位名稱只取一次，再以 zip 組成字典（避免每列 dict(Row) 重新處理欄位名稱）
+        cols = [d[0] for d in cur.description]
+        courses_dict = [dict(zip(cols, row)) for row in _iter_rows(cur)]
+        cur.close()
         
-        # 將 Row 物件轉換為字典
-        courses_dict = []
-        for course in courses:
-            course_dict = dict(course)
+        # 處理多表結構的 grade 和 required
+        if self.use_multi_table and 'grade_required' in cols:
+            for course_dict in courses_dict:
+                grade_required_str = course_dict['grade_required']
+                if not grade_required_str:
+                    continue
+                # 解析 grade_required 字串（格式：grade1|required1,grade2|required2）
+                grades = []
+                requireds = []
+                for part in grade_required_str.split(','):
+                    g, sep, r = part.partition('|')
+                    if sep:
+                        grades.append(g.strip())
+                        requireds.append(r.strip())
+                
+                if grades:
+                    course_dict['grade'] = '|'.join(grades)
+                    course_dict['required'] = '|'.join(requireds)
+        
+        return courses_dict
+    
+    def _refresh_multi_table_courses(self):
+        """
+        來源表有異動（或尚未建立）時，重新建立多表結構的彙整表
+        """
+        conn = self._get_db_connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS materialized_state (name TEXT PRIMARY KEY, stale INTEGER NOT NULL)")
+        row = conn.execute(
+            "SELECT stale FROM materialized_state WHERE name = 'course_full_materialized'"
+        ).fetchone()
+        if row is None or row[0]:
+            self.materialize_multi_table_courses()
+    
+    def materialize_multi_table_courses(self):
+        """
+        將多表結構的 JOIN + GROUP_CONCAT 彙整結果寫入 course_full_materialized 表，
+        並在來源表建立 trigger：來源表異動時標記彙整表過期，下次載入時自動重建
+        """
+        print("🔄 建立多表結構彙整表...")
+        conn = self._get_db_connection()
+        if conn.in_transaction:
+            conn.commit()
+        # 所有步驟在同一個交易中完成：任一步失敗時整批 rollback，不會留下指向不存在的
+        # materialized_state 的 trigger（否則之後對來源表的任何寫入都會失敗）
+        conn.execute("BEGIN")
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS materialized_state (name TEXT PRIMARY KEY, stale INTEGER NOT NULL)")
+            conn.execute("DROP TABLE IF EXISTS course_full_materialized")
+            conn.execute(f"CREATE TABLE course_full_materialized AS {_MULTI_TABLE_COURSES_SQL}")
+            conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_course_full_materialized "
+                "ON course_full_materialized (yearterm, serial, edu_type)"
+            )
+            for table in _MULTI_TABLE_SOURCE_TABLES:
+                for op in ('INSERT', 'UPDATE', 'DELETE'):
+                    conn.execute(f"""
+                        CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_invalidate_course_full
+                        AFTER {op} ON {table}
+                        BEGIN
+                            UPDATE materialized_state SET stale = 1 WHERE name = 'course_full_materialized';
+                        END
+                    """)
+            conn.execute("INSERT OR REPLACE INTO materialized_state VALUES ('course_full_materialized', 0)")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+    
+    def _get_course_texts(self, courses: List[Dict]) -> List[str]:
+        """
+        取得課程文字描述；來源資料列未變動（_course_source_hash 相同）時沿用 course_texts 表中已產生的文字，
+        只有新課程或任一欄位有變動的課程才重新呼叫 _create_course_text 並寫回
+        
+        Args:
+            courses: 課程資料列表
             
-            # 處理多表結構的 grade 和 required
-            if self.use_multi_table and 'grade_required' in course_dict:
-                grade_required_str = course_dict.get('grade_required', '')
-                if grade_required_str:
-                    # 解析 grade_required 字串（格式：grade1|required1,grade2|required2）
-                    parts = grade_required_str.split(',')
-                    grades = []
-                    requireds = []
-                    for part in parts:
-                        if '|' in part:
-                            g, r = part.split('|', 1)
-                            grades.append(g.strip())
-                            requireds.append(r.strip())
-                    
-                    if grades and requireds:
-                        course_dict['grade'] = '|'.join(grades)
-                        course_dict['required'] = '|'.join(requireds)
+        Returns:
+            與 courses 順序相同的課程文字列表
+        """
+        source = 'multi' if self.use_multi_table else 'single'
+        conn = self._get_db_connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS course_texts (
+                yearterm TEXT,
+                serial TEXT,
+                edu_type TEXT,
+                source TEXT,
+                text_key TEXT,
+                course_text TEXT,
+                PRIMARY KEY (yearterm, serial, edu_type, source)
+            )
+        """)
+        cached: Dict[Tuple[str, str, str], Tuple[str, str]] = {
+            (yearterm, serial, edu_type): (text_key, course_text)
+            for yearterm, serial, edu_type, text_key, course_text in conn.execute(
+                "SELECT yearterm, serial, edu_type, text_key, course_text FROM course_texts WHERE source = ?",
+                (source,)
+            )
+        }
+        
+        texts = []
+        updates = []
+        regenerated = 0
+        for course in courses:
+            row_key = (course.get('yearterm'), course.get('serial'), course.get('edu_type'))
+            text_key = f"{_COURSE_TEXT_VERSION}:{_course_source_hash(course)}"
+            hit = cached.get(row_key)
+            if hit is not None and hit[0] == text_key:
+                texts.append(hit[1])
+                continue
             
-            courses_dict.append(course_dict)
+            course_text = self._create_course_text(course)
+            texts.append(course_text)
+            regenerated += 1
+            updates.append((*row_key, source, text_key, course_text))
         
-        return courses_dict
+        if updates:
+            conn.executemany("INSERT OR REPLACE INTO course_texts VALUES (?, ?, ?, ?, ?, ?)", updates)
+            conn.commit()
+        
+        print(f"📝 課程文字：沿用 {len(texts) - regenerated} 筆，重新產生 {regenerated} 筆")
+        return texts
     
     def _create_course_text(self, course: Dict) -> str:
         """
@@ -161,121 +516,327 @@ class CourseRAGSystem:
         Returns:
             格式化的課程文字描述
         """
-        text_parts = []
+        get = course.get
+        grade = get('grade', '')
+        category = get('category', '')
+        hours = get('hours', '')
+        language = get('language', '')
+        note = get('note')
         
-        # 基本資訊
-        text_parts.append(f"課程名稱：{course.get('name', '')}")
-        text_parts.append(f"課程代碼：{course.get('serial', '')}")
-        text_parts.append(f"學年度學期：{course.get('yearterm', '')}")
-        text_parts.append(f"系所：{course.get('dept', '')}")
+        # 空字串代表該欄位不輸出
+        text_parts = (
+            # 基本資訊
+            f"課程名稱：{get('name', '')}",
+            f"課程代碼：{get('serial', '')}",
+            f"學年度學期：{get('yearterm', '')}",
+            f"系所：{get('dept', '')}",
+            f"年級：{grade}" if grade else '',
+            # 必選修資訊（重點加強）：優先使用 grade_required_mapping JSON 欄位，再加上傳統的必選修欄位
+            _mapping_text(get('grade_required_mapping', '')),
+            _required_text(get('required', '')),
+            f"授課教師：{get('teacher', '')}",
+            f"課程類別：{category}" if category else '',
+            f"學分數：{get('credit', '')}",
+            f"時數：{hours}" if hours else '',
+            f"授課語言：{language}" if language else '',
+            f"上課時間：{get('schedule', '')}",
+            f"學制：{get('edu_type', '')}",
+            f"備註：{note}" if note else '',
+            _limits_text(get('limits_json', '')),
+            # 選課資訊
+            f"可加選：{get('addable', '')}",
+            f"加選人數上限：{get('add_limit', '')}",
+            f"總人數上限：{get('total_limit', '')}",
+            f"已選人數：{get('enrolled', '')}",
+        )
+        return "\n".join(part for part in text_parts if part)
+    
+    def _collection_embedding_dimensions(self) -> int:
+        """
+        取得目前 collection 建立時使用的向量維度
         
-        # 年級資訊
-        grade = course.get('grade', '')
-        if grade:
-            text_parts.append(f"年級：{grade}")
+        Returns:
+            向量維度（舊版 collection 未記錄時為 1536）
+        """
+        metadata = getattr(self.collection, 'metadata', None) or {}
+        return metadata.get('embedding_dimensions', _LEGACY_EMBEDDING_DIMENSIONS)
+    
+    def data_version(self) -> Optional[str]:
+        """
+        取得 collection 目前的課程資料版本（每次重新讀取 collection metadata，
+        其他程序更新向量資料庫後也能察覺）
         
-        # 必選修資訊（重點加強）
-        # 優先使用 grade_required_mapping JSON 欄位
-        mapping_json = course.get('grade_required_mapping', '')
-        if mapping_json:
-            try:
-                mapping_data = json.loads(mapping_json)
-                mapping = mapping_data.get('mapping', [])
-                
-                if mapping:
-                    text_parts.append(f"年級組別與必選修對應：")
-                    for grade_item, required_item in mapping:
-                        if '必' in required_item:
-                            text_parts.append(f"  {grade_item}：必修課程")
-                        elif '選' in required_item:
-                            text_parts.append(f"  {grade_item}：選修課程")
-                        else:
-                            text_parts.append(f"  {grade_item}：{required_item}")
-                    
-                    # 統計資訊
-                    required_groups = mapping_data.get('required_groups', [])
-                    elective_groups = mapping_data.get('elective_groups', [])
-                    if required_groups:
-                        text_parts.append(f"必修組別：{', '.join(required_groups[:10])}")  # 只顯示前10個
-                    if elective_groups:
-                        text_parts.append(f"選修組別：{', '.join(elective_groups[:10])}")  # 只顯示前10個
-            except:
-                pass
+        Returns:
+            版本字串；collection 未記錄或無法讀取時為 None
+        """
+        try:
+            collection = self.chroma_client.get_collection(name=self.collection_name)
+        except Exception:
+            return None
+        metadata = getattr(collection, 'metadata', None) or {}
+        return metadata.get(_DATA_VERSION_KEY)
+    
+    def _stamp_data_version(self):
+        """
+        在 collection metadata 寫入新的課程資料版本，讓查詢端的快照與回答快取失效
+        """
+        metadata = dict(getattr(self.collection, 'metadata', None) or {})
+        metadata[_DATA_VERSION_KEY] = str(time.time_ns())
+        try:
+            self.collection.modify(metadata=metadata)
+        except Exception as e:
+            print(f"⚠️  無法更新課程資料版本：{e}")
+    
+    def _get_embedding(self, text: str) -> List[float]:
+        """
+        使用 OpenAI 取得文字向量
         
-        # 如果沒有 JSON 欄位，使用傳統方式
-        required = course.get('required', '')
-        if required:
-            # 將必選修資訊更明確地標示
-            if '必' in required:
-                text_parts.append(f"必選修：必修課程")
-                text_parts.append(f"課程類型：必修")
-            elif '選' in required:
-                text_parts.append(f"必選修：選修課程")
-                text_parts.append(f"課程類型：選修")
-            else:
-                text_parts.append(f"必選修：{required}")
+        Args:
+            text: 要向量化的文字
+            
+        Returns:
+            向量列表
+        """
+        response = self.openai_client.embeddings.create(
+            model=_EMBEDDING_MODEL,
+            input=text,
+            dimensions=self.embedding_dimensions
+        )
+        return response.data[0].embedding
+    
+    def _get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        使用 OpenAI 一次取得多段文字的向量
         
-        text_parts.append(f"授課教師：{course.get('teacher', '')}")
+        Args:
+            texts: 要向量化的文字列表
+            
+        Returns:
+            與 texts 順序相同的向量列表
+        """
+        delay = _EMBEDDING_RETRY_DELAY
+        for attempt in range(_EMBEDDING_MAX_RETRIES + 1):
+            try:
+                response = self.openai_client.embeddings.create(
+                    model=_EMBEDDING_MODEL,
+                    input=texts,
+                    dimensions=self.embedding_dimensions
+                )
+                break
+            except Exception as e:
+                # 只針對速率限制重試，並以指數退避等待
+                if getattr(e, 'status_code', None) != 429 or attempt == _EMBEDDING_MAX_RETRIES:
+                    raise
+                print(f"⚠️  Embeddings 請求達到速率限制，{delay:.0f} 秒後重試（{attempt + 1}/{_EMBEDDING_MAX_RETRIES}）")
+                time.sleep(delay)
+                delay *= 2
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    
+    def _get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        """
+        取得查詢向量，優先使用快取；未命中的查詢一次批次向量化
         
-        # 課程類別
-        category = course.get('category', '')
-        if category:
-            text_parts.append(f"課程類別：{category}")
+        Args:
+            queries: 查詢文字列表
+            
+        Returns:
+            與 queries 順序相同的向量列表
+        """
+        cache = self._query_embedding_cache
+        missing = [q for q in dict.fromkeys(queries) if q not in cache]
+        if missing:
+            for query, embedding in zip(missing, self._get_embeddings(missing)):
+                cache[query] = embedding
         
-        text_parts.append(f"學分數：{course.get('credit', '')}")
+        embeddings = []
+        for query in queries:
+            cache.move_to_end(query)
+            embeddings.append(cache[query])
+        while len(cache) > _QUERY_EMBEDDING_CACHE_SIZE:
+            cache.popitem(last=False)
+        return embeddings
+    
+    def prefetch_query_embeddings(self, queries: List[str]):
+        """
+        以單次請求預先向量化多個查詢並放入快取，之後的檢索不再個別呼叫 OpenAI
         
-        # 時數
-        hours = course.get('hours', '')
-        if hours:
-            text_parts.append(f"時數：{hours}")
+        Args:
+            queries: 查詢文字列表
+        """
+        if queries:
+            self._get_query_embeddings(queries)
+    
+    def _create_course_metadata(self, course: Dict) -> Dict:
+        """
+        建立課程在向量資料庫中的 metadata
         
-        # 授課語言
-        language = course.get('language', '')
-        if language:
-            text_parts.append(f"授課語言：{language}")
+        Args:
+            course: 課程資料字典
+            
+        Returns:
+            metadata 字典
+        """
+        # 建立 metadata（保留原始資料以便後續使用）
+        required = course.get('required', '')
+        is_required = '必' in required if required else False
         
-        text_parts.append(f"上課時間：{course.get('schedule', '')}")
-        text_parts.append(f"學制：{course.get('edu_type', '')}")
+        # 取得 grade_required_mapping JSON 欄位（如果存在）
+        mapping_json = course.get('grade_required_mapping', '')
         
-        if course.get('note'):
-            text_parts.append(f"備註：{course.get('note', '')}")
+        # 查詢端的過濾只讀 metadata；欄位一律寫入字串（NULL 轉為空字串），不需再從 document 解析
+        metadata = {
+            'serial': course.get('serial') or '',
+            'name': course.get('name') or '',
+            'dept': course.get('dept') or '',
+            'teacher': course.get('teacher') or '',
+            'yearterm': course.get('yearterm') or '',
+            'edu_type': course.get('edu_type') or '',
+            'credit': str(course.get('credit', '')),
+            'schedule': course.get('schedule') or '',
+            'required': required or '',  # 加入必選修資訊
+            'is_required': '是' if is_required else '否',  # 明確標示是否為必修
+            'grade': course.get('grade') or '',
+        }
         
-        # 課程限制
-        limits_json = course.get('limits_json', '')
-        if limits_json:
+        # 如果有 grade_required_mapping，加入 metadata（但 ChromaDB 的 metadata 可能不支援太長的 JSON）
+        # 我們可以只加入關鍵資訊
+        if _has_json_object(mapping_json):
             try:
-                limits = json.loads(limits_json)
-                if limits:
-                    limits_text = "課程限制："
-                    for key, value in limits.items():
-                        limits_text += f"{key}：{value}；"
-                    text_parts.append(limits_text)
-            except:
+                mapping_data = load_mapping_json(mapping_json)
+                # 只加入必要的資訊到 metadata（避免 metadata 太大）
+                if mapping_data.get('required_groups'):
+                    metadata['has_required_groups'] = '是'
+                if mapping_data.get('elective_groups'):
+                    metadata['has_elective_groups'] = '是'
+                # 注意：完整的 mapping_json 會存在 document 中，可以從 document 中提取
+                metadata['grade_required_mapping'] = mapping_json  # 儲存 JSON 字串
+            except _JSON_FIELD_ERRORS:
                 pass
         
-        # 選課資訊
-        text_parts.append(f"可加選：{course.get('addable', '')}")
-        text_parts.append(f"加選人數上限：{course.get('add_limit', '')}")
-        text_parts.append(f"總人數上限：{course.get('total_limit', '')}")
-        text_parts.append(f"已選人數：{course.get('enrolled', '')}")
+        return metadata
+    
+    def _write_batches(self, texts: List[str], metadatas: List[Dict], ids: List[str], write):
+        """
+        分批向量化並寫入 ChromaDB
         
-        return "\n".join(text_parts)
+        Args:
+            texts: 課程文字列表
+            metadatas: 與 texts 順序相同的 metadata 列表
+            ids: 與 texts 順序相同的文件 ID 列表
+            write: 寫入方法（collection.add 或 collection.upsert）
+        """
+        batch_size = 100
+        starts = range(0, len(texts), batch_size)
+        
+        # 各批次的 embeddings 平行請求；executor.map 依原順序回傳，寫入 ChromaDB 時維持批次順序
+        with ThreadPoolExecutor(max_workers=_EMBEDDING_WORKERS) as executor:
+            embeddings_per_batch = executor.map(
+                self._get_embeddings,
+                (texts[i:i+batch_size] for i in starts)
+            )
+            for i, batch_embeddings in zip(starts, embeddings_per_batch):
+                batch_texts = texts[i:i+batch_size]
+                
+                print(f"🔄 處理中：{min(i+batch_size, len(texts))}/{len(texts)}")
+                
+                # 批次寫入 ChromaDB（以 list 傳入：requirements 允許的 chromadb 0.4.x 不接受 numpy 陣列）
+                write(
+                    embeddings=batch_embeddings,
+                    documents=batch_texts,
+                    metadatas=metadatas[i:i+batch_size],
+                    ids=ids[i:i+batch_size]
+                )
+                print(f"✅ 已寫入 {len(batch_texts)} 筆資料到向量資料庫")
     
-    def _get_embedding(self, text: str) -> List[float]:
+    def _update_metadatas(self, ids: List[str], metadatas: List[Dict], old_metadatas: List[Dict]):
         """
-        使用 OpenAI 取得文字向量
+        分批更新既有文件的 metadata（不重新向量化）
+        
+        ChromaDB 更新 metadata 時會與原本的欄位合併，新 metadata 中已不存在的欄位
+        （例如 has_required_groups）以 _metadata_with_removed_keys 設為 None 才會被刪除。
         
         Args:
-            text: 要向量化的文字
-            
-        Returns:
-            向量列表
+            ids: 文件 ID 列表
+            metadatas: 與 ids 順序相同的新 metadata 列表
+            old_metadatas: 與 ids 順序相同的向量資料庫中原本的 metadata 列表
         """
-        response = self.openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text
-        )
-        return response.data[0].embedding
+        batch_size = 100
+        updates = [_metadata_with_removed_keys(new, old) for new, old in zip(metadatas, old_metadatas)]
+        for i in range(0, len(ids), batch_size):
+            self.collection.update(ids=ids[i:i+batch_size], metadatas=updates[i:i+batch_size])
+        print(f"✅ 已更新 {len(ids)} 筆 metadata")
+    
+    def update_vector_database(self):
+        """
+        增量更新向量資料庫：只重新向量化新增或內容有變動的課程，只有 metadata 變動的課程只更新 metadata，
+        並刪除已不存在的課程；BM25 索引沿用快取中未變動文件的分詞結果
+        
+        有任何變動時會寫入新的資料版本（_stamp_data_version），執行中的 CourseQuerySystem
+        下次查詢時即重建 collection 快照並清空回答快取，不必呼叫 invalidate_cache 或重新啟動
+        """
+        print("📚 開始增量更新向量資料庫...")
+        if self.collection.count() == 0:
+            # 尚無資料時等同完整建立
+            self.build_vector_database()
+            return
+        
+        courses = self._load_courses_from_db()
+        if not courses:
+            print("❌ 沒有找到課程資料")
+            return
+        
+        # 直接重新產生文字（不經 course_texts 快取），確保比對的是目前資料庫的內容
+        all_texts = [self._create_course_text(course) for course in courses]
+        all_metadatas = [self._create_course_metadata(course) for course in courses]
+        all_ids = [_course_doc_id(course) for course in courses]
+        
+        # 以目前向量資料庫中的文件內容與 metadata 比對：
+        # 文字變動的課程需要重新向量化；只有 metadata 變動的課程只更新 metadata
+        existing = self.collection.get(include=['documents', 'metadatas'])
+        existing_docs = dict(zip(existing['ids'], existing['documents']))
+        existing_metadatas = dict(zip(existing['ids'], existing['metadatas']))
+        changed = [i for i, (doc_id, text) in enumerate(zip(all_ids, all_texts)) if existing_docs.get(doc_id) != text]
+        metadata_changed = [
+            i for i, (doc_id, metadata) in enumerate(zip(all_ids, all_metadatas))
+            if doc_id in existing_metadatas
+            and _metadata_hash(existing_metadatas[doc_id] or {}) != _metadata_hash(metadata)
+        ]
+        # 文字變動的課程會連同 metadata 一起 upsert，不需再單獨更新 metadata
+        changed_set = set(changed)
+        metadata_only = [i for i in metadata_changed if i not in changed_set]
+        current_ids = set(all_ids)
+        removed_ids = [doc_id for doc_id in existing_docs if doc_id not in current_ids]
+        
+        print(f"📊 新增或變動 {len(changed)} 筆，僅 metadata 變動 {len(metadata_only)} 筆，"
+              f"刪除 {len(removed_ids)} 筆，未變動 {len(all_ids) - len(changed) - len(metadata_only)} 筆")
+        if changed:
+            # upsert 既有文件時 ChromaDB 同樣會合併 metadata，已不存在的欄位以 None 寫入才會被刪除
+            self._write_batches(
+                [all_texts[i] for i in changed],
+                [
+                    _metadata_with_removed_keys(all_metadatas[i], existing_metadatas.get(all_ids[i]) or {})
+                    for i in changed
+                ],
+                [all_ids[i] for i in changed],
+                self.collection.upsert
+            )
+        if metadata_only:
+            self._update_metadatas(
+                [all_ids[i] for i in metadata_only],
+                [all_metadatas[i] for i in metadata_only],
+                [existing_metadatas[all_ids[i]] or {} for i in metadata_only]
+            )
+        if removed_ids:
+            self.collection.delete(ids=removed_ids)
+        
+        # 寫入新的資料版本：執行中的 CourseQuerySystem 依此重建快照並清空回答快取，不需重新啟動
+        if changed or metadata_only or removed_ids:
+            self._stamp_data_version()
+        
+        if changed or removed_ids or self.bm25_index is None:
+            print("🔄 更新 BM25 索引...")
+            self._build_bm25_index(all_texts, all_ids)
+        print(f"🎉 向量資料庫更新完成！共 {self.collection.count()} 筆資料")
     
     def build_vector_database(self):
         """
@@ -305,93 +866,26 @@ class CourseRAGSystem:
                 self.chroma_client.delete_collection(name=self.collection_name)
                 self.collection = self.chroma_client.create_collection(
                     name=self.collection_name,
-                    metadata={"description": "NTPU Courses RAG System"}
+                    metadata=dict(_COLLECTION_METADATA)
                 )
+                self.embedding_dimensions = self._collection_embedding_dimensions()
+                self._query_embedding_cache.clear()  # 維度可能改變，舊的查詢向量不再適用
                 print("✅ 已清除舊資料")
             else:
                 print("❌ 取消建立向量資料庫")
                 return
         
-        # 批次處理課程資料
-        batch_size = 100
-        all_texts = []
-        all_metadatas = []
-        all_ids = []
-        
         # 先準備所有資料
         print("📝 準備課程資料...")
-        for idx, course_row in enumerate(courses):
-            course = dict(course_row)
-            
-            # 建立課程文字描述
-            course_text = self._create_course_text(course)
-            all_texts.append(course_text)
-            
-            # 建立 metadata（保留原始資料以便後續使用）
-            required = course.get('required', '')
-            is_required = '必' in required if required else False
-            
-            # 取得 grade_required_mapping JSON 欄位（如果存在）
-            mapping_json = course.get('grade_required_mapping', '')
-            
-            metadata = {
-                'serial': course.get('serial', ''),
-                'name': course.get('name', ''),
-                'dept': course.get('dept', ''),
-                'teacher': course.get('teacher', ''),
-                'yearterm': course.get('yearterm', ''),
-                'edu_type': course.get('edu_type', ''),
-                'credit': str(course.get('credit', '')),
-                'schedule': course.get('schedule', ''),
-                'required': required,  # 加入必選修資訊
-                'is_required': '是' if is_required else '否',  # 明確標示是否為必修
-                'grade': course.get('grade', ''),
-            }
-            
-            # 如果有 grade_required_mapping，加入 metadata（但 ChromaDB 的 metadata 可能不支援太長的 JSON）
-            # 我們可以只加入關鍵資訊
-            if mapping_json:
-                try:
-                    mapping_data = json.loads(mapping_json)
-                    # 只加入必要的資訊到 metadata（避免 metadata 太大）
-                    if mapping_data.get('required_groups'):
-                        metadata['has_required_groups'] = '是'
-                    if mapping_data.get('elective_groups'):
-                        metadata['has_elective_groups'] = '是'
-                    # 注意：完整的 mapping_json 會存在 document 中，可以從 document 中提取
-                    metadata['grade_required_mapping'] = mapping_json  # 儲存 JSON 字串
-                except:
-                    pass
-            
-            all_metadatas.append(metadata)
-            
-            # 建立唯一 ID
-            course_id = f"{course.get('yearterm', '')}_{course.get('serial', '')}_{course.get('edu_type', '')}"
-            all_ids.append(course_id)
+        # 建立課程文字描述（未變動的課程直接沿用資料庫中的文字）
+        all_texts = self._get_course_texts(courses)
+        all_metadatas = [self._create_course_metadata(course) for course in courses]
+        all_ids = [_course_doc_id(course) for course in courses]
         
         # 批次處理 embeddings 並加入 ChromaDB
         print("🔄 開始向量化並建立向量資料庫...")
-        for i in range(0, len(all_texts), batch_size):
-            batch_texts = all_texts[i:i+batch_size]
-            batch_metadatas = all_metadatas[i:i+batch_size]
-            batch_ids = all_ids[i:i+batch_size]
-            
-            print(f"🔄 處理中：{min(i+batch_size, len(all_texts))}/{len(all_texts)}")
-            
-            # 批次取得 embeddings
-            batch_embeddings = []
-            for text in batch_texts:
-                embedding = self._get_embedding(text)
-                batch_embeddings.append(embedding)
-            
-            # 批次加入 ChromaDB
-            self.collection.add(
-                embeddings=batch_embeddings,
-                documents=batch_texts,
-                metadatas=batch_metadatas,
-                ids=batch_ids
-            )
-            print(f"✅ 已加入 {len(batch_texts)} 筆資料到向量資料庫")
+        self._write_batches(all_texts, all_metadatas, all_ids, self.collection.add)
+        self._stamp_data_version()
         
         print(f"🎉 向量資料庫建立完成！共 {self.collection.count()} 筆資料")
         
@@ -411,17 +905,86 @@ class CourseRAGSystem:
         # 儲存文件用於 BM25
         self.bm25_documents = documents
         self.bm25_doc_ids = doc_ids
+        self.bm25_doc_positions = {doc_id: i for i, doc_id in enumerate(doc_ids)}
         
-        # 使用 jieba 進行中文分詞
-        tokenized_docs = []
-        for doc in documents:
-            # 使用 jieba 分詞
-            tokens = jieba.cut(doc)
-            tokenized_docs.append(list(tokens))
+        # 使用 jieba 進行中文分詞；內容未變的文件沿用快取檔中上次的分詞結果
+        saved = self._read_saved_bm25_index()
+        previous_tokens = {}
+        if saved is not None and 'tokenized_docs' in saved:
+            previous_tokens = dict(zip(saved['documents'], saved['tokenized_docs']))
+        tokenized_docs = [
+            previous_tokens[doc] if doc in previous_tokens else jieba.lcut(doc)
+            for doc in documents
+        ]
         
-        # 建立 BM25 索引
+        # 建立 BM25 索引與倒排索引
         self.bm25_index = BM25Okapi(tokenized_docs)
+        self.bm25_postings = _build_postings(tokenized_docs)
         print(f"✅ BM25 索引已建立，共 {len(tokenized_docs)} 筆文件")
+        self._save_bm25_index(tokenized_docs)
+    
+    def _save_bm25_index(self, tokenized_docs: List[List[str]]):
+        """
+        將 BM25 索引（含預先計算的統計量與分詞結果）寫入快取檔，下次啟動直接載入
+        
+        Args:
+            tokenized_docs: 與 bm25_documents 順序相同的分詞結果
+        """
+        try:
+            with open(self.bm25_index_path, 'wb') as f:
+                pickle.dump({
+                    'documents': self.bm25_documents,
+                    'doc_ids': self.bm25_doc_ids,
+                    'tokenized_docs': tokenized_docs,
+                    'bm25_index': self.bm25_index,
+                    'bm25_postings': self.bm25_postings,
+                    'fingerprint': _documents_fingerprint(self.bm25_doc_ids, self.bm25_documents),
+                }, f, protocol=5)
+        except Exception as e:
+            print(f"⚠️  無法儲存 BM25 索引：{e}")
+    
+    def _read_saved_bm25_index(self) -> Optional[Dict]:
+        """
+        讀取 BM25 索引快取檔
+        
+        Returns:
+            快取內容；檔案不存在或無法讀取時回傳 None
+        """
+        if not os.path.exists(self.bm25_index_path):
+            return None
+        try:
+            with open(self.bm25_index_path, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"⚠️  無法讀取 BM25 索引快取：{e}")
+            return None
+    
+    def _load_saved_bm25_index(self, fingerprint: str) -> bool:
+        """
+        從快取檔載入 BM25 索引
+        
+        Args:
+            fingerprint: 目前 collection 文件的 _documents_fingerprint
+            
+        Returns:
+            是否成功載入（檔案不存在或與 collection 內容不符時回傳 False）
+        """
+        saved = self._read_saved_bm25_index()
+        if saved is None:
+            return False
+        
+        # collection 內容已變動（例如重新建立、筆數相同但文件不同）或快取缺少指紋、倒排索引（舊版格式）
+        # 則視為過期，改由 ChromaDB 重建
+        if saved.get('fingerprint') != fingerprint or 'bm25_postings' not in saved:
+            return False
+        
+        self.bm25_documents = saved['documents']
+        self.bm25_doc_ids = saved['doc_ids']
+        self.bm25_doc_positions = {doc_id: i for i, doc_id in enumerate(self.bm25_doc_ids)}
+        self.bm25_index = saved['bm25_index']
+        self.bm25_postings = saved['bm25_postings']
+        print(f"✅ 已載入 BM25 索引快取，共 {len(self.bm25_doc_ids)} 筆文件")
+        return True
     
     def _tokenize_query(self, query: str) -> List[str]:
         """
@@ -433,15 +996,16 @@ class CourseRAGSystem:
         Returns:
             分詞後的列表
         """
-        return list(jieba.cut(query))
+        return jieba.lcut(query)
     
-    def search_courses(self, query: str, n_results: int = 5, use_hybrid: bool = True) -> List[Dict]:
+    def search_courses(self, query: Union[str, List[str]], n_results: int = 5, use_hybrid: bool = True) -> List[Dict]:
         """
         搜尋相關課程（支援混合檢索：BM25 + Embedding）
         
         Args:
-            query: 使用者查詢文字
-            n_results: 回傳結果數量
+            query: 使用者查詢文字；傳入多個查詢時一次向量化並檢索，
+                   結果依查詢順序合併，並以課程代碼去重
+            n_results: 每個查詢的回傳結果數量
             use_hybrid: 是否使用混合檢索（預設 True）
             
         Returns:
@@ -450,24 +1014,46 @@ class CourseRAGSystem:
         # 如果 BM25 索引未建立，嘗試從現有資料建立
         if use_hybrid and self.bm25_index is None:
             self._try_load_bm25_index()
+        use_hybrid = use_hybrid and self.bm25_index is not None
         
-        if use_hybrid and self.bm25_index is not None:
-            # 使用混合檢索：BM25 + Embedding
-            return self._hybrid_search(query, n_results)
-        else:
+        if isinstance(query, str):
+            if use_hybrid:
+                # 使用混合檢索：BM25 + Embedding
+                return self._hybrid_search(query, n_results)
             # 僅使用 Embedding 檢索
             return self._embedding_search(query, n_results)
+        
+        queries = list(query)
+        if not queries:
+            return []
+        # 混合檢索時 Embedding 階段擴大範圍（與 _hybrid_search 相同）
+        embedding_n = n_results * 3 if use_hybrid else n_results
+        results_per_query = self._embedding_search_many(queries, embedding_n)
+        if use_hybrid:
+            results_per_query = [
+                self._hybrid_search(q, n_results, embedding_results=results)
+                for q, results in zip(queries, results_per_query)
+            ]
+        
+        # 以課程代碼為 key 去重（dict 保留插入順序）
+        combined = {}
+        for results in results_per_query:
+            for course in results:
+                combined.setdefault(course.get('metadata', {}).get('serial', ''), course)
+        return list(combined.values())
     
     def _try_load_bm25_index(self):
         """
-        嘗試從 ChromaDB 載入資料並建立 BM25 索引
+        嘗試載入 BM25 索引：快取檔與 ChromaDB 中的文件一致時直接載入，否則以 ChromaDB 的資料重建
         """
         try:
-            # 從 ChromaDB 取得所有文件
-            all_results = self.collection.get()
+            # 從 ChromaDB 取得所有文件（也用來確認快取檔是否過期）
+            all_results = self.collection.get(include=['documents'])
             if all_results['documents']:
                 documents = all_results['documents']
                 doc_ids = all_results['ids']
+                if self._load_saved_bm25_index(_documents_fingerprint(doc_ids, documents)):
+                    return
                 self._build_bm25_index(documents, doc_ids)
         except Exception as e:
             print(f"⚠️  無法載入 BM25 索引：{e}")
@@ -484,98 +1070,208 @@ class CourseRAGSystem:
             相關課程列表
         """
         # 取得查詢向量
-        query_embedding = self._get_embedding(query)
+        query_embedding = self._get_query_embeddings([query])[0]
+        return self._query_collection([query_embedding], n_results)[0]
+    
+    def _embedding_search_many(self, queries: List[str], n_results: int) -> List[List[Dict]]:
+        """
+        一次向量化多個查詢，並以單次 collection.query 檢索
         
+        Args:
+            queries: 查詢文字列表
+            n_results: 每個查詢的回傳結果數量
+            
+        Returns:
+            與 queries 順序相同的課程列表
+        """
+        return self._query_collection(self._get_query_embeddings(queries), n_results)
+    
+    def _query_collection(self, query_embeddings: List[List[float]], n_results: int) -> List[List[Dict]]:
+        """
+        以查詢向量在向量資料庫中搜尋並格式化結果
+        
+        Args:
+            query_embeddings: 查詢向量列表
+            n_results: 每個查詢的回傳結果數量
+            
+        Returns:
+            每個查詢向量各自的課程列表
+        """
         # 在向量資料庫中搜尋（擴大搜尋範圍以進行混合）
         search_n = n_results * 3 if self.bm25_index is not None else n_results
         
         results = self.collection.query(
-            query_embeddings=[query_embedding],
+            query_embeddings=query_embeddings,
             n_results=search_n
         )
         
         # 格式化結果
-        courses = []
-        if results['documents'] and len(results['documents'][0]) > 0:
-            for i in range(len(results['documents'][0])):
-                course_info = {
-                    'document': results['documents'][0][i],
-                    'metadata': results['metadatas'][0][i],
-                    'distance': results['distances'][0][i] if 'distances' in results else None,
-                    'similarity': 1 - results['distances'][0][i] if 'distances' in results and results['distances'][0][i] else 0,
-                    'embedding_score': 1 - results['distances'][0][i] if 'distances' in results and results['distances'][0][i] else 0
-                }
-                courses.append(course_info)
-        
-        return courses
-    
-    def _hybrid_search(self, query: str, n_results: int) -> List[Dict]:
+        courses_per_query = []
+        for q in range(len(query_embeddings)):
+            courses = []
+            if results['documents'] and len(results['documents'][q]) > 0:
+                for i in range(len(results['documents'][q])):
+                    course_info = {
+                        'document': results['documents'][q][i],
+                        'metadata': results['metadatas'][q][i],
+                        'distance': results['distances'][q][i] if 'distances' in results else None,
+                        'similarity': 1 - results['distances'][q][i] if 'distances' in results and results['distances'][q][i] else 0,
+                        'embedding_score': 1 - results['distances'][q][i] if 'distances' in results and results['distances'][q][i] else 0
+                    }
+                    courses.append(course_info)
+            courses_per_query.append(courses)
+        
+        return courses_per_query
+    
+    def _get_courses_by_ids(self, doc_ids: List[str]) -> Dict[str, Dict]:
+        """
+        以單次 collection.get 取得多筆課程的完整資訊
+        
+        Args:
+            doc_ids: 文件 ID 列表
+            
+        Returns:
+            doc_id -> 課程資訊，依 doc_ids 順序排列（查無資料的 ID 會略過）
+        """
+        if not doc_ids:
+            return {}
+        # 查無資料的 ID 不會拋出例外，只是不出現在回傳結果中
+        results = self.collection.get(ids=doc_ids, include=['documents', 'metadatas'])
+        
+        metadatas = results['metadatas'] or [{}] * len(results['ids'])
+        fetched = {}
+        for doc_id, document, metadata in zip(results['ids'], results['documents'], metadatas):
+            fetched[doc_id] = {
+                'document': document,
+                'metadata': metadata,
+                'distance': None,
+                'similarity': 0.0,
+                'embedding_score': 0.0
+            }
+        return {doc_id: fetched[doc_id] for doc_id in doc_ids if doc_id in fetched}
+    
+    def _hybrid_search(self, query: str, n_results: int, embedding_results: Optional[List[Dict]] = None) -> List[Dict]:
         """
         混合檢索：BM25 + Embedding
         
         Args:
             query: 使用者查詢文字
             n_results: 回傳結果數量
+            embedding_results: 已取得的 Embedding 檢索結果（批次檢索時傳入）
             
         Returns:
             相關課程列表（按混合分數排序）
         """
         # 1. Embedding 檢索（擴大範圍）
-        embedding_results = self._embedding_search(query, n_results * 3)
+        if embedding_results is None:
+            embedding_results = self._embedding_search(query, n_results * 3)
         
         # 2. BM25 檢索
         tokenized_query = self._tokenize_query(query)
-        bm25_scores = self.bm25_index.get_scores(tokenized_query)
-        
-        # 建立 BM25 分數映射（doc_id -> score）
-        bm25_score_map = {}
-        for i, doc_id in enumerate(self.bm25_doc_ids):
-            bm25_score_map[doc_id] = bm25_scores[i]
-        
-        # 正規化 BM25 分數（0-1 範圍）
-        if len(bm25_scores) > 0:
-            max_bm25 = float(max(bm25_scores))
-            min_bm25 = float(min(bm25_scores))
-            if max_bm25 > min_bm25:
-                bm25_score_map = {
-                    doc_id: (float(score) - min_bm25) / (max_bm25 - min_bm25)
-                    for doc_id, score in bm25_score_map.items()
-                }
-            else:
-                bm25_score_map = {doc_id: 0.0 for doc_id in bm25_score_map.keys()}
         
-        # 3. 合併結果並計算混合分數
+        # 3. 融合兩種檢索結果
+        if self.fusion_method == 'linear':
+            # 線性融合需要全部文件的分數做正規化
+            bm25_scores = self.bm25_index.get_scores(tokenized_query)
+            course_map = self._linear_fusion(embedding_results, bm25_scores, n_results)
+        else:
+            course_map = self._rrf_fusion(embedding_results, tokenized_query, n_results)
+        
+        # 4. 按混合分數排序並返回前 n_results
+        sorted_courses = sorted(course_map.values(), key=lambda x: x['hybrid_score'], reverse=True)
+        
+        return sorted_courses[:n_results]
+    
+    def _rrf_fusion(self, embedding_results: List[Dict], tokenized_query: List[str], n_results: int) -> Dict[str, Dict]:
+        """
+        Reciprocal Rank Fusion：每個檢索結果依名次貢獻 1 / (k + rank)，不需正規化分數
+        
+        Args:
+            embedding_results: Embedding 檢索結果（已依相似度排序）
+            tokenized_query: 分詞後的查詢
+            n_results: 回傳結果數量
+            
+        Returns:
+            doc_id -> 課程資訊（含 hybrid_score）
+        """
+        rrf_k = self.rrf_k
+        course_map = {}
+        rrf_scores = {}
+        for rank, course in enumerate(embedding_results, 1):
+            doc_id = _course_doc_id(course['metadata'])
+            if doc_id in course_map:
+                continue
+            course_map[doc_id] = course
+            rrf_scores[doc_id] = 1.0 / (rrf_k + rank)
+        
+        # BM25 只取前 n_results * 3 名；沒有任何詞命中的文件分數為 0、不列入排名，
+        # 因此只需以倒排索引找出候選文件並為其計分（依索引排序，同分時與全體計分的名次相同）
+        postings = self.bm25_postings
+        candidates = sorted({i for term in set(tokenized_query) for i in postings.get(term, ())})
+        bm25_scores = self.bm25_index.get_batch_scores(tokenized_query, candidates) if candidates else []
+        top_positions = heapq.nlargest(n_results * 3, range(len(candidates)), key=bm25_scores.__getitem__)
+        bm25_ranked = [
+            (self.bm25_doc_ids[candidates[j]], float(bm25_scores[j]))
+            for j in top_positions if bm25_scores[j] > 0
+        ]
+        for rank, (doc_id, _) in enumerate(bm25_ranked, 1):
+            rrf_scores[doc_id] = rrf_scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+        
+        # BM25 高名次但不在 Embedding 結果中的課程，一次從 ChromaDB 取回
+        missing_ids = [doc_id for doc_id, _ in bm25_ranked if doc_id not in course_map]
+        course_map.update(self._get_courses_by_ids(missing_ids))
+        
+        bm25_raw = dict(bm25_ranked)
+        for doc_id, course in course_map.items():
+            course['bm25_score'] = bm25_raw.get(doc_id, 0.0)
+            course['hybrid_score'] = rrf_scores.get(doc_id, 0.0)
+            course['similarity'] = course['hybrid_score']  # 更新 similarity 為混合分數
+        return course_map
+    
+    def _linear_fusion(self, embedding_results: List[Dict], bm25_scores, n_results: int) -> Dict[str, Dict]:
+        """
+        線性融合：BM25 分數正規化至 0-1 後與 Embedding 分數加權相加
+        
+        Args:
+            embedding_results: Embedding 檢索結果
+            bm25_scores: 所有文件的 BM25 分數
+            n_results: 回傳結果數量
+            
+        Returns:
+            doc_id -> 課程資訊（含 hybrid_score）
+        """
+        # 正規化 BM25 分數（0-1 範圍）：只算出 min/max，實際用到的文件才換算
+        min_bm25 = float(min(bm25_scores)) if len(bm25_scores) > 0 else 0.0
+        max_bm25 = float(max(bm25_scores)) if len(bm25_scores) > 0 else 0.0
+        bm25_positions = self.bm25_doc_positions
+        
+        def normalized_bm25(doc_id: str) -> float:
+            i = bm25_positions.get(doc_id)
+            if i is None or max_bm25 <= min_bm25:
+                return 0.0
+            return (float(bm25_scores[i]) - min_bm25) / (max_bm25 - min_bm25)
+        
         # 建立 document -> course_info 映射
         course_map = {}
         for course in embedding_results:
-            doc_id = f"{course['metadata'].get('yearterm', '')}_{course['metadata'].get('serial', '')}_{course['metadata'].get('edu_type', '')}"
-            course['bm25_score'] = bm25_score_map.get(doc_id, 0.0)
+            doc_id = _course_doc_id(course['metadata'])
+            course['bm25_score'] = normalized_bm25(doc_id)
             course_map[doc_id] = course
         
         # 加入 BM25 高分但 Embedding 低分的結果
         # 找出 BM25 前 n_results * 2 的結果
-        top_bm25_indices = sorted(range(len(bm25_scores)), key=lambda i: bm25_scores[i], reverse=True)[:n_results * 2]
-        
+        # heapq.nlargest 與 sorted(..., reverse=True)[:k] 結果相同（同分保留原順序），但只維護 k 筆
+        top_bm25_indices = heapq.nlargest(n_results * 2, range(len(bm25_scores)), key=bm25_scores.__getitem__)
+        missing_ids = []
         for idx in top_bm25_indices:
             doc_id = self.bm25_doc_ids[idx]
-            if doc_id not in course_map:
-                # 從 ChromaDB 取得完整資訊
-                try:
-                    chroma_results = self.collection.get(ids=[doc_id])
-                    if chroma_results['documents']:
-                        course_info = {
-                            'document': chroma_results['documents'][0],
-                            'metadata': chroma_results['metadatas'][0] if chroma_results['metadatas'] else {},
-                            'distance': None,
-                            'similarity': 0.0,
-                            'embedding_score': 0.0,
-                            'bm25_score': bm25_score_map.get(doc_id, 0.0)
-                        }
-                        course_map[doc_id] = course_info
-                except:
-                    pass
-        
-        # 4. 計算混合分數並排序
+            if doc_id not in course_map and doc_id not in missing_ids:
+                missing_ids.append(doc_id)
+        for doc_id, course in self._get_courses_by_ids(missing_ids).items():
+            course['bm25_score'] = normalized_bm25(doc_id)
+            course_map[doc_id] = course
+        
+        # 計算混合分數
         for course in course_map.values():
             embedding_score = course.get('embedding_score', 0.0)
             bm25_score = course.get('bm25_score', 0.0)
@@ -584,11 +1280,7 @@ class CourseRAGSystem:
             hybrid_score = self.embedding_weight * embedding_score + self.bm25_weight * bm25_score
             course['hybrid_score'] = hybrid_score
             course['similarity'] = hybrid_score  # 更新 similarity 為混合分數
-        
-        # 5. 按混合分數排序並返回前 n_results
-        sorted_courses = sorted(course_map.values(), key=lambda x: x['hybrid_score'], reverse=True)
-        
-        return sorted_courses[:n_results]
+        return course_map
 
 
 if __name__ == "__main__":
@@ -596,7 +1288,7 @@ if __name__ == "__main__":
     
     # 檢查是否使用多表結構
     use_multi_table = False
-    if len(sys.argv) > 1 and sys.argv[1] == "--multi-table":
+    if "--multi-table" in sys.argv[1:]:
         use_multi_table = True
         print("📋 使用多表結構")
     
@@ -616,6 +1308,9 @@ if __name__ == "__main__":
         else:
             print("❌ 取消建立向量資料庫")
             sys.exit(0)
+    elif "--update" in sys.argv[1:]:
+        rag.update_vector_database()
     else:
         print(f"\n✅ 向量資料庫已存在，共有 {existing_count} 筆資料")
         print("💡 如果要重新建立，請刪除 chroma_db 目錄或刪除 collection")
+        print("💡 只更新有變動的課程：python rag_system.py --update")
@@ -94,6 +94,9 @@ def test_all_queries(n_results: int = 5):
         query_system = CourseQuerySystem(rag)
         print("✅ 系統初始化完成\n")
         
+        # 所有查詢的檢索向量一次批次取得
+        query_system.prefetch_search_embeddings(DEFAULT_TEST_QUERIES)
+        
         # 測試每個查詢
         results = []
         for i, query in enumerate(DEFAULT_TEST_QUERIES, 1):
@@ -1,10 +1,272 @@
 """
 工具函數：處理課程資料的 grade 和 required 對應關係
 """
+from __future__ import annotations
+
 import re
 import json
+from functools import lru_cache
+from types import MappingProxyType
 from typing import List, Tuple, Optional, Dict
 
+# orjson 解析速度較快，未安裝時退回標準庫 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# grade_required_mapping 格式錯誤時可能拋出的例外：JSON 解析失敗（ValueError）、
+# 內容不是預期的 dict / [年級組別, 必選修] 列表（TypeError、AttributeError）
+_MAPPING_ERRORS = (ValueError, TypeError, AttributeError)
+
+
+@lru_cache(maxsize=4096)
+def load_mapping_json(mapping_json: str) -> Dict:
+    """
+    解析 grade_required_mapping JSON 字串（同一字串只解析一次）
+    
+    回傳的 dict 會被多次共用，呼叫端只能讀取、不可修改。
+    
+    Args:
+        mapping_json: grade_required_mapping 欄位的 JSON 字串
+        
+    Returns:
+        解析後的 dict；格式錯誤時拋出 ValueError（json.JSONDecodeError）
+    """
+    if orjson is not None:
+        return orjson.loads(mapping_json)
+    return json.loads(mapping_json)
+
+
+@lru_cache(maxsize=8192)
+def load_mapping_pairs(mapping_json: str) -> Tuple:
+    """
+    取出 grade_required_mapping 中的 [年級組別, 必選修] 對應（依字串快取）
+    
+    回傳 tuple 而非 list，快取的結果被多個課程共用時不會被呼叫端意外修改。
+    
+    Args:
+        mapping_json: grade_required_mapping 欄位的 JSON 字串
+        
+    Returns:
+        mapping tuple；格式錯誤時拋出例外，由呼叫端處理
+    """
+    return tuple(load_mapping_json(mapping_json).get('mapping', ()))
+
+
+@lru_cache(maxsize=8192)
+def load_mapping_status(mapping_json: str) -> Tuple[Tuple[str, str], ...]:
+    """
+    取出 grade_required_mapping 的 (年級組別, 必選修狀態) 對應（依字串快取）
+    
+    必選修在這裡先以 _required_status 正規化成 '必'、'選'（其他寫法原樣保留），
+    比對迴圈只需做字串相等比較，不必對每個項目重複搜尋「必」、「選」。
+    
+    Args:
+        mapping_json: grade_required_mapping 欄位的 JSON 字串
+        
+    Returns:
+        (grade_item, 必選修狀態) 的 tuple；格式錯誤時拋出 _MAPPING_ERRORS 之一，
+        因此比對迴圈拿到的一定是字串對，不必再包 try
+    """
+    statuses = []
+    for grade_item, required_item in load_mapping_pairs(mapping_json):
+        if not isinstance(grade_item, str) or not isinstance(required_item, str):
+            raise TypeError(f"grade_required_mapping 項目格式錯誤: {grade_item!r}, {required_item!r}")
+        statuses.append((grade_item, _required_status(required_item)))
+    return tuple(statuses)
+
+
+def safe_load_mapping_status(mapping_json: str) -> Optional[Tuple[Tuple[str, str], ...]]:
+    """
+    load_mapping_status 的不拋例外版本，呼叫端不必用 try 包住整段比對
+    
+    Args:
+        mapping_json: grade_required_mapping 欄位的 JSON 字串
+        
+    Returns:
+        (grade_item, 必選修狀態) 的 tuple；格式錯誤時為 None
+    """
+    try:
+        return load_mapping_status(mapping_json)
+    except _MAPPING_ERRORS:
+        return None
+
+
+@lru_cache(maxsize=8192)
+def _load_mapping_exact(mapping_json: str) -> Dict[str, str]:
+    """
+    grade_required_mapping 的精確匹配查表：年級組別 → 第一個必選修為「必」或「選」的狀態（依字串快取）
+    
+    回傳的 dict 會被多次共用，呼叫端只能讀取、不可修改。
+    
+    Args:
+        mapping_json: grade_required_mapping 欄位的 JSON 字串
+        
+    Returns:
+        年級組別 → '必' 或 '選'；格式錯誤時拋出 _MAPPING_ERRORS 之一
+    """
+    exact = {}
+    for grade_item, status in load_mapping_status(mapping_json):
+        if (status == '必' or status == '選') and grade_item not in exact:
+            exact[grade_item] = status
+    return exact
+
+
+# 年級後面的班別字母（例如「經濟系1A」的 A）
+_SECTION_LETTERS = frozenset('ABCDEF')
+# check_grade_required 部分匹配時視為誤匹配而略過的班別字母
+_SKIPPED_SECTION_LETTERS = frozenset('ABCD')
+
+# 中文數字年級轉阿拉伯數字（避免「一」無法被識別導致誤判為不分年級）
+_GRADE_DIGIT_TABLE = str.maketrans({'一': '1', '二': '2', '三': '3', '四': '4'})
+
+_DIGITS_RE = re.compile(r'\d+')
+# 以數字切開並保留數字：切出的列表奇數位置是數字、偶數位置是其餘文字
+_DIGITS_SPLIT_RE = re.compile(r'(\d+)')
+
+
+def extract_document_field(document: str, key: str) -> Optional[str]:
+    """
+    取出 document 中「key」之後到行尾的值（例如 key='年級：'）
+    
+    document 的欄位都是固定字樣開頭、換行結尾，直接用 str.find 切片即可，
+    不必每次經過 regex；值為空的欄位會略過，繼續找下一個同名欄位。
+    
+    Args:
+        document: 課程文字
+        key: 欄位字樣（含全形冒號）
+        
+    Returns:
+        去除前後空白的欄位值；找不到時為 None
+    """
+    start = 0
+    key_len = len(key)
+    while True:
+        i = document.find(key, start)
+        if i < 0:
+            return None
+        i += key_len
+        j = document.find('\n', i)
+        value = document[i:j] if j >= 0 else document[i:]
+        if value:
+            return value.strip()
+        start = i
+
+
+@lru_cache(maxsize=4096)
+def extract_document_grade_required(document: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    從 document 的「年級：」「必選修：」欄位取值（metadata 缺少欄位時的備援，依 document 快取）
+    
+    同一門課的 document 每次查詢都相同，快取後只有第一次需要掃描文字。
+    
+    Args:
+        document: 課程文字
+        
+    Returns:
+        (年級, 必選修)；document 中沒有該欄位時為 None
+    """
+    return (
+        extract_document_field(document, '年級：'),
+        extract_document_field(document, '必選修：'),
+    )
+
+
+@lru_cache(maxsize=4096)
+def _split_grade_label(label: str) -> Tuple[Tuple[str, ...], str]:
+    """
+    將年級標籤正規化後拆成數字與文字部分（例如「通訊工程學系三A」→ (('3',), '通訊工程A')）
+    
+    數字與文字以一次 split 同時取得，不必 findall 與 sub 各掃一次。
+    
+    Args:
+        label: 年級/組別標籤
+        
+    Returns:
+        (數字 tuple, 去除數字後的文字)
+    """
+    norm = label.replace('學系', '').replace('系', '').translate(_GRADE_DIGIT_TABLE)
+    parts = _DIGITS_SPLIT_RE.split(norm)
+    return tuple(parts[1::2]), ''.join(parts[0::2]).strip()
+
+
+def _split_master_label(label: str) -> Tuple[str, str]:
+    """
+    拆開含「碩」的年級標籤（例如「資工系碩1」→ ('資工', '1')）
+    
+    與 label.split('碩') 取第 0、1 段相同（第二個「碩」之後的部分捨棄），但不必切出整個列表兩次。
+    
+    Args:
+        label: 含「碩」的年級/組別標籤
+        
+    Returns:
+        (去除「系」字的系所, 年級)
+    """
+    head, _, rest = label.partition('碩')
+    return head.replace('系', '').strip(), rest.partition('碩')[0].strip()
+
+
+def _section_suffix_matches(diff: str) -> bool:
+    """
+    部分匹配時，grade_item 比 target_grade 多出的部分（diff）是否可接受
+    
+    允許：
+    1. 空字串 (完全匹配)
+    2. 單個字母 (A, B...)
+    3. 非數字開頭的字串 (法學組, 智財組...) -> 避免 1 匹配 11
+    """
+    return len(diff) == 0 or \
+        (len(diff) == 1 and diff in _SECTION_LETTERS) or \
+        (len(diff) > 0 and not diff[0].isdigit())
+
+
+def _fuzzy_dept_matches(grade_item: str, is_required: bool, t_num: str, t_text: str) -> bool:
+    """
+    系所名稱模糊匹配（處理「通訊系3」匹配「通訊工程學系3」）
+    
+    移除「系」、「學系」並將中文數字轉為阿拉伯數字後，分離數字與文字進行比對
+    （解決「通訊3」無法匹配「通訊工程3」的問題）。
+    目標有年級、課程無年級時，必修課不匹配（避免「通訊系」大一必修被「通訊系3」匹配到），選修則允許。
+    
+    Args:
+        grade_item: mapping 中的年級/組別
+        is_required: 該項目是否為必修
+        t_num: 目標年級的第一個數字（沒有時為空字串）
+        t_text: 目標年級去除數字後的文字
+        
+    Returns:
+        是否匹配
+    """
+    g_nums, g_text = _split_grade_label(grade_item)
+    
+    if t_num and not g_nums:
+        num_match = not is_required
+    else:
+        num_match = (not g_nums) or (t_num and t_num in g_nums)
+    
+    return bool(num_match and g_text and t_text and (g_text in t_text or t_text in g_text))
+
+
+def _master_grade_matches(grade_item: str, target_dept: str, target_num: str) -> bool:
+    """
+    碩士班格式匹配：例如「資工系碩1」匹配「資工碩1」或「資工碩1A」（資料庫中沒有「系」字）
+    
+    Args:
+        grade_item: mapping 中含「碩」的年級/組別
+        target_dept: 目標年級的系所（_split_master_label 的結果）
+        target_num: 目標年級的年級（_split_master_label 的結果）
+        
+    Returns:
+        系所相同或互相包含，且年級相同（或為其前綴）時為 True
+    """
+    grade_dept, grade_num = _split_master_label(grade_item)
+    if target_dept in grade_dept or grade_dept in target_dept:
+        return bool(target_num) and (grade_num == target_num or grade_num.startswith(target_num))
+    return False
+
+
 def parse_grade_required_mapping(grade: str, required: str) -> List[Tuple[str, str]]:
     """
     解析 grade 和 required 的一對多對應關係
@@ -19,20 +281,12 @@ def parse_grade_required_mapping(grade: str, required: str) -> List[Tuple[str, s
     if not grade or not required:
         return []
     
-    grades = [g.strip() for g in grade.split('|') if g.strip()]
-    requireds = [r.strip() for r in required.split('|') if r.strip()]
-    
-    # 建立對應關係
-    mapping = []
-    max_len = max(len(grades), len(requireds))
-    
-    for i in range(max_len):
-        g = grades[i] if i < len(grades) else ''
-        r = requireds[i] if i < len(requireds) else ''
-        if g and r:
-            mapping.append((g, r))
+    grades = [g for g in map(str.strip, grade.split('|')) if g]
+    requireds = [r for r in map(str.strip, required.split('|')) if r]
     
-    return mapping
+    # 建立對應關係：兩邊皆已去除空白項目，長度不同時多出的部分沒有對應，
+    # 因此 zip 截斷到較短的一方即與逐一檢查邊界的結果相同
+    return list(zip(grades, requireds))
 
 def check_grade_required(course: Dict, target_grade: str) -> Optional[str]:
     """
@@ -51,22 +305,48 @@ def check_grade_required(course: Dict, target_grade: str) -> Optional[str]:
     if not grade or not required:
         return None
     
-    mapping = parse_grade_required_mapping(grade, required)
+    return _grade_required_status(grade, required, target_grade)
+
+
+@lru_cache(maxsize=16384)
+def _grade_required_status(grade: str, required: str, target_grade: str) -> Optional[str]:
+    """
+    check_grade_required 的快取版本（同一組 grade/required 與目標年級只解析、比對一次）
+    
+    過濾時大量課程共用相同的 grade/required 字串，重複查詢也會帶入相同的目標年級，
+    以字串為鍵快取即可省去每次的拆解與比對。
+    
+    Args:
+        grade: 年級/組別字串，用 | 分隔（非空）
+        required: 必選修字串，用 | 分隔（非空）
+        target_grade: 目標 grade
+        
+    Returns:
+        '必'、'選' 或 None
+    """
+    # 必選修狀態每個項目只判斷一次（'必' 或 '選'）；兩者皆非的項目在任何情況下都不會回傳，直接略過
+    mapping = []
+    for grade_item, required_item in parse_grade_required_mapping(grade, required):
+        if '必' in required_item:
+            mapping.append((grade_item, '必'))
+        elif '選' in required_item:
+            mapping.append((grade_item, '選'))
     
     if not mapping:
         return None
     
     # 精確匹配優先
-    for grade_item, required_item in mapping:
+    for grade_item, status in mapping:
         if grade_item == target_grade:
-            if '必' in required_item:
-                return '必'
-            elif '選' in required_item:
-                return '選'
+            return status
+    
+    # 目標年級的拆解只需做一次
+    t_nums, t_text = _split_grade_label(target_grade)
+    t_num = t_nums[0] if t_nums else ''
     
     # 部分匹配（改進版：更精確的匹配）
     # 避免誤匹配：例如「經濟系1」不應該匹配「經濟系1A」
-    for grade_item, required_item in mapping:
+    for grade_item, status in mapping:
         # 只處理精確匹配或合理的部分匹配
         # 避免「1」匹配「1A」或「經濟系1」匹配「經濟系1A」
         
@@ -77,58 +357,19 @@ def check_grade_required(course: Dict, target_grade: str) -> Optional[str]:
             # 檢查差異部分
             diff = grade_item[len(target_grade):].strip()
             # 如果差異只有一個字母（A, B, C, D），這是誤匹配，跳過
-            if len(diff) == 1 and diff in ['A', 'B', 'C', 'D']:
+            if len(diff) == 1 and diff in _SKIPPED_SECTION_LETTERS:
                 continue  # 跳過誤匹配
             
             # 允許差異為空，或是字母（A, B...），或是非數字（組別等）
             # 這樣可以讓「通訊系1」匹配「通訊系1A」，也可以讓「通訊系3」匹配「通訊系3A」
-            if len(diff) == 0 or \
-               (len(diff) == 1 and diff in ['A', 'B', 'C', 'D', 'E', 'F']) or \
-               (len(diff) > 0 and not diff[0].isdigit()):
-                if '必' in required_item:
-                    return '必'
-                elif '選' in required_item:
-                    return '選'
+            if _section_suffix_matches(diff):
+                return status
         
         # 情況2：grade_item 是 target_grade 的前綴
         # 例如：「經濟系1A」是「經濟系1A2」的前綴，這種情況可以匹配
         # 情況2：系所名稱模糊匹配（處理「通訊系3」匹配「通訊工程學系3A」）
-        # 移除「系」、「學系」後比較
-        g_norm = grade_item.replace('學系', '').replace('系', '')
-        t_norm = target_grade.replace('學系', '').replace('系', '')
-        
-        # 處理中文數字（避免「一」無法被識別導致誤判為不分年級）
-        trans_table = str.maketrans({'一': '1', '二': '2', '三': '3', '四': '4'})
-        g_norm = g_norm.translate(trans_table)
-        t_norm = t_norm.translate(trans_table)
-        
-        # 分離數字與文字進行比對（解決「通訊3」無法匹配「通訊工程3」的問題）
-        g_nums = re.findall(r'\d+', g_norm)
-        t_nums = re.findall(r'\d+', t_norm)
-        t_num = t_nums[0] if t_nums else ''
-        
-        g_text = re.sub(r'\d+', '', g_norm).strip()
-        t_text = re.sub(r'\d+', '', t_norm).strip()
-        
-        # 數字匹配邏輯優化
-        # 修正：對於必修課，若目標指定了年級，則課程必須也有年級且匹配
-        # 這是為了避免「通訊系」（無年級）的必修課（通常是大一）被「通訊系3」匹配到
-        num_match = False
-        if t_num and not g_nums:
-            # 目標有年級，課程無年級：如果是必修，嚴格不匹配；選修則允許
-            if '必' in required_item:
-                num_match = False
-            else:
-                num_match = True
-        else:
-            num_match = (not g_nums) or (t_num and t_num in g_nums)
-        
-        if num_match:
-            if g_text and t_text and (g_text in t_text or t_text in g_text):
-                if '必' in required_item:
-                    return '必'
-                elif '選' in required_item:
-                    return '選'
+        if _fuzzy_dept_matches(grade_item, status == '必', t_num, t_text):
+            return status
 
         # 情況3：grade_item 是 target_grade 的前綴（反向匹配，例如「通訊系」匹配「通訊系3」）
         if target_grade.startswith(grade_item):
@@ -136,28 +377,75 @@ def check_grade_required(course: Dict, target_grade: str) -> Optional[str]:
             diff = target_grade[len(grade_item):].strip()
             
             # 修正：如果是必修，且差異包含數字（代表指定了年級），則不匹配
-            if '必' in required_item and any(c.isdigit() for c in diff):
+            if status == '必' and _DIGITS_RE.search(diff):
                 continue
                 
             # 如果差異合理（數字、字母等），可以匹配
-            if '必' in required_item:
-                return '必'
-            elif '選' in required_item:
-                return '選'
+            return status
         
-        # 情況3：完全相同的匹配（已經在精確匹配中處理，這裡不需要）
-        # 但為了完整性，保留這個檢查
-        if grade_item == target_grade:
-            if '必' in required_item:
-                return '必'
-            elif '選' in required_item:
-                return '選'
+        # 完全相同的匹配已經在精確匹配中處理
     
     return None
 
+# 年級對應表（「大一」→「1」）
+_GRADE_KEYWORDS = MappingProxyType({
+    '大一': '1', '大二': '2', '大三': '3', '大四': '4',
+    '一年級': '1', '二年級': '2', '三年級': '3', '四年級': '4',
+    '碩一': '碩1', '碩二': '碩2', '碩三': '碩3',
+    '碩士一年級': '碩1', '碩士二年級': '碩2', '碩士三年級': '碩3'
+})
+
+# 任一年級關鍵詞的單一正則：查詢中完全沒有年級關鍵詞時（多數查詢），一次掃描即可略過逐一比對
+# 選項依長度由長到短排列，同一位置較長的關鍵詞（「碩士一年級」）不會被較短的（「一年級」）截斷
+_GRADE_KEYWORD_RE = re.compile('|'.join(map(re.escape, sorted(_GRADE_KEYWORDS, key=len, reverse=True))))
+
+# 「統計大一」這類沒有「系」字的寫法，依年級關鍵詞預先編譯
+_GRADE_KEYWORD_DEPT_RES = MappingProxyType({
+    keyword: re.compile(r'([^大\s]+)' + keyword)
+    for keyword in _GRADE_KEYWORDS
+})
+
+_DEPT_XI_RE = re.compile(r'(\S+系)')
+_DEPT_SHI_RE = re.compile(r'(\S+碩)')
+_DEPT_XI_THEN_SHI_RE = re.compile(r'(\S+系)\s*碩')
+_GRADE_NUM_RE = re.compile(r'[一二三四1234]')
+
+# 系所簡稱+數字的寫法中，系所部分含有這些時間或年級字樣就不是系所（例如「週三」、「大一」）
+_NON_DEPT_WORD_RE = re.compile(r'[週周第大碩年]|星期|禮拜')
+
+# 任何年級寫法都含有「一二三四」或數字；查詢中都沒有時（與年級無關的查詢）不必逐一跑正則
+_GRADE_TRIGGER_RE = re.compile(r'[一二三四\d]')
+
+# 查詢中的年級寫法，依優先順序排列
+# 每個寫法附上必須出現的字（「系」或「碩」）：查詢中沒有該字時直接略過，
+# 不讓 \S+ 在每個起點吃到字串尾再逐字回溯找不存在的字
+_QUERY_GRADE_PATTERNS = tuple((anchor, re.compile(p)) for anchor, p in (
+    ('系', r'(\S+系\s*\d+[A-Z]?)'),           # 經濟系1A、資工系2 等（優先）
+    ('系', r'(\S+系\s*碩\s*\d+)'),            # 資工系碩1、經濟系碩2 等
+    ('系', r'(\S+系)\s*[一1]年級'),           # 經濟系一年級、資工系1年級
+    ('系', r'(\S+系)\s*[一1]'),               # 經濟系一、資工系1
+    ('系', r'(\S+系)\s*[一二三四1234]年級'),  # 經濟系一年級、資工系1年級
+    ('系', r'(\S+系)\s*[一二三四1234]'),      # 經濟系一、資工系1
+    ('系', r'(\S+系)\s*碩\s*[一二12]'),       # 資工系碩一、經濟系碩二
+    ('系', r'(\S+系\s*\d+年級)'),            # 經濟系1年級（去除「年級」）
+    ('系', r'(\S+系\s*\d+)'),                # 經濟系1
+    ('碩', r'(\S+碩\s*\d+)'),                # 資工碩1、經濟碩2
+    
+    # 新增：系所簡稱+數字（如「通訊三」、「資工3」）
+    ('', r'([^\d\s]+?)\s*([一二三四1234])'),
+    # 新增：系所/組別+數字（如「財法組1」、「司法組3」）
+    ('', r'(\S+?[系組])\s*([一二三四1234])'),
+))
+
+# 含「系」或「碩」的寫法合併為單一正則，只用來判斷是否有任一寫法符合：
+# 都不符合時（多數查詢）一次掃描即可略過這些寫法；有符合時仍依上面的優先順序逐一比對
+_QUERY_DEPT_GRADE_RE = re.compile('|'.join(pattern.pattern for anchor, pattern in _QUERY_GRADE_PATTERNS if anchor))
+
+
+@lru_cache(maxsize=2048)
 def extract_grade_from_query(query: str) -> Optional[str]:
     """
-    從查詢中提取 grade 資訊
+    從查詢中提取 grade 資訊（依查詢字串快取，重複的問法不必再跑正則）
     
     Args:
         query: 使用者查詢
@@ -165,25 +453,15 @@ def extract_grade_from_query(query: str) -> Optional[str]:
     Returns:
         提取到的 grade（例如「經濟系1A」或「經濟系1」）或 None
     """
-    # 數字對應表
-    chinese_numbers = {
-        '一': '1', '二': '2', '三': '3', '四': '4',
-        '1': '1', '2': '2', '3': '3', '4': '4'
-    }
-    
-    # 年級對應表（「大一」→「1」）
-    grade_keywords = {
-        '大一': '1', '大二': '2', '大三': '3', '大四': '4',
-        '一年級': '1', '二年級': '2', '三年級': '3', '四年級': '4',
-        '碩一': '碩1', '碩二': '碩2', '碩三': '碩3',
-        '碩士一年級': '碩1', '碩士二年級': '碩2', '碩士三年級': '碩3'
-    }
+    if not _GRADE_TRIGGER_RE.search(query):
+        return None
     
     # 優先匹配：包含系所名稱和年級關鍵詞的組合（例如「經濟系大一」、「資工碩一」、「統計大一」）
-    for keyword, num in grade_keywords.items():
+    # 關鍵詞可能互相包含（「碩士一年級」含「一年級」），有命中時仍依 _GRADE_KEYWORDS 順序逐一嘗試
+    for keyword, num in (_GRADE_KEYWORDS.items() if _GRADE_KEYWORD_RE.search(query) else ()):
         if keyword in query:
             # 先嘗試匹配「XX系」格式（例如「統計系大一」）
-            dept_match = re.search(r'(\S+系)', query)
+            dept_match = _DEPT_XI_RE.search(query)
             if dept_match:
                 dept = dept_match.group(1)
                 # 返回「經濟系1」格式（不包含 A/B，這樣可以匹配 1A、1B 等）
@@ -194,8 +472,7 @@ def extract_grade_from_query(query: str) -> Optional[str]:
             if not ('碩' in keyword or '碩' in num):
                 # 匹配「XX大一」格式，其中 XX 是系所名稱（不包含「系」字）
                 # 例如：「統計大一」→「統計系1」
-                dept_pattern = r'([^大\s]+)' + keyword
-                dept_match = re.search(dept_pattern, query)
+                dept_match = _GRADE_KEYWORD_DEPT_RES[keyword].search(query)
                 if dept_match:
                     dept_name = dept_match.group(1).strip()
                     # 如果系所名稱不包含「系」字，加上「系」字
@@ -209,7 +486,7 @@ def extract_grade_from_query(query: str) -> Optional[str]:
             # 如果沒有「系」字，嘗試匹配「XX碩」格式（例如「資工碩一」）
             if '碩' in keyword or '碩' in num:
                 # 先嘗試匹配「XX碩」格式（例如「資工碩一」）
-                dept_match = re.search(r'(\S+碩)', query)
+                dept_match = _DEPT_SHI_RE.search(query)
                 if dept_match:
                     dept = dept_match.group(1)
                     # 如果 num 已經包含「碩」，不要重複添加
@@ -226,33 +503,18 @@ def extract_grade_from_query(query: str) -> Optional[str]:
                         return f"{dept}{num}"
                 
                 # 或者匹配「XX系碩」格式（例如「資工系碩一」）
-                dept_match = re.search(r'(\S+系)\s*碩', query)
+                dept_match = _DEPT_XI_THEN_SHI_RE.search(query)
                 if dept_match:
                     dept = dept_match.group(1)
                     # 返回「資工系碩1」格式
                     return f"{dept}{num}"
     
     # 匹配模式：XX系X、XX系XA、XX系XB、XX碩X 等
-    patterns = [
-        r'(\S+系\s*\d+[A-Z]?)',           # 經濟系1A、資工系2 等（優先）
-        r'(\S+系\s*碩\s*\d+)',            # 資工系碩1、經濟系碩2 等
-        r'(\S+系)\s*[一1]年級',           # 經濟系一年級、資工系1年級
-        r'(\S+系)\s*[一1]',               # 經濟系一、資工系1
-        r'(\S+系)\s*[一二三四1234]年級',  # 經濟系一年級、資工系1年級
-        r'(\S+系)\s*[一二三四1234]',      # 經濟系一、資工系1
-        r'(\S+系)\s*碩\s*[一二12]',       # 資工系碩一、經濟系碩二
-        r'(\S+系\s*\d+年級)',            # 經濟系1年級（去除「年級」）
-        r'(\S+系\s*\d+)',                # 經濟系1
-        r'(\S+碩\s*\d+)',                # 資工碩1、經濟碩2
-        
-        # 新增：系所簡稱+數字（如「通訊三」、「資工3」）
-        r'([^\d\s]+?)\s*([一二三四1234])',
-        # 新增：系所/組別+數字（如「財法組1」、「司法組3」）
-        r'(\S+?[系組])\s*([一二三四1234])',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, query)
+    has_dept_grade = ('系' in query or '碩' in query) and _QUERY_DEPT_GRADE_RE.search(query) is not None
+    for anchor, pattern in _QUERY_GRADE_PATTERNS:
+        if anchor and (not has_dept_grade or anchor not in query):
+            continue
+        match = pattern.search(query)
         if match:
             # 處理雙群組匹配（系所簡稱+數字）
             if len(match.groups()) == 2:
@@ -260,10 +522,10 @@ def extract_grade_from_query(query: str) -> Optional[str]:
                 num_str = match.group(2).strip()
                 
                 # 排除時間關鍵詞與其他非系所詞彙
-                if any(k in dept for k in ['週', '周', '星期', '禮拜', '第', '大', '碩', '年']):
+                if _NON_DEPT_WORD_RE.search(dept):
                     continue
                 
-                num = chinese_numbers.get(num_str, num_str)
+                num = num_str.translate(_GRADE_DIGIT_TABLE)
                 if '系' not in dept:
                     dept += '系'
                 return f"{dept}{num}"
@@ -273,20 +535,20 @@ def extract_grade_from_query(query: str) -> Optional[str]:
             # 處理「一年級」格式
             if '一年級' in query or '1年級' in query:
                 # 提取系所名稱
-                dept_match = re.search(r'(\S+系)', grade)
+                dept_match = _DEPT_XI_RE.search(grade)
                 if dept_match:
                     dept = dept_match.group(1)
                     # 檢查是否有數字
-                    num_match = re.search(r'([一二三四1234])', query)
+                    num_match = _GRADE_NUM_RE.search(query)
                     if num_match:
-                        num = chinese_numbers.get(num_match.group(1), '1')
+                        num = num_match.group(0).translate(_GRADE_DIGIT_TABLE)
                         return f"{dept}{num}"
                     else:
                         return f"{dept}1"
             
             # 處理「碩一」、「碩二」格式
             if '碩一' in query or '碩二' in query or '碩三' in query:
-                dept_match = re.search(r'(\S+系)', grade)
+                dept_match = _DEPT_XI_RE.search(grade)
                 if dept_match:
                     dept = dept_match.group(1)
                     if '碩一' in query or '碩1' in query:
@@ -298,12 +560,12 @@ def extract_grade_from_query(query: str) -> Optional[str]:
             
             # 處理「一二三四」格式（排除碩士班與年級字樣）
             # 這裡處理如「通訊系三」的情況
-            num_match = re.search(r'[一二三四1234]', query)
+            num_match = _GRADE_NUM_RE.search(query)
             if num_match and '年級' not in query and '大' not in query and '碩' not in query:
-                dept_match = re.search(r'(\S+系)', grade)
+                dept_match = _DEPT_XI_RE.search(grade)
                 if dept_match:
                     dept = dept_match.group(1)
-                    num = chinese_numbers.get(num_match.group(0), num_match.group(0))
+                    num = num_match.group(0).translate(_GRADE_DIGIT_TABLE)
                     return f"{dept}{num}"
             
             # 移除「年級」字樣
@@ -315,51 +577,94 @@ def extract_grade_from_query(query: str) -> Optional[str]:
     
     return None
 
+def _course_grade_required(course: Dict) -> Tuple[str, str]:
+    """
+    取得課程的 grade 與 required：metadata 缺少任一欄位時，改用 document 中找得到的欄位值
+    
+    Args:
+        course: 課程資料字典（含 metadata 與 document）
+        
+    Returns:
+        (grade, required)
+    """
+    metadata = course.get('metadata', {})
+    
+    # 從 metadata 或 document 中取得 grade 和 required
+    grade = metadata.get('grade', '')
+    required = metadata.get('required', '')
+    
+    # 如果 metadata 中沒有，嘗試從 document 中提取
+    if not grade or not required:
+        doc_grade, doc_required = extract_document_grade_required(course.get('document', ''))
+        
+        if doc_grade is not None:
+            grade = doc_grade
+        if doc_required is not None:
+            required = doc_required
+    
+    return grade, required
+
+
+def build_grade_required_index(courses: List[Dict]) -> Dict[Tuple[str, str], List[int]]:
+    """
+    建立 (grade, required) → 課程索引列表的反向索引
+    
+    同一批課程要以不同年級、必選修重複過濾時（例如聊天機器人多次查詢同一份課程資料），
+    先建好索引傳給 filter_courses_by_grade_required，就不必每次重新讀取每門課的欄位。
+    
+    Args:
+        courses: 課程列表
+        
+    Returns:
+        以 (grade, required) 為鍵、課程在 courses 中的索引（遞增）為值的字典
+    """
+    index = {}
+    for i, course in enumerate(courses):
+        index.setdefault(_course_grade_required(course), []).append(i)
+    return index
+
+
 def filter_courses_by_grade_required(
     courses: List[Dict], 
     target_grade: str, 
-    target_required: str
+    target_required: str,
+    index: Optional[Dict[Tuple[str, str], List[int]]] = None
 ) -> List[Dict]:
     """
     根據 grade 和 required 過濾課程
     
+    許多課程共用相同的欄位值，只對索引中不重複的 (grade, required) 判斷一次必選修，
+    再取出符合條件的課程。
+    
     Args:
         courses: 課程列表
         target_grade: 目標 grade
         target_required: 目標必選修（'必' 或 '選'）
+        index: build_grade_required_index(courses) 的結果；未提供時當場建立
         
     Returns:
-        過濾後的課程列表
+        過濾後的課程列表（維持原本順序）
     """
-    filtered = []
+    if index is None:
+        index = build_grade_required_index(courses)
     
-    for course in courses:
-        metadata = course.get('metadata', {})
-        document = course.get('document', '')
-        
-        # 從 metadata 或 document 中取得 grade 和 required
-        grade = metadata.get('grade', '')
-        required = metadata.get('required', '')
-        
-        # 如果 metadata 中沒有，嘗試從 document 中提取
-        if not grade or not required:
-            # 從 document 中提取
-            grade_match = re.search(r'年級：([^\n]+)', document)
-            required_match = re.search(r'必選修：([^\n]+)', document)
-            
-            if grade_match:
-                grade = grade_match.group(1).strip()
-            if required_match:
-                required = required_match.group(1).strip()
-        
-        # 檢查是否符合條件
-        course_dict = {'grade': grade, 'required': required}
-        grade_required = check_grade_required(course_dict, target_grade)
+    positions = []
+    for (grade, required), course_ids in index.items():
+        # 必選修欄位中沒有目標字樣時（例如查「選」而該課程全為必修）不可能符合，不必執行比對
+        if target_required and target_required not in required:
+            continue
+
+        # 欄位不完整的課程視為 None
+        if grade and required:
+            grade_required = _grade_required_status(grade, required, target_grade)
+        else:
+            grade_required = None
         
         if grade_required == target_required:
-            filtered.append(course)
+            positions.extend(course_ids)
     
-    return filtered
+    positions.sort()
+    return [courses[i] for i in positions]
 
 def get_grade_required_info(course: Dict) -> Dict[str, List[str]]:
     """
@@ -375,13 +680,13 @@ def get_grade_required_info(course: Dict) -> Dict[str, List[str]]:
     mapping_json = course.get('grade_required_mapping', '')
     if mapping_json:
         try:
-            mapping_data = json.loads(mapping_json)
+            mapping_data = load_mapping_json(mapping_json)
             return {
                 'required_groups': mapping_data.get('required_groups', []),
                 'elective_groups': mapping_data.get('elective_groups', []),
                 'mapping': mapping_data.get('mapping', [])
             }
-        except:
+        except _MAPPING_ERRORS:
             pass
     
     # 如果沒有 JSON 欄位，使用傳統方式解析
@@ -419,110 +724,157 @@ def check_grade_required_from_json(course: Dict, target_grade: str) -> Optional[
     # 優先使用 grade_required_mapping JSON 欄位
     mapping_json = course.get('grade_required_mapping', '')
     if mapping_json:
-        try:
-            import json
-            mapping_data = json.loads(mapping_json)
-            mapping = mapping_data.get('mapping', [])
-            
-            # 精確匹配優先（例如「經濟系1A」匹配「經濟系1A」）
-            for grade_item, required_item in mapping:
-                if grade_item == target_grade:
-                    if '必' in required_item:
-                        return '必'
-                    elif '選' in required_item:
-                        return '選'
-            
-            # 部分匹配：處理「經濟系1」匹配「經濟系1A」、「經濟系1B」的情況
-            # 也處理「資工系碩1」匹配「資工碩1A」、「企碩1」匹配「企碩1A」等
-            # 情況1：target_grade 是「經濟系1」，grade_item 是「經濟系1A」
-            # 這種情況下，grade_item.startswith(target_grade) 為 True
-            # 且差異部分是一個字母（A, B, C, D），這是一個有效的匹配
-            for grade_item, required_item in mapping:
-                if grade_item.startswith(target_grade):
-                    diff = grade_item[len(target_grade):].strip()
-                    # 允許：
-                    # 1. 單個字母 (A, B...)
-                    # 2. 非數字開頭的字串 (法學組, 智財組...) -> 避免 1 匹配 11
-                    # 3. 空字串 (完全匹配)
-                    if len(diff) == 0 or \
-                       (len(diff) == 1 and diff in ['A', 'B', 'C', 'D', 'E', 'F']) or \
-                       (len(diff) > 0 and not diff[0].isdigit()):
-                        if '必' in required_item:
-                            return '必'
-                        elif '選' in required_item:
-                            return '選'
-                
-                # 處理碩士班格式：例如「資工系碩1」匹配「資工碩1」（資料庫中沒有「系」字）
-                if '碩' in target_grade and '碩' in grade_item:
-                    # 提取系所和年級（移除「系」字以便匹配）
-                    target_dept = target_grade.split('碩')[0].replace('系', '').strip()
-                    target_num = target_grade.split('碩')[1].strip() if '碩' in target_grade else ''
-                    
-                    grade_dept = grade_item.split('碩')[0].replace('系', '').strip()
-                    grade_num = grade_item.split('碩')[1].strip() if '碩' in grade_item else ''
-                    
-                    # 如果系所相同或包含，且年級相同，則匹配
-                    # 例如：「資工系碩1」匹配「資工碩1」或「資工碩1A」
-                    if target_dept in grade_dept or grade_dept in target_dept:
-                        if target_num and (grade_num == target_num or grade_num.startswith(target_num)):
-                            if '必' in required_item:
-                                return '必'
-                            elif '選' in required_item:
-                                return '選'
-            
-            # 情況2：grade_item 是 target_grade 的前綴（反向匹配）
-            # 例如：target_grade 是「經濟系1A」，grade_item 是「經濟系1」
-            # 這種情況通常不需要，但為了完整性保留
-            for grade_item, required_item in mapping:
-                if target_grade.startswith(grade_item):
-                    diff = target_grade[len(grade_item):].strip()
-                    # 如果差異是一個字母，這是有效的匹配
-                    if len(diff) == 1 and diff in ['A', 'B', 'C', 'D', 'E', 'F']:
-                        if '必' in required_item:
-                            return '必'
-                        elif '選' in required_item:
-                            return '選'
-            
-            # 情況3：系所名稱模糊匹配（處理「通訊系3」匹配「通訊工程學系3」）
-            # 修正：將邏輯移入迴圈內，確保檢查每一筆 mapping
-            for grade_item, required_item in mapping:
-                g_norm = grade_item.replace('學系', '').replace('系', '')
-                t_norm = target_grade.replace('學系', '').replace('系', '')
-                
-                # 處理中文數字
-                trans_table = str.maketrans({'一': '1', '二': '2', '三': '3', '四': '4'})
-                g_norm = g_norm.translate(trans_table)
-                t_norm = t_norm.translate(trans_table)
-                
-                g_nums = re.findall(r'\d+', g_norm)
-                t_nums = re.findall(r'\d+', t_norm)
-                t_num = t_nums[0] if t_nums else ''
-                
-                g_text = re.sub(r'\d+', '', g_norm).strip()
-                t_text = re.sub(r'\d+', '', t_norm).strip()
-                
-                # 數字匹配邏輯修正
-                num_match = False
-                if t_num and not g_nums:
-                    if '必' in required_item:
-                        num_match = False
-                    else:
-                        num_match = True
-                else:
-                    num_match = (not g_nums) or (t_num and t_num in g_nums)
-                
-                if num_match:
-                    if g_text and t_text and (g_text in t_text or t_text in g_text):
-                        if '必' in required_item:
-                            return '必'
-                        elif '選' in required_item:
-                            return '選'
-        except:
-            pass
+        status = _grade_required_from_mapping(mapping_json, target_grade)
+        if status is not None:
+            return status
     
     # 如果沒有 JSON 欄位，使用傳統方式
     return check_grade_required(course, target_grade)
 
+
+@lru_cache(maxsize=16384)
+def _grade_required_from_mapping(mapping_json: str, target_grade: str) -> Optional[str]:
+    """
+    check_grade_required_from_json 中 JSON 欄位比對的快取版本（同一門課與同一年級只比對一次）
+    
+    Args:
+        mapping_json: grade_required_mapping 欄位的 JSON 字串
+        target_grade: 目標 grade
+        
+    Returns:
+        '必'、'選'；沒有匹配或解析失敗時為 None（由呼叫端改用 grade/required 欄位判斷）
+    """
+    try:
+        mapping = load_mapping_status(mapping_json)
+        exact = _load_mapping_exact(mapping_json)
+    except _MAPPING_ERRORS:
+        return None
+    
+    # 精確匹配優先（例如「經濟系1A」匹配「經濟系1A」）：查表即可，不必先掃描 mapping
+    status = exact.get(target_grade)
+    if status is not None:
+        return status
+    
+    # 只與 target_grade 有關的拆解在迴圈外先算好
+    target_len = len(target_grade)
+    t_nums, t_text = _split_grade_label(target_grade)
+    t_num = t_nums[0] if t_nums else ''
+    is_master_target = '碩' in target_grade
+    if is_master_target:
+        target_dept, target_num = _split_master_label(target_grade)
+    
+    # 單次掃描 mapping：三種情況各自記下第一個結果，
+    # 最後依「部分匹配 > 反向匹配 > 模糊匹配」的優先順序回傳；
+    # 已找到較高優先的結果後，較低優先的比對就不必再做
+    partial = reverse = fuzzy = None
+    for grade_item, status in mapping:
+        # 部分匹配優先順序最高，找到後不必再看其餘項目
+        if partial is not None:
+            break
+        has_status = status == '必' or status == '選'
+        
+        # 情況1：部分匹配，處理「經濟系1」匹配「經濟系1A」、「經濟系1B」的情況
+        # 也處理「資工系碩1」匹配「資工碩1A」、「企碩1」匹配「企碩1A」等
+        if grade_item.startswith(target_grade):
+            if _section_suffix_matches(grade_item[target_len:].strip()):
+                if has_status:
+                    partial = status
+                    continue
+        
+        # 處理碩士班格式：例如「資工系碩1」匹配「資工碩1」（資料庫中沒有「系」字）
+        if is_master_target and '碩' in grade_item:
+            if _master_grade_matches(grade_item, target_dept, target_num) and has_status:
+                partial = status
+                continue
+        
+        if reverse is not None:
+            continue
+        
+        # 情況2：grade_item 是 target_grade 的前綴（反向匹配）
+        # 例如：target_grade 是「經濟系1A」，grade_item 是「經濟系1」
+        if target_grade.startswith(grade_item):
+            diff = target_grade[len(grade_item):].strip()
+            # 如果差異是一個字母，這是有效的匹配
+            if len(diff) == 1 and diff in _SECTION_LETTERS and has_status:
+                reverse = status
+                continue
+        
+        if fuzzy is not None:
+            continue
+        
+        # 情況3：系所名稱模糊匹配（處理「通訊系3」匹配「通訊工程學系3」）
+        if has_status and _fuzzy_dept_matches(grade_item, status == '必', t_num, t_text):
+            fuzzy = status
+    
+    for status in (partial, reverse, fuzzy):
+        if status is not None:
+            return status
+    return None
+
+# 查詢中的星期寫法 → 標準星期
+_DAY_PATTERNS = MappingProxyType({
+    '週一': '週一', '星期一': '週一', '禮拜一': '週一', '周一': '週一', 'Monday': '週一', 'Mon': '週一',
+    '週二': '週二', '星期二': '週二', '禮拜二': '週二', '周二': '週二', 'Tuesday': '週二', 'Tue': '週二',
+    '週三': '週三', '星期三': '週三', '禮拜三': '週三', '周三': '週三', 'Wednesday': '週三', 'Wed': '週三',
+    '週四': '週四', '星期四': '週四', '禮拜四': '週四', '周四': '週四', 'Thursday': '週四', 'Thu': '週四',
+    '週五': '週五', '星期五': '週五', '禮拜五': '週五', '周五': '週五', 'Friday': '週五', 'Fri': '週五',
+    '週六': '週六', '星期六': '週六', '禮拜六': '週六', '周六': '週六', 'Saturday': '週六', 'Sat': '週六',
+    '週日': '週日', '星期日': '週日', '禮拜日': '週日', '禮拜天': '週日', '周日': '週日', '周天': '週日', 'Sunday': '週日', 'Sun': '週日',
+})
+
+# 所有星期寫法合併為單一正則，一次掃描找出查詢中出現的寫法；
+# 選項依長度由長到短排列（「Monday」先於「Mon」），不依賴 _DAY_PATTERNS 的書寫順序；
+# 出現多個時沿用逐一檢查 _DAY_PATTERNS 的優先順序（越前面的寫法優先）
+_DAY_RE = re.compile('|'.join(map(re.escape, sorted(_DAY_PATTERNS, key=len, reverse=True))))
+_DAY_PATTERN_PRIORITY = MappingProxyType({pattern: i for i, pattern in enumerate(_DAY_PATTERNS)})
+
+# 「週3」「星期三」等數字/國字寫法 → 標準星期
+_DAY_NUMBERS = MappingProxyType({
+    '1': '週一', '一': '週一',
+    '2': '週二', '二': '週二',
+    '3': '週三', '三': '週三',
+    '4': '週四', '四': '週四',
+    '5': '週五', '五': '週五',
+    '6': '週六', '六': '週六',
+    '7': '週日', '日': '週日', '天': '週日',
+})
+
+# 查詢中「週3」「禮拜 三」等星期 + 數字的寫法
+_QUERY_DAY_NUMBER_RE = re.compile(r'(週|周|星期|禮拜)\s*([1-7一二三四五六日天])')
+
+# 課程上課時間中各星期可能的寫法
+_SCHEDULE_DAY_KEYWORDS = MappingProxyType({
+    '週一': ('週一', '星期一', 'Monday', 'Mon', '一'),
+    '週二': ('週二', '星期二', 'Tuesday', 'Tue', '二', 'T'),
+    '週三': ('週三', '星期三', 'Wednesday', 'Wed', '三'),
+    '週四': ('週四', '星期四', 'Thursday', 'Thu', '四'),
+    '週五': ('週五', '星期五', 'Friday', 'Fri', '五'),
+    '週六': ('週六', '星期六', 'Saturday', 'Sat', '六'),
+    '週日': ('週日', '星期日', 'Sunday', 'Sun', '日'),
+})
+_SCHEDULE_DAY_PATTERNS = MappingProxyType({
+    day: re.compile('|'.join(map(re.escape, keywords)))
+    for day, keywords in _SCHEDULE_DAY_KEYWORDS.items()
+})
+
+# 匹配節次範圍：1~2、3~4、5~7、1-2、3-4 等
+# 但不匹配教室號碼（如「電1F02」中的「1」和「02」）
+# 節次通常在「週X」之後，且格式為「數字~數字」或「數字-數字」
+# 上課時間中的節次寫法；原本八種寫法合併為兩條（「~」與「-」、有無空白、「每週」皆已涵蓋），
+# 兩條分開掃描以保留各自的非重疊匹配結果
+_SCHEDULE_PERIOD_PATTERNS = (
+    re.compile(r'週[一二三四五六日]\s*(\d+)\s*[~-](\d+)'),  # 週二3~4、週二 3-4、每週二3~4
+    re.compile(r'(\d+)[~-](\d+)\s*[\(（]'),  # 3~4（、3-4（
+)
+
+# 時段對應的起始節次範圍（含頭尾）
+_PERIOD_START_RANGES = MappingProxyType({
+    '早上': (1, 4),  # 早上：1-4節
+    '下午': (5, 8),  # 下午：5-8節
+    '晚上': (9, 12),  # 晚上：9-12節
+})
+
+
 def extract_time_from_query(query: str) -> Dict[str, Optional[str]]:
     """
     從查詢中提取時間條件
@@ -531,52 +883,47 @@ def extract_time_from_query(query: str) -> Dict[str, Optional[str]]:
         query: 使用者查詢
         
     Returns:
-        包含時間條件的字典，例如 {'day': '週二', 'period': '早上'}
+        包含時間條件的字典，例如 {'day': '週二', 'period': '早上'}；每次回傳新的字典，呼叫端可自行修改
     """
-    result = {'day': None, 'period': None}
+    day, period = _extract_time_parts(query)
+    return {'day': day, 'period': period}
+
+
+@lru_cache(maxsize=2048)
+def _extract_time_parts(query: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    extract_time_from_query 的快取版本（依查詢字串快取）
     
-    # 提取星期幾（含口語與數字寫法）
-    day_patterns = {
-        '週一': '週一', '星期一': '週一', '禮拜一': '週一', '周一': '週一', 'Monday': '週一', 'Mon': '週一',
-        '週二': '週二', '星期二': '週二', '禮拜二': '週二', '周二': '週二', 'Tuesday': '週二', 'Tue': '週二',
-        '週三': '週三', '星期三': '週三', '禮拜三': '週三', '周三': '週三', 'Wednesday': '週三', 'Wed': '週三',
-        '週四': '週四', '星期四': '週四', '禮拜四': '週四', '周四': '週四', 'Thursday': '週四', 'Thu': '週四',
-        '週五': '週五', '星期五': '週五', '禮拜五': '週五', '周五': '週五', 'Friday': '週五', 'Fri': '週五',
-        '週六': '週六', '星期六': '週六', '禮拜六': '週六', '周六': '週六', 'Saturday': '週六', 'Sat': '週六',
-        '週日': '週日', '星期日': '週日', '禮拜日': '週日', '禮拜天': '週日', '周日': '週日', '周天': '週日', 'Sunday': '週日', 'Sun': '週日',
-    }
+    Args:
+        query: 使用者查詢
+        
+    Returns:
+        (星期幾, 時段)
+    """
+    day = None
+    period = None
     
-    for pattern, day in day_patterns.items():
-        if pattern in query:
-            result['day'] = day
-            break
+    # 提取星期幾（含口語與數字寫法）
+    day_matches = _DAY_RE.findall(query)
+    if day_matches:
+        day = _DAY_PATTERNS[min(day_matches, key=_DAY_PATTERN_PRIORITY.__getitem__)]
     
     # 支援「週3/周3/星期3/禮拜3」等數字寫法
-    if not result['day']:
-        import re
-        m = re.search(r'(週|周|星期|禮拜)\s*([1-7一二三四五六日天])', query)
+    if not day:
+        m = _QUERY_DAY_NUMBER_RE.search(query)
         if m:
             num = m.group(2)
-            num_map = {
-                '1': '週一', '一': '週一',
-                '2': '週二', '二': '週二',
-                '3': '週三', '三': '週三',
-                '4': '週四', '四': '週四',
-                '5': '週五', '五': '週五',
-                '6': '週六', '六': '週六',
-                '7': '週日', '日': '週日', '天': '週日',
-            }
-            result['day'] = num_map.get(num)
+            day = _DAY_NUMBERS.get(num)
     
     # 提取時段
     if '早上' in query or '上午' in query or 'AM' in query:
-        result['period'] = '早上'  # 1-4節
+        period = '早上'  # 1-4節
     elif '下午' in query or 'PM' in query:
-        result['period'] = '下午'  # 5-8節
+        period = '下午'  # 5-8節
     elif '晚上' in query or '夜間' in query:
-        result['period'] = '晚上'  # 9-12節
+        period = '晚上'  # 9-12節
     
-    return result
+    return day, period
 
 def check_time_match(schedule: str, time_condition: Dict[str, Optional[str]]) -> bool:
     """
@@ -597,125 +944,55 @@ def check_time_match(schedule: str, time_condition: Dict[str, Optional[str]]) ->
     
     # 檢查星期幾
     if day:
-        # 檢查是否包含對應的星期幾
-        day_mapping = {
-            '週一': ['週一', '星期一', 'Monday', 'Mon', '一'],
-            '週二': ['週二', '星期二', 'Tuesday', 'Tue', '二', 'T'],
-            '週三': ['週三', '星期三', 'Wednesday', 'Wed', '三'],
-            '週四': ['週四', '星期四', 'Thursday', 'Thu', '四'],
-            '週五': ['週五', '星期五', 'Friday', 'Fri', '五'],
-            '週六': ['週六', '星期六', 'Saturday', 'Sat', '六'],
-            '週日': ['週日', '星期日', 'Sunday', 'Sun', '日'],
-        }
-        
-        day_keywords = day_mapping.get(day, [])
-        day_match = any(keyword in schedule for keyword in day_keywords)
-        
-        if not day_match:
+        # 檢查是否包含對應的星期幾（任一寫法出現即符合）
+        day_pattern = _SCHEDULE_DAY_PATTERNS.get(day)
+        if day_pattern is None or not day_pattern.search(schedule):
             return False
     
     # 檢查時段
     if period:
+        # 節次寫法都含有數字，上課時間中沒有任何數字時不可能符合
+        if not _DIGITS_RE.search(schedule):
+            return False
+        
+        period_range = _PERIOD_START_RANGES.get(period)
+        if period_range is None:
+            return False
+        start_min, start_max = period_range
+        
         # 提取節次範圍（更精確的模式，避免匹配到教室號碼）
-        import re
         
-        # 優先匹配主要上課時間，而不是實習時間
-        # 如果 schedule 中包含「實習」或「;」，優先檢查主要上課時間（「;」之前的部分）
+        # 只檢查主要上課時間，而不是實習時間：
+        # 如果 schedule 中包含「;」，只看「;」之前的部分，因為用戶查詢的是主要上課時間
         main_schedule = schedule
         if ';' in schedule:
-            # 分割主要上課時間和實習時間
-            parts = schedule.split(';')
-            main_schedule = parts[0].strip()
-            # 如果主要上課時間不符合條件，再檢查實習時間
-            # 但優先使用主要上課時間
-        
-        # 匹配節次範圍：1~2、3~4、5~7、1-2、3-4 等
-        # 但不匹配教室號碼（如「電1F02」中的「1」和「02」）
-        # 節次通常在「週X」之後，且格式為「數字~數字」或「數字-數字」
-        time_patterns = [
-            r'週[一二三四五六日]\s*(\d+)~(\d+)',  # 週二3~4
-            r'週[一二三四五六日]\s*(\d+)-(\d+)',  # 週二3-4
-            r'週[一二三四五六日]\s*(\d+)\s*~(\d+)',  # 週二 3~4
-            r'週[一二三四五六日]\s*(\d+)\s*-(\d+)',  # 週二 3-4
-            r'每週[一二三四五六日]\s*(\d+)~(\d+)',  # 每週二3~4
-            r'每週[一二三四五六日]\s*(\d+)-(\d+)',  # 每週二3-4
-            r'(\d+)~(\d+)\s*[\(（]',  # 3~4（
-            r'(\d+)-(\d+)\s*[\(（]',  # 3-4（
-        ]
+            main_schedule = schedule.split(';', 1)[0].strip()
         
         period_match = False
-        
-        # 先檢查主要上課時間
-        for pattern in time_patterns:
-            matches = re.findall(pattern, main_schedule)
-            for match in matches:
-                try:
-                    start = int(match[0]) if match[0] else 0
-                    end = int(match[1]) if match[1] and match[1] else start
-                    
-                    # 只考慮合理的節次範圍（1-12節）
-                    if start >= 1 and start <= 12:
-                        if period == '早上':
-                            # 早上：1-4節
-                            if start >= 1 and start <= 4:
-                                period_match = True
-                                break
-                        elif period == '下午':
-                            # 下午：5-8節
-                            if start >= 5 and start <= 8:
-                                period_match = True
-                                break
-                        elif period == '晚上':
-                            # 晚上：9-12節
-                            if start >= 9 and start <= 12:
-                                period_match = True
-                                break
-                except:
-                    continue
+        for pattern in _SCHEDULE_PERIOD_PATTERNS:
+            for match in pattern.finditer(main_schedule):
+                # 正規表示式保證起始節次為數字；只考慮落在該時段內的起始節次
+                if start_min <= int(match.group(1)) <= start_max:
+                    period_match = True
+                    break
             if period_match:
                 break
         
-        # 如果主要上課時間不符合條件，且 schedule 中包含「實習」或「;」，不匹配實習時間
-        # 因為用戶查詢的是主要上課時間，而不是實習時間
-        if not period_match and (';' in schedule or '實習' in schedule):
-            return False
-        
-        # 如果主要上課時間不符合條件，且沒有「實習」標記，再檢查整個 schedule
-        if not period_match:
-            for pattern in time_patterns:
-                matches = re.findall(pattern, schedule)
-                for match in matches:
-                    try:
-                        start = int(match[0]) if match[0] else 0
-                        end = int(match[1]) if match[1] and match[1] else start
-                        
-                        # 只考慮合理的節次範圍（1-12節）
-                        if start >= 1 and start <= 12:
-                            if period == '早上':
-                                # 早上：1-4節
-                                if start >= 1 and start <= 4:
-                                    period_match = True
-                                    break
-                            elif period == '下午':
-                                # 下午：5-8節
-                                if start >= 5 and start <= 8:
-                                    period_match = True
-                                    break
-                            elif period == '晚上':
-                                # 晚上：9-12節
-                                if start >= 9 and start <= 12:
-                                    period_match = True
-                                    break
-                    except:
-                        continue
-                if period_match:
-                    break
-        
         if not period_match:
             return False
     
     return True
 
+
+# 法律系組別別名（例如「財法組」與「財經法組」視為同一組）
+_LAW_GROUP_ALIASES = MappingProxyType({
+    '財法': ('財法', '財經法'),
+    '財經法': ('財法', '財經法'),
+    '司法': ('司法',),
+    '法學': ('法學',),
+})
+
+
 def check_grades_required_from_json(course: Dict, target_grade: str) -> List[Tuple[str, str]]:
     """
     從 JSON 欄位檢查特定 grade 的所有匹配結果（返回所有匹配）
@@ -729,124 +1006,120 @@ def check_grades_required_from_json(course: Dict, target_grade: str) -> List[Tup
         匹配結果列表，每個元素是 (grade_item, required_item) 的 tuple
         例如：[('經濟系1A', '必'), ('經濟系1B', '必')]
     """
+    return list(_grades_required_matches(course.get('grade_required_mapping', ''), target_grade))
+
+
+@lru_cache(maxsize=8192)
+def _grades_required_matches(mapping_json: str, target_grade: str) -> Tuple[Tuple[str, str], ...]:
+    """
+    check_grades_required_from_json 的快取版本（同一門課與同一年級只比對一次）
+    
+    Args:
+        mapping_json: grade_required_mapping 欄位的 JSON 字串
+        target_grade: 目標 grade
+        
+    Returns:
+        匹配結果 tuple；mapping_json 為空或格式錯誤時為空 tuple
+    """
+    if not mapping_json:
+        return ()
+    try:
+        mapping = load_mapping_status(mapping_json)
+    except _MAPPING_ERRORS:
+        return ()
+    
     results = []
-    mapping_json = course.get('grade_required_mapping', '')
+    _collect_grades_required(mapping, target_grade, results)
+    return tuple(results)
+
+
+def check_grades_required_parsed(mapping: List, target_grade: str) -> List[Tuple[str, str]]:
+    """
+    對已解析的 grade_required_mapping['mapping'] 檢查特定 grade 的所有匹配結果
     
-    if mapping_json:
-        try:
-            import json
-            mapping_data = json.loads(mapping_json)
-            mapping = mapping_data.get('mapping', [])
-            
-            # 精確匹配
-            for grade_item, required_item in mapping:
-                if grade_item == target_grade:
-                    required_status = '必' if '必' in required_item else '選' if '選' in required_item else required_item
-                    results.append((grade_item, required_status))
-            
-            # 部分匹配：處理「經濟系1」匹配「經濟系1A」、「經濟系1B」的情況
-            # 也處理「資工系碩1」匹配「資工碩1」的情況
-            for grade_item, required_item in mapping:
-                # 標準匹配：grade_item 以 target_grade 開頭
-                if grade_item.startswith(target_grade):
-                    diff = grade_item[len(target_grade):].strip()
-                    # 允許：
-                    # 1. 單個字母 (A, B...)
-                    # 2. 非數字開頭的字串 (法學組, 智財組...) -> 避免 1 匹配 11
-                    # 3. 空字串 (完全匹配)
-                    if len(diff) == 0 or \
-                       (len(diff) == 1 and diff in ['A', 'B', 'C', 'D', 'E', 'F']) or \
-                       (len(diff) > 0 and not diff[0].isdigit()):
-                        # 檢查是否已經在結果中（避免重複）
-                        if not any(g == grade_item for g, _ in results):
-                            required_status = '必' if '必' in required_item else '選' if '選' in required_item else required_item
-                            results.append((grade_item, required_status))
+    Args:
+        mapping: (grade_item, required_item) 的列表
+        target_grade: 目標 grade（例如「經濟系1」）
+        
+    Returns:
+        匹配結果列表，每個元素是 (grade_item, required_item) 的 tuple
+    """
+    results = []
+    statuses = [(grade_item, _required_status(required_item)) for grade_item, required_item in mapping]
+    _collect_grades_required(statuses, target_grade, results)
+    return results
+
+
+def _required_status(required_item: str) -> str:
+    """必選修欄位正規化：含「必」為 '必'，含「選」為 '選'，否則原樣回傳"""
+    return '必' if '必' in required_item else '選' if '選' in required_item else required_item
+
+
+def _collect_grades_required(mapping: List, target_grade: str, results: List[Tuple[str, str]]) -> None:
+    """
+    比對 mapping 中符合 target_grade 的項目，依序加入 results（就地修改）
+    
+    只與 target_grade 有關的拆解（數字、文字、法律組別、碩士班系所）在迴圈外先算好；
+    mapping 只掃描一次，精確匹配直接加入 results，部分匹配與其他匹配先各自暫存，
+    掃描完再依「精確 > 部分 > 其他」的順序合併，並以 set 去除重複的 grade_item。
+    
+    Args:
+        mapping: (grade_item, 必選修狀態) 的列表，狀態已由 _required_status 正規化
+        target_grade: 目標 grade
+        results: 收集匹配結果的列表
+    """
+    target_len = len(target_grade)
+    t_nums, t_text = _split_grade_label(target_grade)
+    t_num = t_nums[0] if t_nums else ''
+    
+    is_law_target = '法律' in target_grade
+    if is_law_target:
+        law_t_nums = _DIGITS_RE.findall(target_grade)
+        law_t_num = law_t_nums[0] if law_t_nums else ''
+        # 找出目標查詢中的組別關鍵字
+        target_group_key = next((k for k in _LAW_GROUP_ALIASES if k in target_grade), None)
+    
+    is_master_target = '碩' in target_grade
+    if is_master_target:
+        target_dept, target_num = _split_master_label(target_grade)
+    
+    partial_matches = []
+    other_matches = []
+    for grade_item, status in mapping:
+        # 精確匹配
+        if grade_item == target_grade:
+            results.append((grade_item, status))
+        
+        # 部分匹配：處理「經濟系1」匹配「經濟系1A」、「經濟系1B」的情況
+        if grade_item.startswith(target_grade):
+            if _section_suffix_matches(grade_item[target_len:].strip()):
+                partial_matches.append((grade_item, status))
+        
+        # 情況3：系所名稱模糊匹配（處理「通訊系3」匹配「通訊工程學系3」）
+        if _fuzzy_dept_matches(grade_item, status == '必', t_num, t_text):
+            other_matches.append((grade_item, status))
+        
+        # 處理法律系組別匹配：例如「法律系1」匹配「法律系財法組1」
+        # 或者「法律系財法組1」匹配「法律系財經法組1」（處理簡稱）
+        if is_law_target and '法律' in grade_item:
+            # 提取數字
+            g_law_nums = _DIGITS_RE.findall(grade_item)
+            g_num = g_law_nums[0] if g_law_nums else ''
             
-            # 情況3：系所名稱模糊匹配（處理「通訊系3」匹配「通訊工程學系3A」）
-            # 情況3：系所名稱模糊匹配（處理「通訊系3」匹配「通訊工程學系3」）
-            # 修正：將邏輯移入迴圈內
-            for grade_item, required_item in mapping:
-                g_norm = grade_item.replace('學系', '').replace('系', '')
-                t_norm = target_grade.replace('學系', '').replace('系', '')
-                
-                # 處理中文數字
-                trans_table = str.maketrans({'一': '1', '二': '2', '三': '3', '四': '4'})
-                g_norm = g_norm.translate(trans_table)
-                t_norm = t_norm.translate(trans_table)
-                
-                g_nums = re.findall(r'\d+', g_norm)
-                t_nums = re.findall(r'\d+', t_norm)
-                t_num = t_nums[0] if t_nums else ''
-                
-                g_text = re.sub(r'\d+', '', g_norm).strip()
-                t_text = re.sub(r'\d+', '', t_norm).strip()
-                
-                # 數字匹配：目標年級在列表內，或課程不分年級
-                # 數字匹配邏輯修正
-                num_match = False
-                if t_num and not g_nums:
-                    if '必' in required_item:
-                        num_match = False
-                    else:
-                        num_match = True
-                else:
-                    num_match = (not g_nums) or (t_num and t_num in g_nums)
-                
-                if num_match:
-                    if g_text and t_text and (g_text in t_text or t_text in g_text):
-                        if not any(g == grade_item for g, _ in results):
-                            required_status = '必' if '必' in required_item else '選' if '選' in required_item else required_item
-                            results.append((grade_item, required_status))
-                
-                # 處理法律系組別匹配：例如「法律系1」匹配「法律系財法組1」
-                # 或者「法律系財法組1」匹配「法律系財經法組1」（處理簡稱）
-                if '法律' in target_grade and '法律' in grade_item:
-                    # 提取數字
-                    t_nums = re.findall(r'\d+', target_grade)
-                    g_nums = re.findall(r'\d+', grade_item)
-                    t_num = t_nums[0] if t_nums else ''
-                    g_num = g_nums[0] if g_nums else ''
-                    
-                    if t_num and g_num and t_num == g_num:
-                        # 定義組別別名映射
-                        group_aliases = {
-                            '財法': ['財法', '財經法'],
-                            '財經法': ['財法', '財經法'],
-                            '司法': ['司法'],
-                            '法學': ['法學'],
-                        }
-                        
-                        # 找出目標查詢中的組別關鍵字
-                        target_group_key = next((k for k in group_aliases if k in target_grade), None)
-                        
-                        # 如果目標指定了組別，檢查 grade_item 是否包含該組別或其別名
-                        if target_group_key:
-                            if any(alias in grade_item for alias in group_aliases[target_group_key]):
-                                required_status = '必' if '必' in required_item else '選' if '選' in required_item else required_item
-                                if not any(g == grade_item for g, _ in results):
-                                    results.append((grade_item, required_status))
-                        else:
-                            # 目標沒指定組別（如法律系1），則匹配所有組別
-                            required_status = '必' if '必' in required_item else '選' if '選' in required_item else required_item
-                            if not any(g == grade_item for g, _ in results):
-                                results.append((grade_item, required_status))
-
-                # 處理碩士班格式：例如「資工系碩1」匹配「資工碩1」（資料庫中沒有「系」字）
-                if '碩' in target_grade and '碩' in grade_item:
-                    target_dept = target_grade.split('碩')[0].replace('系', '').strip()
-                    target_num = target_grade.split('碩')[1].strip() if '碩' in target_grade else ''
-                    
-                    grade_dept = grade_item.split('碩')[0].replace('系', '').strip()
-                    grade_num = grade_item.split('碩')[1].strip() if '碩' in grade_item else ''
-                    
-                    # 如果系所相同或包含，且年級相同，則匹配
-                    if target_dept in grade_dept or grade_dept in target_dept:
-                        if target_num and (grade_num == target_num or grade_num.startswith(target_num)):
-                            # 檢查是否已經在結果中（避免重複）
-                            if not any(g == grade_item for g, _ in results):
-                                required_status = '必' if '必' in required_item else '選' if '選' in required_item else required_item
-                                results.append((grade_item, required_status))
-        except:
-            pass
+            if law_t_num and g_num and law_t_num == g_num:
+                # 如果目標指定了組別，檢查 grade_item 是否包含該組別或其別名
+                # 目標沒指定組別（如法律系1），則匹配所有組別
+                if not target_group_key or any(alias in grade_item for alias in _LAW_GROUP_ALIASES[target_group_key]):
+                    other_matches.append((grade_item, status))
+
+        # 處理碩士班格式：例如「資工系碩1」匹配「資工碩1」（資料庫中沒有「系」字）
+        if is_master_target and '碩' in grade_item:
+            if _master_grade_matches(grade_item, target_dept, target_num):
+                other_matches.append((grade_item, status))
     
-    return results
+    # 精確匹配全部保留，部分匹配與其他匹配略過已加入的 grade_item（避免重複）
+    seen = {g for g, _ in results}
+    for grade_item, status in partial_matches + other_matches:
+        if grade_item not in seen:
+            seen.add(grade_item)
+            results.append((grade_item, status))